@@ -0,0 +1,35 @@
+-- allocation of many small tables
+local function bottom_up_tree(depth)
+	if depth > 0 then
+		depth = depth - 1
+		local left, right = bottom_up_tree(depth), bottom_up_tree(depth)
+		return { left, right }
+	else
+		return { }
+	end
+end
+
+local function item_check(tree)
+	if tree[1] then
+		return 1 + item_check(tree[1]) + item_check(tree[2])
+	else
+		return 1
+	end
+end
+
+local N = N or 6
+local mindepth = 4
+local maxdepth = mindepth + 2
+if maxdepth < N then maxdepth = N end
+
+local check = item_check(bottom_up_tree(maxdepth + 1))
+local longlived = bottom_up_tree(maxdepth)
+
+for depth = mindepth, maxdepth, 2 do
+	local iterations = 2 ^ (maxdepth - depth + mindepth)
+	for i = 1, iterations do
+		check = check + item_check(bottom_up_tree(depth))
+	end
+end
+
+return check + item_check(longlived)
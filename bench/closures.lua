@@ -0,0 +1,23 @@
+-- closure creation and upvalue access
+local N = N or 2000
+
+local function counter()
+	local count = 0
+	return function(step)
+		count = count + step
+		return count
+	end
+end
+
+local function compose(f, g)
+	return function(x) return f(g(x)) end
+end
+
+local total = 0
+for i = 1, N do
+	local c = counter()
+	c(i)
+	local inc = compose(c, function(x) return x + 1 end)
+	total = total + inc(1)
+end
+return total
@@ -0,0 +1,7 @@
+-- naive recursion: call overhead and small-number arithmetic
+local function fib(n)
+	if n < 2 then return n end
+	return fib(n - 1) + fib(n - 2)
+end
+
+return fib(N or 20)
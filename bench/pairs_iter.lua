@@ -0,0 +1,13 @@
+-- generic for loops over the hash and array parts
+local N = N or 2000
+
+local hash = {}
+for i = 1, N do hash["k" .. i] = i end
+local arr = {}
+for i = 1, N do arr[i] = i * 2 end
+
+local sum = 0
+for k, v in pairs(hash) do sum = sum + v end
+for i, v in ipairs(arr) do sum = sum + v end
+for k, v in pairs(arr) do sum = sum + k end
+return sum
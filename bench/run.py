@@ -0,0 +1,222 @@
+"""
+Benchmark runner for the VM.
+
+The benchmarks are the .lua files in this directory. They are compiled with
+luac5.1 into chunks/ (again only when the source is newer than the chunk),
+then every benchmark is run under every VM configuration and its result is
+checked. The runner reports runs per second, peak memory of a run and the
+time it takes to load the chunk, and compares them against a stored
+baseline.
+
+	python bench/run.py                       # run everything, compare to baseline.json
+	python bench/run.py fib nbody -c release  # a subset
+	python bench/run.py --save-baseline       # store the results as the new baseline
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CHUNK_DIR = os.path.join(BENCH_DIR, "chunks")
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+
+from luafile import LuaFile
+from luabudget import LuaBudget
+from luatypes import *
+from lvm import call_lua_function
+
+
+# benchmark name: (value of N, expected results)
+BENCHMARKS = {
+	"fib": (20, [6765]),
+	"binary_trees": (6, [4398]),
+	"nbody": (100, [-0.1690507623824094]),
+	"spectral_norm": (20, [1.2738398405412965]),
+	"fannkuch": (7, [228, 16]),
+	"string_build": (2000, [25785]),
+	"table_sort": (2000, [102924]),
+	"table_insert": (2000, [2400, 6130009]),
+	"table_remove": (2000, [2001000, 6005005, 0]),
+	"table_foreach": (2000, [2668667000, 4002000, 1000]),
+	"table_unpack": (2000, [88000, 3999, 2000]),
+	"pairs_iter": (2000, [8004000]),
+	"closures": (2000, [2005000]),
+}
+
+
+def load_release(name: str, bytecode: bytes) -> LuaFile:
+	return LuaFile(name, bytecode)
+
+
+def load_unoptimized(name: str, bytecode: bytes) -> LuaFile:
+	return LuaFile(name, bytecode, optimize=False)
+
+
+def load_budget(name: str, bytecode: bytes) -> LuaFile:
+	# a budget without limits, to see what the accounting itself costs
+	luafile = LuaFile(name, bytecode)
+	luafile.env.budget = LuaBudget()
+	return luafile
+
+
+# VM configuration name: function loading a chunk into a ready to run LuaFile
+CONFIGS = {
+	"release": load_release,
+	"unoptimized": load_unoptimized,
+	"budget": load_budget,
+}
+
+
+def compile_benchmark(name: str) -> bytes | None:
+	source = os.path.join(BENCH_DIR, name + ".lua")
+	chunk = os.path.join(CHUNK_DIR, name + ".luac")
+
+	stale = not os.path.exists(chunk) or os.path.getmtime(chunk) < os.path.getmtime(source)
+	if stale and shutil.which("luac5.1"):
+		os.makedirs(CHUNK_DIR, exist_ok=True)
+		subprocess.check_call(["luac5.1", "-o", chunk, source])
+	if not os.path.exists(chunk):
+		return None
+
+	with open(chunk, "rb") as f:
+		return f.read()
+
+
+def run_once(load, name: str, bytecode: bytes, n: int) -> tuple[float, list]:
+	luafile = load(name, bytecode)
+	luafile.env.set(LuaString("N"), LuaNumber(n))
+	start = time.perf_counter()
+	res = call_lua_function(luafile.main_func, luafile.env, [])
+	return time.perf_counter() - start, [make_py_type(r) for r in res]
+
+
+def check_results(res: list, expected: list):
+	res = res[:len(expected)]
+	if len(res) != len(expected) or any(
+		not isinstance(r, (int, float)) or abs(r - e) > 1e-9 * max(1, abs(e))
+		for r, e in zip(res, expected)
+	):
+		raise AssertionError(f"expected {expected}, got {res}")
+
+
+def measure(load, name: str, bytecode: bytes, min_time: float) -> dict:
+	n, expected = BENCHMARKS[name]
+
+	startup = []
+	for _ in range(5):
+		start = time.perf_counter()
+		load(name, bytecode)
+		startup.append(time.perf_counter() - start)
+
+	# the first run doubles as the warmup
+	_, res = run_once(load, name, bytecode, n)
+	check_results(res, expected)
+
+	runs, total = 0, 0.0
+	while runs < 3 or total < min_time:
+		elapsed, _ = run_once(load, name, bytecode, n)
+		runs += 1
+		total += elapsed
+
+	tracemalloc.start()
+	run_once(load, name, bytecode, n)
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	return {
+		"ops_per_sec": runs / total,
+		"peak_memory": peak,
+		"startup": sorted(startup)[len(startup) // 2],
+	}
+
+
+def run_benchmarks(names: list[str], configs: list[str], min_time: float) -> dict:
+	results = {config: {} for config in configs}
+	for name in names:
+		bytecode = compile_benchmark(name)
+		for config in configs:
+			if bytecode is None:
+				results[config][name] = {"error": "no chunk (luac5.1 not found)"}
+				continue
+			try:
+				results[config][name] = measure(CONFIGS[config], name, bytecode, min_time)
+			except Exception as err:
+				results[config][name] = {"error": f"{type(err).__name__}: {err}"}
+	return results
+
+
+def report(results: dict, baseline: dict, threshold: float) -> list[str]:
+	regressions = []
+	print(f"{'benchmark':14} {'config':12} {'ops/s':>10} {'change':>8} {'peak mem':>10} {'startup':>9}")
+	for config, benchmarks in results.items():
+		for name, res in benchmarks.items():
+			if "error" in res:
+				print(f"{name:14} {config:12} {res['error']}")
+				continue
+
+			change = ""
+			base = baseline.get(config, {}).get(name, {})
+			if "ops_per_sec" in base:
+				ratio = res["ops_per_sec"] / base["ops_per_sec"] - 1
+				change = f"{ratio:+.1%}"
+				if ratio < -threshold:
+					change += " !"
+					regressions.append(f"{name} ({config})")
+
+			print(
+				f"{name:14} {config:12} {res['ops_per_sec']:10.2f} {change:>8} "
+				f"{res['peak_memory'] / 1024:8.0f}KB {res['startup'] * 1000:7.2f}ms"
+			)
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Run the VM benchmarks.")
+	parser.add_argument("benchmarks", nargs="*", help="benchmarks to run (default: all)")
+	parser.add_argument("-c", "--config", action="append", choices=CONFIGS, help="VM configurations to run (default: all)")
+	parser.add_argument("--min-time", type=float, default=1.0, help="seconds to spend per benchmark and configuration")
+	parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "baseline.json"))
+	parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+	parser.add_argument("--threshold", type=float, default=0.1, help="slowdown reported as a regression")
+	parser.add_argument("--fail-on-regression", action="store_true")
+	parser.add_argument("--json", help="also write the results to this file")
+	args = parser.parse_args()
+
+	names = args.benchmarks or list(BENCHMARKS)
+	for name in names:
+		if name not in BENCHMARKS:
+			parser.error(f"unknown benchmark '{name}'")
+
+	results = run_benchmarks(names, args.config or list(CONFIGS), args.min_time)
+
+	baseline = {}
+	if os.path.exists(args.baseline):
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+	regressions = report(results, baseline, args.threshold)
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump(results, f, indent="\t")
+	if args.save_baseline:
+		for config, benchmarks in results.items():
+			for name, res in benchmarks.items():
+				if "error" not in res:
+					baseline.setdefault(config, {})[name] = res
+		with open(args.baseline, "w") as f:
+			json.dump(baseline, f, indent="\t")
+
+	if regressions:
+		print("regressions:", ", ".join(regressions))
+		if args.fail_on_regression:
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,15 @@
+-- repeated concatenation and table.concat
+local N = N or 2000
+
+local s = ""
+for i = 1, N do
+	s = s .. i .. ","
+end
+
+local parts = {}
+for i = 1, N do
+	parts[#parts + 1] = "item" .. i
+end
+local joined = table.concat(parts, ";")
+
+return #s + #joined
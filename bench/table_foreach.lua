@@ -0,0 +1,14 @@
+-- table.foreachi over the array part, table.foreach over both parts
+local N = N or 2000
+
+local t = {}
+for i = 1, N do t[i] = i end
+local sum = 0
+table.foreachi(t, function(i, v) sum = sum + i * v end)
+
+for i = 1, N do t["k" .. i] = i end
+local total = 0
+table.foreach(t, function(k, v) total = total + v end)
+
+local found = table.foreachi(t, function(i, v) if v == N / 2 then return i end end)
+return sum, total, found
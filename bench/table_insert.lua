@@ -0,0 +1,11 @@
+-- table.insert at the end, the front and the middle
+local N = N or 2000
+
+local t = {}
+for i = 1, N do table.insert(t, i) end
+for i = 1, N / 10 do table.insert(t, 1, -i) end
+for i = 1, N / 10 do table.insert(t, (#t - #t % 2) / 2 + 1, i * 3) end
+
+local sum = 0
+for i = 1, #t do sum = sum + t[i] * (i % 7) end
+return #t, sum
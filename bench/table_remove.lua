@@ -0,0 +1,14 @@
+-- table.remove as a stack and as a queue
+local N = N or 2000
+
+local stack = {}
+for i = 1, N do stack[#stack + 1] = i end
+local sum = 0
+while #stack > 0 do sum = sum + table.remove(stack) end
+
+local queue = {}
+for i = 1, N do table.insert(queue, i) end
+local order = 0
+for i = 1, N do order = order + table.remove(queue, 1) * (i % 7) end
+
+return sum, order, #queue
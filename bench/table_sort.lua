@@ -0,0 +1,27 @@
+-- table.sort with and without a lua comparator
+local N = N or 2000
+
+local seed = 42
+local function rand()
+	seed = (seed * 16807) % 2147483647
+	return seed
+end
+
+local numbers = {}
+for i = 1, N do numbers[i] = rand() % 100000 end
+table.sort(numbers)
+
+local records = {}
+for i = 1, N do records[i] = { key = rand() % 1000, id = i } end
+table.sort(records, function(a, b)
+	if a.key ~= b.key then return a.key < b.key end
+	return a.id < b.id
+end)
+
+for i = 2, N do
+	if numbers[i - 1] > numbers[i] then error("numbers not sorted") end
+	local a, b = records[i - 1], records[i]
+	if a.key > b.key or (a.key == b.key and a.id > b.id) then error("records not sorted") end
+end
+
+return numbers[1] + numbers[N] + records[1].id + records[N].id
@@ -0,0 +1,13 @@
+-- unpack and table.getn
+local N = N or 2000
+
+local t = {}
+for i = 1, 8 do t[i] = i end
+local function add(a, b, c, d, e, f, g, h) return a + b + c + d + e + f + g + h end
+local sum = 0
+for i = 1, N do sum = sum + add(unpack(t)) + table.getn(t) end
+
+local big = {}
+for i = 1, N do big[i] = i end
+local first, second = unpack(big, N - 1)
+return sum, first + second, table.getn(big)
@@ -0,0 +1,107 @@
+"""
+Multi-threaded stress benchmark for the VM.
+
+Runs the benchmarks of run.py on N threads at once, every thread with its
+own env but all of them sharing the parsed chunks and the standard library,
+like a threaded server embedding the VM would. Every result is checked, so
+state leaking between threads shows up as a failure. The throughput is
+compared with running the same work on one thread; it only scales on
+free-threaded builds of python.
+
+	python bench/threads.py                    # all benchmarks, 1 and 8 threads
+	python bench/threads.py fib nbody -t 1 -t 4 -t 16 --rounds 5
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+from run import BENCHMARKS, check_results, compile_benchmark
+
+from luaenv import LuaEnv
+from luafile import LuaFile
+from luatypes import *
+from lvm import call_lua_function
+
+
+def run_thread(files: dict[str, LuaFile], names: list[str], rounds: int, start: threading.Barrier, errors: list):
+	base = LuaEnv.get_base()
+	start.wait()
+	for _ in range(rounds):
+		for name in names:
+			n, expected = BENCHMARKS[name]
+			try:
+				env = LuaEnv(base)
+				env.set(LuaString("N"), LuaNumber(n))
+				res = call_lua_function(files[name].main_func, env, [])
+				check_results([make_py_type(r) for r in res], expected)
+			except Exception as err:
+				errors.append(f"{name}: {type(err).__name__}: {err}")
+
+
+def stress(files: dict[str, LuaFile], num_threads: int, rounds: int) -> tuple[float, int, list[str]]:
+	"""Runs every benchmark rounds times on each of num_threads threads, each starting at a different one."""
+	names = list(files)
+	start = threading.Barrier(num_threads + 1)
+	errors = []
+	threads = []
+	for i in range(num_threads):
+		# threads start at different benchmarks, so different code runs at the same time
+		k = i % len(names)
+		thread = threading.Thread(target=run_thread, args=(files, names[k:] + names[:k], rounds, start, errors))
+		thread.start()
+		threads.append(thread)
+
+	start.wait()
+	begin = time.perf_counter()
+	for thread in threads:
+		thread.join()
+	return time.perf_counter() - begin, num_threads * rounds * len(names), errors
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Run the VM benchmarks on many threads at once.")
+	parser.add_argument("benchmarks", nargs="*", help="benchmarks to run (default: all)")
+	parser.add_argument("-t", "--threads", type=int, action="append", help="numbers of threads to run (default: 1 and 8)")
+	parser.add_argument("--rounds", type=int, default=3, help="times each thread runs every benchmark")
+	args = parser.parse_args()
+
+	names = args.benchmarks or list(BENCHMARKS)
+	for name in names:
+		if name not in BENCHMARKS:
+			parser.error(f"unknown benchmark '{name}'")
+
+	files = {}
+	for name in names:
+		bytecode = compile_benchmark(name)
+		if bytecode is None:
+			print(f"{name}: no chunk (luac5.1 not found)")
+			continue
+		files[name] = LuaFile(name, bytecode)
+	if not files:
+		sys.exit(1)
+
+	gil = sys._is_gil_enabled() if hasattr(sys, "_is_gil_enabled") else True
+	print(f"python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}, {os.cpu_count()} cpus")
+	print(f"{'threads':>7} {'runs':>6} {'time':>8} {'runs/s':>8} {'speedup':>8}")
+
+	# the speedup is relative to the first number of threads
+	failed = False
+	first = None
+	for num_threads in args.threads or [1, 8]:
+		elapsed, runs, errors = stress(files, num_threads, args.rounds)
+		throughput = runs / elapsed
+		first = first or throughput
+		print(f"{num_threads:7} {runs:6} {elapsed:7.2f}s {throughput:8.2f} {throughput / first:7.2f}x")
+		for error in errors[:10]:
+			print("  " + error)
+		failed = failed or bool(errors)
+
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,6 +1,161 @@
 from luatypes import *
 
 
+def pass_env(func):
+	"""Marks a library function that needs the calling env as its first argument."""
+	func.lua_pass_env = True
+	return func
+
+
+def signature(funcname: str, *params: str):
+	"""
+	Declares the lua parameters of a library function.
+
+	Params are lua type names, "any" for any value, with a trailing "?" if
+	they are optional. The function is called with python values for
+	"number" and "string" params (converting between the two like Lua does),
+	lua values for the others and None for missing optional ones:
+
+		@signature("sub", "string", "number", "number?")
+		def sub(s: str, i: float, j: float | None): ...
+
+	With `pass_env` the env is passed before them. The checks are built once
+	here, and LuaPyFunction uses the entry points from `LuaSignature.bind`
+	instead of going through `*args`.
+	"""
+	def decorate(func):
+		func.lua_signature = LuaSignature(funcname, params)
+		return func
+	return decorate
+
+
+def arg_converter(funcname: str, idx: int, param: str):
+	"""Function checking and unwrapping one argument, None if it's missing."""
+	optional = param.endswith("?")
+	kind = param.rstrip("?")
+
+	def bad_arg(val):
+		if kind == "any":
+			raise LuaError(f"bad argument #{idx} to '{funcname}' (value expected)")
+		got = "no value" if val is None else val.name
+		raise LuaError(f"bad argument #{idx} to '{funcname}' ({kind} expected, got {got})")
+
+	match kind:
+		case "number":
+			def convert(val):
+				if type(val) is LuaNumber:
+					return val.value
+				if isinstance(val, LuaString):
+					num = val.tonumber()
+					if type(num) is LuaNumber:
+						return num.value
+				if optional and (val is None or type(val) is LuaNil):
+					return None
+				bad_arg(val)
+		case "string":
+			def convert(val):
+				if isinstance(val, LuaString):
+					return val.value
+				if type(val) is LuaNumber:
+					return val.tostring().value
+				if optional and (val is None or type(val) is LuaNil):
+					return None
+				bad_arg(val)
+		case "any":
+			def convert(val):
+				if val is None and not optional:
+					bad_arg(val)
+				return val
+		case _:
+			def convert(val):
+				if val is not None and val.name == kind:
+					return val
+				if optional and (val is None or type(val) is LuaNil):
+					return None
+				bad_arg(val)
+	return convert
+
+
+def store_results(registers: list, base: int, nresults: int, res):
+	if type(res) is not tuple:
+		registers[base] = wrap_result(res)
+		for i in range(base + 1, base + nresults):
+			registers[i] = LuaNil()
+		return
+	for i in range(nresults):
+		registers[base + i] = wrap_result(res[i]) if i < len(res) else LuaNil()
+
+
+class LuaSignature:
+	def __init__(self, funcname: str, params: tuple[str]):
+		self.funcname = funcname
+		self.params = params
+		self.converters = tuple(arg_converter(funcname, i + 1, p) for i, p in enumerate(params))
+
+	def bind(self, func: callable):
+		"""
+		The entry points for calling func: `call(env, args)` taking a list of
+		lua values, and `call_into(env, registers, base, nargs, nresults)`
+		reading its arguments from the registers after base and storing its
+		results from base on, for calls with a fixed number of both.
+		"""
+		converters = self.converters
+		pass_env = getattr(func, "lua_pass_env", False)
+
+		def call(env, args: list):
+			nargs = len(args)
+			values = [convert(args[i] if i < nargs else None) for i, convert in enumerate(converters)]
+			res = func(env, *values) if pass_env else func(*values)
+			if type(res) is tuple:
+				return tuple(map(wrap_result, res))
+			return (wrap_result(res),)
+
+		# unrolled for the common arities
+		match converters:
+			case ():
+				def call_into(env, registers: list, base: int, nargs: int, nresults: int):
+					res = func(env) if pass_env else func()
+					if nresults == 1 and type(res) is not tuple:
+						registers[base] = wrap_result(res)
+					else:
+						store_results(registers, base, nresults, res)
+			case (conv1,):
+				def call_into(env, registers: list, base: int, nargs: int, nresults: int):
+					arg1 = conv1(registers[base + 1] if nargs > 0 else None)
+					res = func(env, arg1) if pass_env else func(arg1)
+					if nresults == 1 and type(res) is not tuple:
+						registers[base] = wrap_result(res)
+					else:
+						store_results(registers, base, nresults, res)
+			case (conv1, conv2):
+				def call_into(env, registers: list, base: int, nargs: int, nresults: int):
+					arg1 = conv1(registers[base + 1] if nargs > 0 else None)
+					arg2 = conv2(registers[base + 2] if nargs > 1 else None)
+					res = func(env, arg1, arg2) if pass_env else func(arg1, arg2)
+					if nresults == 1 and type(res) is not tuple:
+						registers[base] = wrap_result(res)
+					else:
+						store_results(registers, base, nresults, res)
+			case (conv1, conv2, conv3):
+				def call_into(env, registers: list, base: int, nargs: int, nresults: int):
+					arg1 = conv1(registers[base + 1] if nargs > 0 else None)
+					arg2 = conv2(registers[base + 2] if nargs > 1 else None)
+					arg3 = conv3(registers[base + 3] if nargs > 2 else None)
+					res = func(env, arg1, arg2, arg3) if pass_env else func(arg1, arg2, arg3)
+					if nresults == 1 and type(res) is not tuple:
+						registers[base] = wrap_result(res)
+					else:
+						store_results(registers, base, nresults, res)
+			case _:
+				def call_into(env, registers: list, base: int, nargs: int, nresults: int):
+					args = registers[base + 1:base + 1 + nargs]
+					values = [convert(args[i] if i < nargs else None) for i, convert in enumerate(converters)]
+					res = func(env, *values) if pass_env else func(*values)
+					store_results(registers, base, nresults, res)
+
+		return call, call_into
+
+
 def optional_arg(funcname, args, idx, *kinds):
 	if idx - 1 >= len(args) or isinstance(args[idx - 1], LuaNil): return
 
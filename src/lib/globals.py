@@ -1,12 +1,15 @@
 from lib.common import *
+from lib.table import tab_unpack
+from luamemo import DEFAULT_MAXSIZE, memoize
 from luatypes import *
 
 import subprocess
 import os.path
 
 
-def lua_print(*args):
-	print(*[a.tostring().value for a in args], sep="\t")
+@pass_env
+def lua_print(env, *args):
+	env.output.write("\t".join([a.tostring().value for a in args]) + "\n")
 
 def lua_error(*args):
 	optional_arg("error", args, 1)
@@ -27,37 +30,137 @@ def lua_assert(*args):
 		else:
 			raise LuaError("assertion failed!")
 
-def lua_type(*args):
-	required_arg("type", args, 1)
-	return args[0].name
-
-def lua_tostring(*args):
-	required_arg("tostring", args, 1)
-	return args[0].tostring()
-
-def lua_tonumber(*args):
-	required_arg("tonumber", args, 1)
-	return args[0].tonumber()
-
-def lua_next(*args):
-	required_arg("next", args, 1, "table")
-	required_arg("next", args, 2, "nil", "string", "number")
-	if isinstance(args[1], LuaNil):
-		idx = 1
-	else:
-		idx = args[0].keys().index(args[1]) + 2
-	items = args[0].items()
-	return items[idx - 1] if idx <= len(items) else (None, None)
+@signature("type", "any")
+def lua_type(val):
+	return val.name
+
+@signature("tostring", "any")
+def lua_tostring(val):
+	return val.tostring()
+
+@signature("tonumber", "any", "number?")
+def lua_tonumber(val, base):
+	if base is None or base == 10:
+		return val.tonumber()
+	if not 2 <= base <= 36:
+		raise LuaError("bad argument #2 to 'tonumber' (base out of range)")
+	if not isinstance(val, LuaString):
+		return LuaNil()
+	try:
+		return int(val.value.strip(), int(base))
+	except ValueError:
+		return LuaNil()
+
+@signature("setmetatable", "table", "any")
+def lua_setmetatable(t, mt):
+	if type(mt) is LuaNil:
+		mt = None
+	elif not isinstance(mt, LuaTable):
+		raise LuaError("bad argument #2 to 'setmetatable' (nil or table expected)")
+	if t.metatable is not None and t.metatable.metamethod("__metatable") is not None:
+		raise LuaError("cannot change a protected metatable")
+	t.set_metatable(mt)
+
+	mode = mt.metamethod("__mode") if mt is not None else None
+	weak_keys = isinstance(mode, LuaString) and "k" in mode.value
+	weak_values = isinstance(mode, LuaString) and "v" in mode.value
+	if type(t) is LuaWeakTable:
+		if (weak_keys, weak_values) != (t.weak_keys, t.weak_values):
+			t.set_mode(weak_keys, weak_values)
+	elif weak_keys or weak_values:
+		t.set_mode(weak_keys, weak_values)
+	return t
+
+@signature("getmetatable", "any")
+def lua_getmetatable(val):
+	mt = val.metatable
+	if mt is None:
+		return None
+	protected = mt.metamethod("__metatable")
+	return mt if protected is None else protected
+
+@signature("rawget", "table", "any")
+def lua_rawget(t, key):
+	return t.rawget(key)
+
+@signature("rawset", "table", "any", "any")
+def lua_rawset(t, key, val):
+	t.rawset(key, val)
+	return t
+
+@signature("rawequal", "any", "any")
+def lua_rawequal(a, b):
+	if isinstance(a, LuaTable) or isinstance(b, LuaTable):
+		return a is b
+	return a == b
+
+@pass_env
+@signature("collectgarbage", "string?", "number?")
+def lua_collectgarbage(env, opt, arg):
+	memory = env.memory
+	match "collect" if opt is None else opt:
+		case "collect":
+			memory.collect()
+			return 0
+		case "count":
+			return memory.count()
+		case "step":
+			return memory.step()
+		case "stop":
+			memory.stopped = True
+			return 0
+		case "restart":
+			memory.stopped = False
+			return 0
+		case "setpause":
+			prev, memory.pause = memory.pause, int(arg or 0)
+			return prev
+		case "setstepmul":
+			prev, memory.stepmul = memory.stepmul, int(arg or 0)
+			return prev
+		case _:
+			raise LuaError(f"bad argument #1 to 'collectgarbage' (invalid option '{opt}')")
+
+@signature("memoize", "function", "number?")
+def lua_memoize(f, maxsize):
+	if type(f) is not LuaFunction:
+		raise LuaError("bad argument #1 to 'memoize' (lua function expected)")
+	# a size of 0 or less means no limit
+	return memoize(f, None if maxsize is not None and maxsize <= 0 else int(maxsize or DEFAULT_MAXSIZE))
+
+@signature("memostats", "function")
+def lua_memostats(f):
+	memo = getattr(f, "memo", None)
+	return None if memo is None else memo.stats()
+
+@signature("next", "table", "any?")
+def lua_next(t, key):
+	entry = t.next(LuaNil() if key is None else key)
+	return (None, None) if entry is None else entry
 
 def lua_pairs(*args):
 	required_arg("pairs", args, 1, "table")
 	return lua_next, args[0], None
 
+def lua_ipairs_next(*args):
+	i = int(args[1].value) + 1
+	val = args[0].get_from(LuaNumber(i))
+	if isinstance(val, LuaNil):
+		return None
+	return i, val
+
 def lua_ipairs(*args):
 	required_arg("ipairs", args, 1, "table")
-	return # TODO
+	return lua_ipairs_next, args[0], 0
+
+def run_chunk(env, name: str, bytecode: bytes):
+	from luafile import LuaFile
+	# in the caller's env, so the chunk shares its globals and errors reach the caller
+	luafile = LuaFile(name, bytecode, env)
+	return luafile.main_func.call(env, [])
 
-def lua_dofile(*args):
+@pass_env
+def lua_dofile(env, *args):
 	required_arg("dofile", args, 1, "string")
 	filename = args[0].value
 	if not os.path.exists(filename):
@@ -65,28 +168,26 @@ def lua_dofile(*args):
 
 	proc = subprocess.Popen(args=["luac5.1", "-o", "/dev/stdout", filename], stdout=subprocess.PIPE)
 	bytecode = proc.stdout.read()
-	from luafile import LuaFile
-	luafile = LuaFile(filename, bytecode)
-	return luafile.execute()
+	return run_chunk(env, filename, bytecode)
 
-def lua_dostring(*args):
+@pass_env
+def lua_dostring(env, *args):
 	required_arg("dostring", args, 1, "string")
 	proc = subprocess.Popen(args=["luac5.1", "-o", "/dev/stdout", "-"], stdout=subprocess.PIPE, stdin=subprocess.PIPE)
 	bytecode = proc.communicate(input=args[0].value.encode())[0]
-	from luafile import LuaFile
-	luafile = LuaFile(":string", bytecode)
-	return luafile.execute()
+	return run_chunk(env, ":string", bytecode)
 
-def lua_require(*args):
+@pass_env
+def lua_require(env, *args):
 	# TODO don't reload already loaded files
-	required_arg("dofile", args, 1, "string")
-	if not os.path.exists(args[0]):
-		raise LuaError(f"cannot open {args[0]}: No such file or directory")
+	required_arg("require", args, 1, "string")
+	filename = args[0].value
+	if not os.path.exists(filename):
+		raise LuaError(f"cannot open {filename}: No such file or directory")
 
-	proc = subprocess.Popen(args=["luac5.1", "-o", "/dev/stdout", args[0]], stdout=subprocess.PIPE)
+	proc = subprocess.Popen(args=["luac5.1", "-o", "/dev/stdout", filename], stdout=subprocess.PIPE)
 	bytecode = proc.stdout.read()
-	luafile = LuaFile(args[0], bytecode)
-	return luafile.execute()
+	return run_chunk(env, filename, bytecode)
 
 def lua_setglobal(*args):
 	pass
@@ -104,6 +205,15 @@ lua_globals = {
 	"next": lua_next,
 	"pairs": lua_pairs,
 	"ipairs": lua_ipairs,
+	"setmetatable": lua_setmetatable,
+	"getmetatable": lua_getmetatable,
+	"rawget": lua_rawget,
+	"rawset": lua_rawset,
+	"rawequal": lua_rawequal,
+	"collectgarbage": lua_collectgarbage,
+	"memoize": lua_memoize,
+	"memostats": lua_memostats,
+	"unpack": tab_unpack,
 	"dofile": lua_dofile,
 	"dostring": lua_dostring,
 	"require": lua_require,
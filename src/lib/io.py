@@ -1 +1,375 @@
 from lib.common import *
+from luatypes import *
+
+import mmap
+import os
+import sys
+
+
+# files are read and written through buffers this large
+BUFFER_SIZE = 1 << 20
+# files at least this large are memory-mapped by file:lines() instead of read
+MMAP_THRESHOLD = 1 << 26
+
+# lua strings are bytes, anything not valid utf-8 survives a read and write unchanged
+ENCODING = "utf-8"
+ERRORS = "surrogateescape"
+
+MODES = {"r", "w", "a", "r+", "w+", "a+"}
+WHENCE = {"set": os.SEEK_SET, "cur": os.SEEK_CUR, "end": os.SEEK_END}
+NUMBER_CHARS = b"0123456789+-.xXaAbBcCdDeEfFpP"
+
+
+def decode(b: bytes) -> str:
+	return b.decode(ENCODING, ERRORS)
+
+def encode(s: str) -> bytes:
+	return s.encode(ENCODING, ERRORS)
+
+
+class LuaFileHandle(LuaObject):
+	"""
+	A file opened by the io library, `FILE*` in Lua.
+
+	The python file is opened in binary mode with a large buffer. Lines of
+	big read-only files are streamed from a memory map instead: the map is
+	made on the first file:lines() and dropped as soon as anything else
+	touches the file, which continues at the position the lines got to.
+	"""
+
+	name = "userdata"
+
+	def __init__(self, file, path: str, mode: str):
+		self.file = file
+		self.path = path
+		self.mode = mode
+		self.closed = False
+		self.mapping = None
+		# position of the next line in the mapping, None when the file position is current
+		self.mapped_pos = None
+
+	def get_from(self, key):
+		if isinstance(key, LuaString):
+			return FILE_METHODS.get(key.value, LuaNil())
+		return LuaNil()
+
+	def check(self):
+		if self.closed:
+			raise LuaError("attempt to use a closed file")
+		self.sync()
+
+	def sync(self):
+		if self.mapped_pos is not None:
+			self.file.seek(self.mapped_pos)
+			self.mapped_pos = None
+
+	def can_map(self) -> bool:
+		if self.mode != "r":
+			return False
+		try:
+			return os.fstat(self.file.fileno()).st_size >= MMAP_THRESHOLD
+		except (OSError, ValueError):
+			return False
+
+	def map(self) -> mmap.mmap:
+		if self.mapping is None:
+			self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			if hasattr(mmap, "MADV_SEQUENTIAL"):
+				self.mapping.madvise(mmap.MADV_SEQUENTIAL)
+		return self.mapping
+
+	def close(self):
+		if self.mapping is not None:
+			self.mapping.close()
+			self.mapping = None
+		self.mapped_pos = None
+		self.file.close()
+		self.closed = True
+
+	def tostring(self):
+		if self.closed:
+			return LuaString("file (closed)")
+		return LuaString(f"file (0x{id(self):x})")
+
+	def __str__(self): return self.tostring().value
+	def __repr__(self): return f"LuaFileHandle({self.path!r})"
+
+
+class LuaStdFile(LuaFileHandle):
+	"""
+	io.stdin, io.stdout and io.stderr, looked up in sys on every use so they
+	follow redirections. Writes to io.stdout go to the output of the env
+	instead, see LuaOutput.
+	"""
+
+	def __init__(self, stream: str, mode: str):
+		self.stream = stream
+		self.path = "<" + stream + ">"
+		self.mode = mode
+		self.closed = False
+		self.mapping = None
+		self.mapped_pos = None
+
+	@property
+	def file(self):
+		stream = getattr(sys, self.stream)
+		return getattr(stream, "buffer", stream)
+
+	def can_map(self) -> bool:
+		return False
+
+	def close(self):
+		raise LuaError("cannot close standard file")
+
+
+stdin = LuaStdFile("stdin", "r")
+stdout = LuaStdFile("stdout", "w")
+stderr = LuaStdFile("stderr", "w")
+
+
+def to_file(funcname: str, val) -> LuaFileHandle:
+	if not isinstance(val, LuaFileHandle):
+		got = "no value" if val is None else val.name
+		raise LuaError(f"bad argument #1 to '{funcname}' (FILE* expected, got {got})")
+	val.check()
+	return val
+
+def io_error(err: OSError, path: str | None = None):
+	msg = err.strerror or str(err)
+	if path is not None:
+		msg = f"{path}: {msg}"
+	return None, msg, err.errno or 0
+
+
+def read_line(f) -> str | None:
+	line = f.readline()
+	if not line:
+		return None
+	return decode(line[:-1] if line.endswith(b"\n") else line)
+
+def read_number(f) -> float | None:
+	# like fscanf("%lf"), skip whitespace and take the longest run that can be part of a number
+	while True:
+		c = f.peek(1)[:1]
+		if not c or not c.isspace():
+			break
+		f.read(1)
+	chars = bytearray()
+	while True:
+		c = f.peek(1)[:1]
+		if not c or c not in NUMBER_CHARS:
+			break
+		chars += f.read(1)
+	num = LuaString(decode(bytes(chars))).tonumber()
+	return num if type(num) is LuaNumber else None
+
+def read_format(f, fmt) -> str | float | None:
+	if type(fmt) is LuaNumber:
+		n = int(fmt.value)
+		if n == 0:
+			# only tests for the end of the file
+			return "" if f.peek(1) else None
+		chunk = f.read(n)
+		return decode(chunk) if chunk else None
+	if not isinstance(fmt, LuaString) or not fmt.value.startswith("*") or len(fmt.value) < 2:
+		raise LuaError("bad argument #1 to 'read' (invalid format)")
+	match fmt.value[1]:
+		case "l": return read_line(f)
+		case "a": return decode(f.read())
+		case "n": return read_number(f)
+		case _: raise LuaError("bad argument #1 to 'read' (invalid option)")
+
+def read_formats(env, handle: LuaFileHandle, formats) -> tuple:
+	if handle is stdin:
+		# whatever the script printed before waiting for input has to be visible
+		env.output.flush()
+	f = handle.file
+	if not formats:
+		return read_line(f)
+	res = []
+	for fmt in formats:
+		val = read_format(f, fmt)
+		res.append(val)
+		# like Lua, stop at the first format that fails
+		if val is None:
+			break
+	return tuple(res)
+
+def write_values(env, handle: LuaFileHandle, values):
+	# stdout goes through the env's output buffer like print
+	write = env.output.write if handle is stdout else lambda s: handle.file.write(encode(s))
+	for i, val in enumerate(values):
+		if not isinstance(val, (LuaString, LuaNumber)):
+			raise LuaError(f"bad argument #{i + 1} to 'write' (string expected, got {val.name})")
+		write(val.tostring().value)
+	return handle
+
+
+def buffered_lines(handle: LuaFileHandle, close: bool):
+	f = handle.file
+
+	def next_line(*_):
+		if handle.closed:
+			raise LuaError("file is already closed")
+		handle.sync()
+		line = read_line(f)
+		if line is None and close:
+			handle.close()
+		return line
+
+	return next_line
+
+def mapped_lines(handle: LuaFileHandle, close: bool):
+	mm = handle.map()
+	size = len(mm)
+
+	def next_line(*_):
+		if handle.closed:
+			raise LuaError("file is already closed")
+		pos = handle.mapped_pos
+		if pos is None:
+			pos = handle.file.tell()
+		if pos >= size:
+			handle.mapped_pos = pos
+			if close:
+				handle.close()
+			return None
+		end = mm.find(b"\n", pos)
+		if end == -1:
+			end = size
+		handle.mapped_pos = end + 1 if end < size else size
+		return decode(mm[pos:end])
+
+	return next_line
+
+def lines_of(handle: LuaFileHandle, close: bool = False):
+	if handle.can_map():
+		return mapped_lines(handle, close)
+	return buffered_lines(handle, close)
+
+
+@pass_env
+def file_read(env, *args):
+	handle = to_file("read", args[0] if args else None)
+	return read_formats(env, handle, args[1:])
+
+def file_lines(*args):
+	handle = to_file("lines", args[0] if args else None)
+	return lines_of(handle)
+
+@pass_env
+def file_write(env, *args):
+	handle = to_file("write", args[0] if args else None)
+	return write_values(env, handle, args[1:])
+
+def file_seek(*args):
+	handle = to_file("seek", args[0] if args else None)
+	optional_arg("seek", args, 2, "string")
+	optional_arg("seek", args, 3, "number")
+	whence = args[1].value if len(args) > 1 and not isinstance(args[1], LuaNil) else "cur"
+	offset = int(args[2].value) if len(args) > 2 and not isinstance(args[2], LuaNil) else 0
+	if whence not in WHENCE:
+		raise LuaError(f"bad argument #1 to 'seek' (invalid option '{whence}')")
+	try:
+		return handle.file.seek(offset, WHENCE[whence])
+	except OSError as err:
+		return io_error(err)
+
+@pass_env
+def file_flush(env, *args):
+	handle = to_file("flush", args[0] if args else None)
+	if handle is stdout:
+		env.output.flush()
+	else:
+		handle.file.flush()
+	return True
+
+def file_close(*args):
+	handle = to_file("close", args[0] if args else None)
+	try:
+		handle.close()
+	except LuaError as err:
+		return None, err.msg
+	return True
+
+def file_setvbuf(*args):
+	# the buffer size is fixed when the file is opened
+	to_file("setvbuf", args[0] if args else None)
+	required_arg("setvbuf", args, 2, "string")
+	return True
+
+
+FILE_METHODS = {
+	name: LuaPyFunction(func) for name, func in {
+		"close": file_close,
+		"flush": file_flush,
+		"lines": file_lines,
+		"read": file_read,
+		"seek": file_seek,
+		"setvbuf": file_setvbuf,
+		"write": file_write,
+	}.items()
+}
+
+
+def open_file(path: str, mode: str) -> LuaFileHandle:
+	f = open(path, mode.replace("b", "") + "b", buffering=BUFFER_SIZE)
+	return LuaFileHandle(f, path, mode.replace("b", ""))
+
+@signature("open", "string", "string?")
+def io_open(path, mode):
+	mode = "r" if mode is None else mode
+	if mode.replace("b", "") not in MODES:
+		raise LuaError("bad argument #2 to 'open' (invalid mode)")
+	try:
+		return open_file(path, mode)
+	except OSError as err:
+		return io_error(err, path)
+
+@pass_env
+def io_lines(env, *args):
+	optional_arg("lines", args, 1, "string")
+	if not args or isinstance(args[0], LuaNil):
+		env.output.flush()
+		return lines_of(to_file("lines", stdin))
+	path = args[0].value
+	try:
+		handle = open_file(path, "r")
+	except OSError as err:
+		raise LuaError(io_error(err, path)[1])
+	return lines_of(handle, close=True)
+
+@pass_env
+def io_read(env, *args):
+	return read_formats(env, to_file("read", stdin), args)
+
+@pass_env
+def io_write(env, *args):
+	return write_values(env, to_file("write", stdout), args)
+
+def io_close(*args):
+	return file_close(args[0] if args else stdout)
+
+@pass_env
+def io_flush(env, *args):
+	return file_flush(env, stdout)
+
+@signature("type", "any")
+def io_type(val):
+	if not isinstance(val, LuaFileHandle):
+		return None
+	return "closed file" if val.closed else "file"
+
+
+lua_iolib = {
+	"close": io_close,
+	"flush": io_flush,
+	"lines": io_lines,
+	"open": io_open,
+	"read": io_read,
+	"stderr": stderr,
+	"stdin": stdin,
+	"stdout": stdout,
+	"type": io_type,
+	"write": io_write,
+}
@@ -0,0 +1,250 @@
+from lib.common import *
+from lib.io import BUFFER_SIZE, ENCODING, ERRORS, LuaFileHandle, open_file, stdout, to_file
+from luatypes import *
+
+import codecs
+import json
+import math
+
+
+class LuaJSONNull(LuaObject):
+	"""json.null, which stands for null where nil can't, like in arrays."""
+
+	name = "userdata"
+
+	def tostring(self): return LuaString("null")
+	def __repr__(self): return "LuaJSONNull"
+
+
+null = LuaJSONNull()
+# metatable marking a table to be encoded as an array, which decode sets on empty arrays
+array_mt = LuaTable(0, 0).freeze()
+
+
+def to_lua(val) -> LuaObject:
+	wrap = LUA_WRAPPERS.get(type(val))
+	if wrap is not None:
+		return wrap(val)
+	if val is None:
+		return null
+	if type(val) is list:
+		return make_array(val)
+	# objects are converted by make_object while parsing
+	return val
+
+def make_array(items: list) -> LuaTable:
+	t = LuaTable(0, 0)
+	# null is a value, so the array part never has holes
+	t.arr = [to_lua(v) for v in items]
+	if not t.arr:
+		t.metatable = array_mt
+	return t
+
+def make_object(pairs: list) -> LuaTable:
+	t = LuaTable(0, 0)
+	t.hash = {LuaString(k): to_lua(v) for k, v in pairs}
+	return t
+
+decoder = json.JSONDecoder(object_pairs_hook=make_object)
+
+
+def decode_error(err: json.JSONDecodeError):
+	return LuaError(f"invalid json: {err.msg} at line {err.lineno} column {err.colno}")
+
+def json_number(val: float) -> int | float:
+	if math.isinf(val) or math.isnan(val):
+		raise LuaError("cannot encode a number that is inf or nan")
+	# integral numbers are written without a fraction
+	return int(val) if val.is_integer() else val
+
+def json_key(key: LuaObject) -> str:
+	match key:
+		case LuaString():
+			return key.value
+		case LuaNumber():
+			return key.tostring().value
+	raise LuaError(f"cannot encode a table with a {key.name} key")
+
+def is_array(t: LuaTable, items: list) -> bool:
+	if t.metatable is array_mt:
+		return True
+	return bool(items) and all(type(k) is LuaNumber for k, _ in items) and sorted(k.value for k, _ in items) == list(range(1, len(items) + 1))
+
+def to_json(val: LuaObject, visiting: set):
+	"""The python value json.dumps writes for val, walking the parts of tables directly."""
+	match val:
+		case LuaString() | LuaBoolean():
+			return val.value
+		case LuaNumber():
+			return json_number(val.value)
+		case LuaNil() | LuaJSONNull():
+			return None
+		case LuaProxyTable():
+			# still the host's own data
+			return val.source
+		case LuaTable():
+			if id(val) in visiting:
+				raise LuaError("cannot encode a table that contains itself")
+			visiting.add(id(val))
+			try:
+				return table_to_json(val, visiting)
+			finally:
+				visiting.discard(id(val))
+	raise LuaError(f"cannot encode a {val.name} value")
+
+def table_to_json(t: LuaTable, visiting: set):
+	if type(t) is LuaNumberArray and not t.hash:
+		return [json_number(v) for v in t.arr]
+	if type(t) in (LuaTable, LuaMetatable, LuaNumberArray):
+		if not t.hash:
+			if not t.arr and t.metatable is not array_mt:
+				# an empty table is an object, unless it's marked as an array
+				return {}
+			return [to_json(v, visiting) for v in t.arr]
+		if not t.arr:
+			return {json_key(k): to_json(v, visiting) for k, v in t.hash.items()}
+
+	# mixed or special tables go through their items
+	items = t.items()
+	if is_array(t, items):
+		return [to_json(v, visiting) for _, v in sorted(items, key=lambda kv: kv[0].value)]
+	return {json_key(k): to_json(v, visiting) for k, v in items}
+
+
+@signature("encode", "any", "number?")
+def json_encode(val, indent):
+	data = to_json(val, set())
+	try:
+		if indent is None:
+			return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+		return json.dumps(data, ensure_ascii=False, indent=int(indent))
+	except (TypeError, ValueError) as err:
+		# only host data in proxy tables can get here
+		raise LuaError(f"cannot encode: {err}")
+
+@signature("decode", "string")
+def json_decode(s):
+	try:
+		return to_lua(decoder.decode(s))
+	except json.JSONDecodeError as err:
+		raise decode_error(err)
+
+
+def stream_file(funcname: str, f, mode: str) -> LuaFileHandle:
+	if isinstance(f, LuaString):
+		try:
+			return open_file(f.value, mode)
+		except OSError as err:
+			raise LuaError(f"{f.value}: {err.strerror}")
+	return to_file(funcname, f)
+
+def decode_stream(handle: LuaFileHandle):
+	"""
+	Yields the json values in a file one after the other (newline delimited
+	or just concatenated), reading it in chunks and converting one value at
+	a time, so only the current value has to fit in memory.
+	"""
+	utf8 = codecs.getincrementaldecoder(ENCODING)(ERRORS)
+	buf, pos, eof = "", 0, False
+	chunk_size = BUFFER_SIZE
+	while True:
+		while pos < len(buf) and buf[pos].isspace():
+			pos += 1
+		if pos < len(buf):
+			try:
+				val, end = decoder.raw_decode(buf, pos)
+			except json.JSONDecodeError as err:
+				if eof:
+					raise decode_error(err)
+			else:
+				# a number at the end of the buffer may continue in the next chunk
+				if end < len(buf) or eof:
+					yield to_lua(val)
+					pos = end
+					continue
+		elif eof:
+			return
+
+		chunk = handle.file.read(chunk_size)
+		eof = not chunk
+		buf = buf[pos:] + utf8.decode(chunk, final=eof)
+		pos = 0
+		# a value spanning many chunks would be parsed again for each one otherwise
+		chunk_size *= 2 if len(buf) > chunk_size else 1
+
+@pass_env
+def json_decode_stream(env, *args):
+	required_arg("decode_stream", args, 1, "string", "userdata")
+	handle = stream_file("decode_stream", args[0], "r")
+	values = decode_stream(handle)
+
+	def next_value(*_):
+		val = next(values, None)
+		if val is None and isinstance(args[0], LuaString):
+			handle.close()
+		return val
+
+	return next_value
+
+@pass_env
+def json_encode_stream(env, *args):
+	"""
+	Writes a value to a file as json. The elements of a top level array or
+	object are converted and written one at a time, so the whole document
+	never exists as one string.
+	"""
+	required_arg("encode_stream", args, 1, "string", "userdata")
+	required_arg("encode_stream", args, 2)
+	handle = stream_file("encode_stream", args[0], "w")
+	val = args[1]
+
+	pending = []
+	pending_size = 0
+	def write(s: str):
+		nonlocal pending_size
+		pending.append(s)
+		pending_size += len(s)
+		if pending_size >= BUFFER_SIZE:
+			flush()
+	def flush():
+		nonlocal pending_size
+		text = "".join(pending)
+		pending.clear()
+		pending_size = 0
+		if handle is stdout:
+			env.output.write(text)
+		else:
+			handle.file.write(text.encode(ENCODING, ERRORS))
+
+	dumps = lambda data: json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+	visiting = {id(val)}
+	if type(val) in (LuaTable, LuaNumberArray) and not val.hash and val.arr:
+		write("[")
+		for i, item in enumerate(val.values() if type(val) is LuaNumberArray else val.arr):
+			write("," if i else "")
+			write(dumps(to_json(item, visiting)))
+		write("]")
+	elif type(val) is LuaTable and not val.arr and val.hash:
+		write("{")
+		for i, (key, item) in enumerate(val.hash.items()):
+			write("," if i else "")
+			write(dumps(json_key(key)) + ":" + dumps(to_json(item, visiting)))
+		write("}")
+	else:
+		write(dumps(to_json(val, set())))
+	flush()
+
+	if isinstance(args[0], LuaString):
+		handle.close()
+		return True
+	return handle
+
+
+lua_jsonlib = {
+	"array_mt": array_mt,
+	"decode": json_decode,
+	"decode_stream": json_decode_stream,
+	"encode": json_encode,
+	"encode_stream": json_encode_stream,
+	"null": null,
+}
@@ -1,117 +1,320 @@
 from lib.common import *
 from luatypes import *
 
+from array import array
+from itertools import repeat
 import math
-from ctypes import CDLL
-libc = CDLL("libc.so.6")
+import operator
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+# functions math.map can run over a whole array, with their numpy equivalents
+VECTORIZED = {
+	"sqrt": "sqrt", "log": "log", "log10": "log10", "deg": "degrees", "rad": "radians",
+	"sin": "sin", "asin": "arcsin", "sinh": "sinh", "cos": "cos", "acos": "arccos",
+	"cosh": "cosh", "tan": "tan", "atan": "arctan", "tanh": "tanh", "exp": "exp",
+	"abs": "abs", "floor": "floor", "ceil": "ceil",
+}
 
 def _mathfunc(name, f):
-	def newf(*args):
-		required_arg(name, args, 1, "number")
-		return f(args[0].value)
-	
+	@signature(name, "number")
+	def newf(x):
+		return f(x)
+
 	newf.__name__ = f.__name__
+	if name in VECTORIZED:
+		newf.lua_vectorized = (f, VECTORIZED[name])
 	return newf
 
 
+# the python functions raise where C's return nan or inf, which is what lua
+# (and numpy, for math.map) gives, so these return them instead
+def _sqrt(x):
+	return math.sqrt(x) if x >= 0 else math.nan
+
+def _logfunc(f):
+	def log(x):
+		if x > 0:
+			return f(x)
+		return -math.inf if x == 0 else math.nan
+	return log
+
+def _arcfunc(f):
+	def arc(x):
+		return f(x) if -1 <= x <= 1 else math.nan
+	return arc
+
+def _periodic(f):
+	def periodic(x):
+		return f(x) if math.isfinite(x) else math.nan
+	return periodic
+
+def _overflowing(f, sign=lambda x: 1):
+	def overflowing(x):
+		try:
+			return f(x)
+		except OverflowError:
+			return math.copysign(math.inf, sign(x))
+	return overflowing
+
+def _rounding(f):
+	def rounding(x):
+		return f(x) if math.isfinite(x) else x
+	return rounding
+
+
 _min = min
 def min(*args):
 	required_arg("min", args, 1, "number")
 	all_args("min", args, "number")
-	return _min(map(lambda a: a.value, args))
+	return _min(_map(lambda a: a.value, args))
 
 _max = max
 def max(*args):
 	required_arg("max", args, 1, "number")
-	all_args("min", args, "number")
-	return _max(map(lambda a: a.value, args))
+	all_args("max", args, "number")
+	return _max(_map(lambda a: a.value, args))
 
-sqrt = _mathfunc("sqrt", math.sqrt)
-log = _mathfunc("log", math.log)
-log10 = _mathfunc("log10", math.log10)
+sqrt = _mathfunc("sqrt", _sqrt)
+log = _mathfunc("log", _logfunc(math.log))
+log10 = _mathfunc("log10", _logfunc(math.log10))
 
 deg = _mathfunc("deg", math.degrees)
 rad = _mathfunc("rad", math.radians)
 
-sin = _mathfunc("sin", math.sin)
-asin = _mathfunc("asin", math.asin)
-sinh = _mathfunc("sinh", math.sinh)
+sin = _mathfunc("sin", _periodic(math.sin))
+asin = _mathfunc("asin", _arcfunc(math.asin))
+sinh = _mathfunc("sinh", _overflowing(math.sinh, sign=lambda x: x))
 
-cos = _mathfunc("cos", math.cos)
-acos = _mathfunc("acos", math.acos)
-cosh = _mathfunc("cosh", math.cosh)
+cos = _mathfunc("cos", _periodic(math.cos))
+acos = _mathfunc("acos", _arcfunc(math.acos))
+cosh = _mathfunc("cosh", _overflowing(math.cosh))
 
-tan = _mathfunc("tan", math.tan)
+tan = _mathfunc("tan", _periodic(math.tan))
 atan = _mathfunc("atan", math.atan)
 tanh = _mathfunc("tanh", math.tanh)
-atan2 = _mathfunc("atan2", math.atan2)
 
-exp = _mathfunc("exp", math.exp)
-frexp = _mathfunc("exp", math.frexp)
-ldexp = _mathfunc("exp", math.ldexp)
+@signature("atan2", "number", "number")
+def atan2(y, x):
+	return math.atan2(y, x)
+
+exp = _mathfunc("exp", _overflowing(math.exp))
+frexp = _mathfunc("frexp", math.frexp)
+
+@signature("ldexp", "number", "number")
+def ldexp(m, e):
+	try:
+		return math.ldexp(m, int(e))
+	except OverflowError:
+		return math.copysign(math.inf, m)
 
 _abs = abs
-abs = _mathfunc("exp", _abs)
-floor = _mathfunc("exp", math.floor)
-ceil = _mathfunc("exp", math.ceil)
+abs = _mathfunc("abs", _abs)
+floor = _mathfunc("floor", _rounding(math.floor))
+ceil = _mathfunc("ceil", _rounding(math.ceil))
+
+def _fmod(a, b):
+	try:
+		return math.fmod(a, b)
+	except ValueError:
+		# a zero divisor or an infinite dividend
+		return math.nan
+
+@signature("fmod", "number", "number")
+def fmod(a, b):
+	return _fmod(a, b)
 
 # deprecated
-def mod(*args):
-	required_arg("mod", args, 1, "number")
-	required_arg("mod", args, 2, "number")
-	return args[0].value % args[1].value
-
-def fmod(*args):
-	required_arg("fmod", args, 1, "number")
-	required_arg("fmod", args, 2, "number")
-	return args[0].value % args[1].value
-
-def modf(*args):
-	required_arg("modf", args, 1, "number")
-	required_arg("modf", args, 2, "number")
-	return divmod(args[0].value, args[1].value)
-
-_pow = pow
-def pow(*args):
-	required_arg("pow", args, 1, "number")
-	required_arg("pow", args, 2, "number")
-	return pow(args[0].value, args[1].value)
-
-
-RAND_MAX = 2147483647
-
-def _rand():
-	return libc.rand() % RAND_MAX
-
-def _srand(seed):
-	libc.srand(math.floor(seed))
-
-def randomseed(*args):
-	optional_arg("randomseed", args, 1, "number")
-	_srand(args[0].value)
-
-def random(*args):
-	optional_arg("random", args, 1, "number")
-	optional_arg("random", args, 2, "number")
-	
-	r = (_rand() % RAND_MAX) / RAND_MAX
-	
-	if len(args) == 0:
+@signature("mod", "number", "number")
+def mod(a, b):
+	return _fmod(a, b)
+
+@signature("modf", "number")
+def modf(x):
+	frac, whole = math.modf(x)
+	return whole, frac
+
+@signature("pow", "number", "number")
+def pow(x, y):
+	# a negative base to an odd integer power keeps its sign
+	sign = x if math.isfinite(y) and y.is_integer() and y % 2 == 1 else 1
+	try:
+		return math.pow(x, y)
+	except OverflowError:
+		return math.copysign(math.inf, sign)
+	except ValueError:
+		# a negative base to a fractional power, or zero to a negative one
+		return math.copysign(math.inf, sign) if x == 0 else math.nan
+
+
+def numbers_of(funcname: str, idx: int, t: LuaTable) -> array:
+	# the bulk functions work on the unboxed array part, packing the table if needed
+	if not t.pack_numbers():
+		raise LuaError(f"bad argument #{idx} to '{funcname}' (table of numbers expected)")
+	return t.arr
+
+def number_array(values: array) -> LuaNumberArray:
+	t = LuaNumberArray(0, 0)
+	t.arr = values
+	return t
+
+def as_numpy(values: array):
+	return numpy.frombuffer(values, dtype=numpy.float64)
+
+def from_numpy(values) -> array:
+	return array("d", values.tobytes())
+
+_sum = sum
+_map = map
+@signature("sum", "table")
+def sum(t):
+	values = numbers_of("sum", 1, t)
+	if numpy is not None and values:
+		return float(as_numpy(values).sum())
+	return _sum(values)
+
+@signature("dot", "table", "table")
+def dot(a, b):
+	x, y = numbers_of("dot", 1, a), numbers_of("dot", 2, b)
+	if len(x) != len(y):
+		raise LuaError("bad argument #2 to 'dot' (tables of different lengths)")
+	if numpy is not None and x:
+		return float(numpy.dot(as_numpy(x), as_numpy(y)))
+	return _sum(_map(operator.mul, x, y))
+
+@pass_env
+@signature("map", "table", "function")
+def map(env, t, f):
+	values = numbers_of("map", 1, t)
+
+	vectorized = getattr(getattr(f, "func", None), "lua_vectorized", None)
+	if vectorized is not None:
+		scalar, numpy_name = vectorized
+		if numpy is not None and values:
+			with numpy.errstate(all="ignore"):
+				return number_array(from_numpy(getattr(numpy, numpy_name)(as_numpy(values))))
+		return number_array(array("d", _map(scalar, values)))
+
+	# any other function is called once per element
+	res = LuaTable(0, 0)
+	for v in array("d", values):
+		results = f.call(env, [LuaNumber(v)])
+		res.arr.append(results[0] if results else LuaNil())
+	res.trim()
+	res.pack_numbers()
+	return res
+
+def elementwise(funcname: str, op, a: LuaObject, b: LuaObject, numpy_op=None) -> LuaObject:
+	"""
+	op over numbers and tables of them. The numpy path uses numpy_op if the
+	python op doesn't work on arrays, and both give the same (IEEE) results.
+	"""
+	if type(a) is LuaNumber and type(b) is LuaNumber:
+		return op(a.value, b.value)
+
+	if numpy is not None:
+		with numpy.errstate(all="ignore"):
+			return elementwise_tables(funcname, op, a, b, numpy_op or op)
+	return elementwise_tables(funcname, op, a, b, None)
+
+def elementwise_tables(funcname: str, op, a: LuaObject, b: LuaObject, numpy_op) -> LuaObject:
+	if isinstance(a, LuaTable) and isinstance(b, LuaTable):
+		x, y = numbers_of(funcname, 1, a), numbers_of(funcname, 2, b)
+		if len(x) != len(y):
+			raise LuaError(f"bad argument #2 to '{funcname}' (tables of different lengths)")
+		if numpy_op is not None and x:
+			return number_array(from_numpy(numpy_op(as_numpy(x), as_numpy(y))))
+		return number_array(array("d", _map(op, x, y)))
+
+	if isinstance(a, LuaTable) and type(b) is LuaNumber:
+		x = numbers_of(funcname, 1, a)
+		if numpy_op is not None and x:
+			return number_array(from_numpy(numpy_op(as_numpy(x), b.value)))
+		return number_array(array("d", _map(op, x, repeat(b.value, len(x)))))
+
+	if type(a) is LuaNumber and isinstance(b, LuaTable):
+		y = numbers_of(funcname, 2, b)
+		if numpy_op is not None and y:
+			return number_array(from_numpy(numpy_op(a.value, as_numpy(y))))
+		return number_array(array("d", _map(op, repeat(a.value, len(y)), y)))
+
+	idx, bad = (2, b) if isinstance(a, (LuaTable, LuaNumber)) else (1, a)
+	raise LuaError(f"bad argument #{idx} to '{funcname}' (table or number expected, got {bad.name})")
+
+@signature("add", "any", "any")
+def add(a, b):
+	return elementwise("add", operator.add, a, b)
+
+@signature("sub", "any", "any")
+def sub(a, b):
+	return elementwise("sub", operator.sub, a, b)
+
+@signature("mul", "any", "any")
+def mul(a, b):
+	return elementwise("mul", operator.mul, a, b)
+
+def _divide(a: float, b: float) -> float:
+	if b == 0:
+		# inf with the sign of the quotient, nan for 0/0 like numpy
+		return math.nan if a == 0 or math.isnan(a) else math.copysign(math.inf, a) * math.copysign(1, b)
+	return a / b
+
+@signature("div", "any", "any")
+def div(a, b):
+	return elementwise("div", _divide, a, b, numpy_op=operator.truediv)
+
+
+def random_bounds(m: float, n: float | None) -> tuple[int, int]:
+	if n is None:
+		if m < 1:
+			raise LuaError("bad argument #1 to 'random' (interval is empty)")
+		return 1, int(m)
+	if m > n:
+		raise LuaError("bad argument #2 to 'random' (interval is empty)")
+	return int(m), int(n)
+
+@pass_env
+@signature("randomseed", "number")
+def randomseed(env, seed):
+	env.random.seed(int(seed))
+
+@pass_env
+@signature("random", "number?", "number?")
+def random(env, m, n):
+	r = env.random.random()
+	if m is None:
 		return r
-	elif len(args) == 1:
-		u = args[0].value
-		if u <= 1:
-			raise LuaError("interval is empty")
-		return math.floor(r * u) + 1
-	elif len(args) == 2:
-		l = args[0].value
-		u = args[1].value
-		if l >= u:
-			raise LuaError("interval is empty")
-		return math.floor(r * (u - l + 1)) + l
+	low, high = random_bounds(m, n)
+	return int(r * (high - low + 1)) + low
+
+# fills t[1..count] with what as many calls to math.random(m, n) would return
+@pass_env
+@signature("randomfill", "table", "number", "number?", "number?")
+def randomfill(env, t, count, m, n):
+	rand = env.random.random
+	count = int(count)
+	if m is None:
+		values = array("d", [rand() for _ in range(count)])
 	else:
-		raise LuaError("wrong number of arguments")
+		low, high = random_bounds(m, n)
+		span = high - low + 1
+		values = array("d", [int(rand() * span) + low for _ in range(count)])
+
+	if not t.pack_numbers():
+		for i, v in enumerate(values):
+			t.set(LuaNumber(i + 1), LuaNumber(v))
+		return t
+
+	# keys that move into the array part must leave the hash part
+	for i in range(len(t.arr) + 2, count + 1):
+		t.hash.pop(LuaNumber(i), None)
+	t.arr[:count] = values
+	t.take_from_hash()
+	return t
 
 
 pi = 3.1415926535898
@@ -146,8 +349,16 @@ lua_mathlib = {
 	"fmod": fmod,
 	"modf": modf,
 	"pow": pow,
+	"sum": sum,
+	"dot": dot,
+	"map": map,
+	"add": add,
+	"sub": sub,
+	"mul": mul,
+	"div": div,
 	"random": random,
 	"randomseed": randomseed,
+	"randomfill": randomfill,
 	"pi": pi,
 	"huge": huge,
 }
@@ -0,0 +1,421 @@
+from luatypes import LuaError
+
+from functools import lru_cache
+import re
+import string
+
+
+SPECIALS = "^$*+?.([%-"
+MAX_CAPTURES = 32
+
+# character classes in the C locale, as a python test and a regex class body
+CLASSES = {
+	"a": (string.ascii_letters, "A-Za-z"),
+	"c": ("".join(map(chr, range(32))) + "\x7f", "\\x00-\\x1f\\x7f"),
+	"d": (string.digits, "0-9"),
+	"l": (string.ascii_lowercase, "a-z"),
+	"p": (string.punctuation, re.escape(string.punctuation)),
+	"s": (" \t\n\r\f\v", " \\t\\n\\r\\f\\v"),
+	"u": (string.ascii_uppercase, "A-Z"),
+	"w": (string.ascii_letters + string.digits, "0-9A-Za-z"),
+	"x": (string.hexdigits, "0-9A-Fa-f"),
+	"z": ("\0", "\\x00"),
+}
+
+# marks a capture that only records a position, like `()`
+POSITION = -1
+
+
+class NoRegex(Exception):
+	"""Raised while translating a pattern that `re` can't express."""
+
+
+def match_class(c: str, cl: str) -> bool:
+	chars = CLASSES.get(cl.lower())
+	if chars is None:
+		return cl == c
+	return (c in chars[0]) != cl.isupper()
+
+
+def class_end(p: str, i: int) -> int:
+	"""Index just past the single character class starting at p[i]."""
+	c = p[i]
+	i += 1
+	if c == "%":
+		if i >= len(p):
+			raise LuaError("malformed pattern (ends with '%')")
+		return i + 1
+	if c == "[":
+		if i < len(p) and p[i] == "^":
+			i += 1
+		# the first character of a set is never its end, so `[]]` is a set of "]"
+		while True:
+			if i >= len(p):
+				raise LuaError("malformed pattern (missing ']')")
+			c = p[i]
+			i += 1
+			if c == "%" and i < len(p):
+				i += 1
+			if i >= len(p):
+				raise LuaError("malformed pattern (missing ']')")
+			if p[i] == "]":
+				return i + 1
+	return i
+
+
+def match_bracket(c: str, p: str, start: int, end: int) -> bool:
+	"""Whether c is in the set p[start:end], brackets included."""
+	i = start + 1
+	negate = p[i] == "^"
+	if negate:
+		i += 1
+	end -= 1
+	while i < end:
+		if p[i] == "%":
+			i += 1
+			if match_class(c, p[i]):
+				return not negate
+		elif p[i + 1] == "-" and i + 2 < end:
+			i += 2
+			if p[i - 2] <= c <= p[i]:
+				return not negate
+		elif p[i] == c:
+			return not negate
+		i += 1
+	return negate
+
+
+def single_match(c: str, p: str, start: int, end: int) -> bool:
+	match p[start]:
+		case ".": return True
+		case "%": return match_class(c, p[start + 1])
+		case "[": return match_bracket(c, p, start, end)
+		case ch: return ch == c
+
+
+class LuaPattern:
+	"""
+	A compiled Lua pattern.
+
+	Patterns are translated to a python regex where possible, which covers
+	everything except balanced matches (`%b`) and back-references that `re`
+	disagrees with; those run on a port of the backtracking matcher from
+	lstrlib.c. Either way `find` returns the same thing.
+	"""
+
+	def __init__(self, pattern: str, anchor: bool = True):
+		self.pattern = pattern
+		self.anchored = anchor and pattern.startswith("^")
+		self.start = 1 if self.anchored else 0
+		# POSITION for position captures, 0 for the others
+		self.captures = []
+		try:
+			self.regex = re.compile(self.translate(), re.DOTALL)
+		except (NoRegex, re.error):
+			self.regex = None
+
+	def translate(self) -> str:
+		p = self.pattern
+		res = []
+		open_captures = []
+		i = self.start
+		while i < len(p):
+			c = p[i]
+			if c == "(":
+				if len(self.captures) >= MAX_CAPTURES:
+					raise LuaError("too many captures")
+				if i + 1 < len(p) and p[i + 1] == ")":
+					self.captures.append(POSITION)
+					res.append("()")
+					i += 2
+				else:
+					open_captures.append(len(self.captures))
+					self.captures.append(0)
+					res.append("(")
+					i += 1
+				continue
+			if c == ")":
+				if not open_captures:
+					raise LuaError("invalid pattern capture")
+				open_captures.pop()
+				res.append(")")
+				i += 1
+				continue
+			if c == "$" and i + 1 == len(p):
+				res.append(r"\Z")
+				i += 1
+				continue
+			if c == "%" and i + 1 < len(p):
+				match p[i + 1]:
+					case "b":
+						raise NoRegex()
+					case "f":
+						i += 2
+						if i >= len(p) or p[i] != "[":
+							raise LuaError("missing '[' after '%f' in pattern")
+						end = class_end(p, i)
+						res.append(self.frontier(i, end))
+						i = end
+						continue
+					case d if d.isdigit():
+						idx = int(d) - 1
+						if idx < 0 or idx >= len(self.captures) or idx in open_captures:
+							raise LuaError("invalid capture index")
+						if self.captures[idx] == POSITION:
+							raise NoRegex()
+						res.append(f"(?:\\{idx + 1})")
+						i += 2
+						continue
+
+			end = class_end(p, i)
+			item = self.translate_class(i, end)
+			if end < len(p) and p[end] in "*+-?":
+				item += {"*": "*", "+": "+", "-": "*?", "?": "?"}[p[end]]
+				end += 1
+			res.append(item)
+			i = end
+
+		if open_captures:
+			raise LuaError("unfinished capture")
+		return "".join(res)
+
+	def translate_class(self, start: int, end: int) -> str:
+		p = self.pattern
+		match p[start]:
+			case ".":
+				return "."
+			case "%":
+				cl = p[start + 1]
+				chars = CLASSES.get(cl.lower())
+				if chars is None:
+					return re.escape(cl)
+				return f"[^{chars[1]}]" if cl.isupper() else f"[{chars[1]}]"
+			case "[":
+				return self.translate_set(start, end)
+			case c:
+				return re.escape(c)
+
+	def translate_set(self, start: int, end: int) -> str:
+		p = self.pattern
+		i = start + 1
+		res = "["
+		if p[i] == "^":
+			res += "^"
+			i += 1
+		end -= 1
+		while i < end:
+			if p[i] == "%":
+				i += 1
+				cl = p[i]
+				chars = CLASSES.get(cl.lower())
+				if chars is None:
+					res += re.escape(cl)
+				elif cl.isupper():
+					# a negated class can't be put inside a regex set
+					raise NoRegex()
+				else:
+					res += chars[1]
+			elif p[i + 1] == "-" and i + 2 < end:
+				res += re.escape(p[i]) + "-" + re.escape(p[i + 2])
+				i += 2
+			else:
+				res += re.escape(p[i])
+			i += 1
+		return res + "]"
+
+	def frontier(self, start: int, end: int) -> str:
+		# the string is surrounded by "\0", which only matters if the set contains it
+		cls = self.translate_set(start, end)
+		if not match_bracket("\0", self.pattern, start, end):
+			return f"(?<!{cls})(?={cls})"
+		negated = "[" + cls[2:] if cls.startswith("[^") else "[^" + cls[1:]
+		return f"(?<={negated})(?:(?={cls})|\\Z)"
+
+	def find(self, s: str, init: int = 0) -> tuple[int, int, list] | None:
+		"""
+		The first match at or after `init` as start index, end index and
+		captures. Position captures are 1-based like in Lua.
+		"""
+		if self.regex is not None:
+			m = self.regex.match(s, init) if self.anchored else self.regex.search(s, init)
+			if m is None:
+				return None
+			captures = [
+				m.start(i + 1) + 1 if kind == POSITION else m.group(i + 1)
+				for i, kind in enumerate(self.captures)
+			]
+			return m.start(), m.end(), captures
+
+		matcher = LuaMatcher(s, self.pattern)
+		while True:
+			matcher.level = 0
+			end = matcher.match(init, self.start)
+			if end is not None:
+				return init, end, matcher.get_captures()
+			init += 1
+			if self.anchored or init > len(s):
+				return None
+
+	def captures_or_match(self, s: str, found: tuple[int, int, list]) -> list:
+		start, end, captures = found
+		return captures if captures else [s[start:end]]
+
+
+class LuaMatcher:
+	"""Backtracking matcher ported from lstrlib.c, for patterns `re` can't run."""
+
+	def __init__(self, src: str, pattern: str):
+		self.src = src
+		self.pattern = pattern
+		self.level = 0
+		# [start, length or POSITION or None while unfinished]
+		self.capture = [[0, None] for _ in range(MAX_CAPTURES)]
+
+	def get_captures(self) -> list:
+		res = []
+		for start, length in self.capture[:self.level]:
+			if length == POSITION:
+				res.append(start + 1)
+			else:
+				res.append(self.src[start:start + length])
+		return res
+
+	def match(self, s: int, p: int) -> int | None:
+		src, pat = self.src, self.pattern
+		while p < len(pat):
+			c = pat[p]
+			if c == "(":
+				if p + 1 < len(pat) and pat[p + 1] == ")":
+					return self.start_capture(s, p + 2, POSITION)
+				return self.start_capture(s, p + 1, None)
+			if c == ")":
+				return self.end_capture(s, p + 1)
+			if c == "$" and p + 1 == len(pat):
+				return s if s == len(src) else None
+			if c == "%" and p + 1 < len(pat):
+				match pat[p + 1]:
+					case "b":
+						s = self.match_balance(s, p + 2)
+						if s is None:
+							return None
+						p += 4
+						continue
+					case "f":
+						p += 2
+						if p >= len(pat) or pat[p] != "[":
+							raise LuaError("missing '[' after '%f' in pattern")
+						ep = class_end(pat, p)
+						prev = src[s - 1] if s > 0 else "\0"
+						cur = src[s] if s < len(src) else "\0"
+						if match_bracket(prev, pat, p, ep) or not match_bracket(cur, pat, p, ep):
+							return None
+						p = ep
+						continue
+					case d if d.isdigit():
+						s = self.match_capture(s, int(d))
+						if s is None:
+							return None
+						p += 2
+						continue
+
+			ep = class_end(pat, p)
+			m = s < len(src) and single_match(src[s], pat, p, ep)
+			quantifier = pat[ep] if ep < len(pat) else None
+			if quantifier == "?":
+				if m:
+					res = self.match(s + 1, ep + 1)
+					if res is not None:
+						return res
+				p = ep + 1
+			elif quantifier == "*":
+				return self.max_expand(s, p, ep)
+			elif quantifier == "+":
+				return self.max_expand(s + 1, p, ep) if m else None
+			elif quantifier == "-":
+				return self.min_expand(s, p, ep)
+			else:
+				if not m:
+					return None
+				s += 1
+				p = ep
+		return s
+
+	def max_expand(self, s: int, p: int, ep: int) -> int | None:
+		i = 0
+		while s + i < len(self.src) and single_match(self.src[s + i], self.pattern, p, ep):
+			i += 1
+		while i >= 0:
+			res = self.match(s + i, ep + 1)
+			if res is not None:
+				return res
+			i -= 1
+		return None
+
+	def min_expand(self, s: int, p: int, ep: int) -> int | None:
+		while True:
+			res = self.match(s, ep + 1)
+			if res is not None:
+				return res
+			if s < len(self.src) and single_match(self.src[s], self.pattern, p, ep):
+				s += 1
+			else:
+				return None
+
+	def start_capture(self, s: int, p: int, what) -> int | None:
+		if self.level >= MAX_CAPTURES:
+			raise LuaError("too many captures")
+		self.capture[self.level] = [s, what]
+		self.level += 1
+		res = self.match(s, p)
+		if res is None:
+			self.level -= 1
+		return res
+
+	def end_capture(self, s: int, p: int) -> int | None:
+		for l in range(self.level - 1, -1, -1):
+			if self.capture[l][1] is None:
+				break
+		else:
+			raise LuaError("invalid pattern capture")
+		self.capture[l][1] = s - self.capture[l][0]
+		res = self.match(s, p)
+		if res is None:
+			self.capture[l][1] = None
+		return res
+
+	def match_balance(self, s: int, p: int) -> int | None:
+		if p + 1 >= len(self.pattern):
+			raise LuaError("unbalanced pattern")
+		src = self.src
+		if s >= len(src) or src[s] != self.pattern[p]:
+			return None
+		b, e = self.pattern[p], self.pattern[p + 1]
+		depth = 1
+		s += 1
+		while s < len(src):
+			if src[s] == e:
+				depth -= 1
+				if depth == 0:
+					return s + 1
+			elif src[s] == b:
+				depth += 1
+			s += 1
+		return None
+
+	def match_capture(self, s: int, l: int) -> int | None:
+		l -= 1
+		if l < 0 or l >= self.level or self.capture[l][1] is None:
+			raise LuaError("invalid capture index")
+		start, length = self.capture[l]
+		if length == POSITION:
+			return None
+		captured = self.src[start:start + length]
+		if self.src.startswith(captured, s):
+			return s + length
+		return None
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern: str, anchor: bool = True) -> LuaPattern:
+	"""Compiles a pattern once, loops matching the same pattern reuse it."""
+	return LuaPattern(pattern, anchor)
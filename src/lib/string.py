@@ -1,84 +1,247 @@
 from lib.common import *
+from lib.pattern import SPECIALS, compile_pattern
 from luatypes import *
 
+# the lua functions below shadow these builtins
+_len = len
+_format = format
+
 
-def byte(*args):
-	required_arg("byte", args, 1, "string")
-	optional_arg("byte", args, 2, "number")
-	idx = args[1].value if len(args) > 1 else 0
-	return ord(args[0].value[idx])
+def str_index(pos: float, length: int) -> int:
+	"""A 1-based string position with negative ones counting from the end."""
+	pos = int(pos)
+	if pos < 0:
+		pos += length + 1
+	return pos if pos >= 0 else 0
+
+@signature("byte", "string", "number?", "number?")
+def byte(s, i, j):
+	start = str_index(1 if i is None else i, _len(s))
+	end = str_index(start if j is None else j, _len(s))
+	return tuple(map(ord, s[max(start, 1) - 1:end]))
 
 def char(*args):
 	all_args("char", args, "number")
-	return "".join(chr(n) for n in args)
+	return "".join(chr(int(n.value)) for n in args)
 
 def dump(*args):
 	required_arg("dump", args, 1, "function")
 	return None
 
-def find(*args):
-	required_arg("find", args, 1, "string")
-	required_arg("find", args, 2, "string")
-	idx = args[0].value.find(args[1].value)
-	if idx == -1:
-		return LuaNil()
-	return (idx, idx + len(args[1].value))
+def init_index(init: float | None, length: int) -> int:
+	"""0-based index to start matching at from an optional init argument."""
+	if init is None:
+		return 0
+	return min(max(str_index(init, length) - 1, 0), length)
 
-_format = format
-def format(*args):
-	return None
+@signature("find", "string", "string", "number?", "any?")
+def find(s, pattern, init, plain):
+	init = init_index(init, _len(s))
 
-def gfind(*args):
-	return None
+	if plain is not None and plain.bool() or not any(c in SPECIALS for c in pattern):
+		idx = s.find(pattern, init)
+		if idx == -1:
+			return LuaNil()
+		return idx + 1, idx + _len(pattern)
 
-def gmatch(*args):
-	return None
+	found = compile_pattern(pattern).find(s, init)
+	if found is None:
+		return LuaNil()
+	start, end, captures = found
+	return (start + 1, end, *captures)
 
-def gsub(*args):
-	return None
+def format_quoted(s: str) -> str:
+	res = s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\\n")
+	return '"' + res.replace("\r", "\\r").replace("\0", "\\000") + '"'
 
-_len = len
-def len(*args):
-	required_arg("len", args, 1, "string")
-	return _len(args[0].value)
+def format(*args):
+	required_arg("format", args, 1, "string")
+	fmt = args[0].value
+	res = []
+	arg = 1
+	i = 0
+	while i < _len(fmt):
+		c = fmt[i]
+		i += 1
+		if c != "%":
+			res.append(c)
+			continue
+		if i < _len(fmt) and fmt[i] == "%":
+			res.append("%")
+			i += 1
+			continue
+
+		start = i
+		while i < _len(fmt) and fmt[i] in "-+ #0":
+			i += 1
+		while i < _len(fmt) and (fmt[i].isdigit() or fmt[i] == "."):
+			i += 1
+		if i >= _len(fmt):
+			raise LuaError("invalid option '%' to 'format'")
+		spec, conv = fmt[start:i], fmt[i]
+		i += 1
+
+		arg += 1
+		match conv:
+			case "d" | "i" | "u" | "c" | "o" | "x" | "X" | "e" | "E" | "f" | "g" | "G":
+				required_arg("format", args, arg, "number", "string")
+				num = args[arg - 1].tonumber()
+				if isinstance(num, LuaNil):
+					raise LuaError(f"bad argument #{arg} to 'format' (number expected, got string)")
+				if conv == "c":
+					res.append(chr(int(num.value)))
+				elif conv in "diuoxX":
+					res.append(("%" + spec + conv.replace("i", "d").replace("u", "d")) % int(num.value))
+				else:
+					res.append(("%" + spec + conv) % num.value)
+			case "q":
+				required_arg("format", args, arg, "string", "number")
+				res.append(format_quoted(args[arg - 1].tostring().value))
+			case "s":
+				required_arg("format", args, arg, "string", "number")
+				res.append(("%" + spec + "s") % args[arg - 1].tostring().value)
+			case _:
+				raise LuaError(f"invalid option '%{conv}' to 'format'")
+	return "".join(res)
+
+@signature("gmatch", "string", "string")
+def gmatch(s, pattern):
+	# a leading "^" isn't an anchor in gmatch
+	pattern = compile_pattern(pattern, False)
+	pos = 0
+
+	def gmatch_iter(*_):
+		nonlocal pos
+		found = pattern.find(s, pos) if pos <= _len(s) else None
+		if found is None:
+			pos = _len(s) + 1
+			return LuaNil()
+		start, end, _ = found
+		# step over empty matches
+		pos = end + 1 if end == start else end
+		return tuple(pattern.captures_or_match(s, found))
+
+	return gmatch_iter
+
+gfind = gmatch
+
+def expand_replacement(repl: str, whole: str, captures: list) -> str:
+	if "%" not in repl:
+		return repl
+	res = []
+	i = 0
+	while i < _len(repl):
+		c = repl[i]
+		i += 1
+		if c != "%" or i >= _len(repl):
+			res.append(c)
+			continue
+		c = repl[i]
+		i += 1
+		if c == "0" or c == "1" and not captures:
+			res.append(whole)
+		elif c.isdigit():
+			if int(c) > _len(captures):
+				raise LuaError("invalid capture index")
+			res.append(make_lua_type(captures[int(c) - 1]).tostring().value)
+		else:
+			res.append(c)
+	return "".join(res)
+
+def replacement(env, repl: LuaObject, s: str, found: tuple) -> str:
+	start, end, captures = found
+	whole = s[start:end]
+	match repl:
+		case LuaString() | LuaNumber():
+			return expand_replacement(repl.tostring().value, whole, captures)
+		case LuaTable():
+			value = repl.get_from(make_lua_type(captures[0] if captures else whole))
+		case _:
+			res = repl.call(env, [make_lua_type(c) for c in captures or [whole]])
+			value = res[0] if res else LuaNil()
+
+	# nil or false keeps the match, unset registers come back as None
+	if value is None or not value.bool():
+		return whole
+	if value.name not in ("string", "number"):
+		raise LuaError(f"invalid replacement value (a {value.name})")
+	return value.tostring().value
+
+@pass_env
+def gsub(env, *args):
+	required_arg("gsub", args, 1, "string")
+	required_arg("gsub", args, 2, "string")
+	required_arg("gsub", args, 3, "string", "number", "table", "function")
+	optional_arg("gsub", args, 4, "number")
+	s = args[0].value
+	pattern = compile_pattern(args[1].value)
+	repl = args[2]
+	max_n = int(args[3].value) if _len(args) > 3 and args[3].bool() else _len(s) + 1
+
+	res = []
+	pos = 0
+	n = 0
+	while n < max_n:
+		found = pattern.find(s, pos)
+		if found is None:
+			break
+		start, end, _ = found
+		n += 1
+		res.append(s[pos:start])
+		res.append(replacement(env, repl, s, found))
+		pos = end
+		if end == start:
+			# an empty match keeps the next character and moves past it
+			if start >= _len(s):
+				break
+			res.append(s[start])
+			pos += 1
+		if pattern.anchored:
+			break
+	res.append(s[pos:])
+	return "".join(res), n
+
+@signature("len", "string")
+def len(s):
+	return _len(s)
+
+@signature("lower", "string")
+def lower(s):
+	return s.lower()
+
+@signature("match", "string", "string", "number?")
+def match(s, pattern, init):
+	pattern = compile_pattern(pattern)
+	found = pattern.find(s, init_index(init, _len(s)))
+	if found is None:
+		return LuaNil()
+	return tuple(pattern.captures_or_match(s, found))
 
-def lower(*args):
-	required_arg("lower", args, 1, "string")
-	return args[0].lower()
+@signature("rep", "string", "number")
+def rep(s, n):
+	return s * int(n) if n > 0 else ""
 
-def match(*args):
-	return None
+@signature("reverse", "string")
+def reverse(s):
+	return s[::-1]
+
+@signature("sub", "string", "number", "number?")
+def sub(s, i, j):
+	start = max(str_index(i, _len(s)), 1)
+	end = min(str_index(-1 if j is None else j, _len(s)), _len(s))
+	return s[start - 1:end] if start <= end else ""
 
-def rep(*args):
-	required_arg("rep", args, 1, "string")
-	required_arg("rep", args, 2, "number")
-	return args[0].value * args[1].value
-
-def reverse(*args):
-	required_arg("reverse", args, 1, "string")
-	return args[0].value[::-1]
-
-def sub(*args):
-	required_arg("sub", args, 1, "string")
-	required_arg("sub", args, 2, "number")
-	optional_arg("sub", args, 3, "number")
-	start = args[1].value
-	if len(args) > 2:
-		end = args[2].value
-		return args[0].value[start:end + 1]
-	else:
-		return args[0].value[start:]
-
-def upper(*args):
-	required_arg("upper", args, 1, "string")
-	return args[0].upper()
+@signature("upper", "string")
+def upper(s):
+	return s.upper()
 
 lua_strlib = {
-	"bytes": bytes,
+	"byte": byte,
 	"char": char,
 	"dump": dump,
 	"find": find,
 	"format": format,
+	"gfind": gfind,
 	"gmatch": gmatch,
 	"gsub": gsub,
 	"len": len,
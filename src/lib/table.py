@@ -1,6 +1,9 @@
 from lib.common import *
 from luatypes import *
 
+from array import array
+from operator import attrgetter
+
 
 def tab_insert(*args):
 	required_arg("insert", args, 1, "table")
@@ -8,74 +11,185 @@ def tab_insert(*args):
 	optional_arg("insert", args, 3)
 
 	t = args[0]
-
 	if len(args) == 2:
-		t.arr.append(args[1])
+		t.set_arr(len(t.arr) + 1, args[1])
+		return
+	if len(args) > 3:
+		raise LuaError("wrong number of arguments to 'insert'")
+
+	required_arg("insert", args, 2, "number")
+	pos = int(args[1].value)
+	if 1 <= pos <= len(t.arr) + 1:
+		t.insert(pos, args[2])
 	else:
-		i = int(args[1].value) - 1
-		v = args[2]
-		t.arr = t.arr[:i] + [v] + t.arr[i:]
-
-
-def tab_concat(*args):
-	required_arg("concat", args, 1, "table")
-	optional_arg("concat", args, 2, "string")
-	optional_arg("concat", args, 3, "number")
-	optional_arg("concat", args, 4, "number")
-	
-	t = args[0]
-	sep = args[1] if len(args) > 1 else ""
-	i = (args[2] - 1) if len(args) > 2 else 0
-	j = args[3] if len(args) > 3 else len(t.arr)
-
-	for idx, value in enumerate(t.arr[i:j + 1]):
-		if value.name not in {"string", "number"}:
-			raise LuaError(f"invalid value ({value.name}) at index {idx + 1} in table for 'concat'")
-
-	# print(i, j, t.arr)
-	return sep.join([e.tostring().value for e in t.arr[i:j]])
-
-
-def tab_sort(*args):
+		t.set(LuaNumber(pos), args[2])
+
+
+@signature("concat", "table", "string?", "number?", "number?")
+def tab_concat(t, sep, i, j):
+	sep = "" if sep is None else sep
+	i = 1 if i is None else int(i)
+	j = len(t.arr) if j is None else int(j)
+
+	arr = t.arr
+	if type(t) is LuaNumberArray and 1 <= i and j <= len(arr):
+		return sep.join([f"{v:.14g}" for v in arr[i - 1:j]])
+
+	parts = []
+	for idx in range(i, j + 1):
+		value = arr[idx - 1] if 1 <= idx <= len(arr) else t.get_from(LuaNumber(idx))
+		match value:
+			case LuaString():
+				parts.append(value.value)
+			case LuaNumber():
+				parts.append(f"{value.value:.14g}")
+			case _:
+				raise LuaError(f"invalid value (at index {idx}) in table for 'concat'")
+
+	return LuaString(sep.join(parts))
+
+
+def default_less_than(a, b) -> bool:
+	if type(a) is LuaNumber and type(b) is LuaNumber or isinstance(a, LuaString) and isinstance(b, LuaString):
+		return a.value < b.value
+	if isinstance(a, LuaTable) and isinstance(b, LuaTable):
+		# the vm's `<`, which goes through __lt
+		return a < b
+	if a.name == b.name:
+		raise LuaError(f"attempt to compare two {a.name} values")
+	raise LuaError(f"attempt to compare {a.name} with {b.name}")
+
+
+def sort_key(env, comp: LuaObject | None):
+	"""A key class for list.sort, whose `<` is the lua comparison."""
+	if comp is None:
+		less_than = default_less_than
+	else:
+		# one argument list for every comparison, the callee copies it into its stack
+		args = [None, None]
+		if type(comp) is LuaFunction:
+			from lvm import call_lua_function
+			def less_than(a, b):
+				args[0], args[1] = a, b
+				res = call_lua_function(comp, env, args)
+				return len(res) > 0 and res[0].bool()
+		else:
+			def less_than(a, b):
+				args[0], args[1] = a, b
+				res = comp.call(env, args)
+				return len(res) > 0 and res[0].bool()
+
+	class SortKey:
+		__slots__ = ("value",)
+
+		def __init__(self, value):
+			self.value = value
+
+		def __lt__(self, other):
+			return less_than(self.value, other.value)
+
+	return SortKey
+
+
+@pass_env
+def tab_sort(env, *args):
 	required_arg("sort", args, 1, "table")
 	optional_arg("sort", args, 2, "function")
-	# TODO
 
-
-def tab_remove(*args):
-	required_arg("remove", args, 1, "table")
-	optional_arg("remove", args, 2, "string", "number")
-	# TODO
-
-
-def tab_foreach(*args):
+	t = args[0]
+	comparator = len(args) > 1 and args[1].bool()
+	if type(t) is LuaNumberArray:
+		if not comparator:
+			t.arr = array("d", sorted(t.arr))
+			return
+		t.unpack_numbers()
+
+	arr = t.arr
+	if comparator:
+		sort_calling_back(t, sort_key(env, args[1]))
+		# a comparator may have sorted holes to the end
+		t.trim()
+	elif all(type(v) is LuaNumber for v in arr) or all(isinstance(v, LuaString) for v in arr):
+		# plain floats or strs, which list.sort compares without calling back into python
+		arr.sort(key=attrgetter("value"))
+	else:
+		# the values may have __lt metamethods
+		sort_calling_back(t, sort_key(env, None))
+
+def sort_calling_back(t: LuaTable, key):
+	"""
+	Sorts the array part by comparisons that run lua code. A copy is sorted,
+	since list.sort empties the list while it runs, so the code would see
+	an empty table. Changing the table in the meantime is an error.
+	"""
+	arr = t.arr
+	before = list(arr)
+	try:
+		res = sorted(before, key=key)
+	except ValueError:
+		raise LuaError("invalid order function for sorting")
+	if t.arr is not arr or len(arr) != len(before) or any(a is not b for a, b in zip(arr, before)):
+		raise LuaError("invalid order function for sorting")
+	t.arr = res
+
+
+@signature("remove", "table", "number?")
+def tab_remove(t, pos):
+	n = len(t.arr)
+	pos = n if pos is None else int(pos)
+	if not 1 <= pos <= n:
+		return ()
+	return t.remove(pos)
+
+
+@pass_env
+def tab_foreach(env, *args):
 	required_arg("foreach", args, 1, "table")
 	required_arg("foreach", args, 2, "function")
-	# TODO
 
+	t, func = args[0], args[1]
+	for key, val in t.items():
+		res = func.call(env, [key, val])
+		if len(res) > 0 and type(res[0]) is not LuaNil:
+			return res[0]
 
-def tab_foreachi(*args):
+
+@pass_env
+def tab_foreachi(env, *args):
 	required_arg("foreachi", args, 1, "table")
 	required_arg("foreachi", args, 2, "function")
-	# TODO
+
+	t, func = args[0], args[1]
+	for i in range(len(t.arr)):
+		res = func.call(env, [LuaNumber(i + 1), t.get_from(LuaNumber(i + 1))])
+		if len(res) > 0 and type(res[0]) is not LuaNil:
+			return res[0]
 
 
 def tab_setn(*args):
 	raise LuaError("'setn' is obsolete")
 
 
-def tab_getn(*args):
-	required_arg("getn", args, 1, "table")
-	keys = args[0].keys()
-	for i in range(1, len(keys) + 1):
-		if LuaNumber(i) not in keys:
-			break
-	return i - 1
+@signature("getn", "table")
+def tab_getn(t):
+	return len(t.arr)
+
+
+@signature("maxn", "table")
+def tab_maxn(t):
+	keys = [k.value for k in t.hash if type(k) is LuaNumber]
+	return max([len(t.arr), *keys]) if keys else len(t.arr)
 
 
-def tab_maxn(*args):
-	required_arg("maxn", args, 1, "table")
-	return max(args[0].hash.keys())
+@signature("unpack", "table", "number?", "number?")
+def tab_unpack(t, i, j):
+	i = 1 if i is None else int(i)
+	j = len(t.arr) if j is None else int(j)
+	if i > j:
+		return ()
+	if i >= 1 and j <= len(t.arr):
+		return tuple(t.arr[i - 1:j])
+	return tuple(t.get_from(LuaNumber(k)) for k in range(i, j + 1))
 
 
 lua_tablib = {
@@ -1,7 +1,9 @@
 from luafile import LuaFile
+from luadebug import ConsoleDebugger
 import lvm
 
 import subprocess
+import sys
 
 # input_filename = "examples/binsearch/binsearch.lua"
 input_filename = "example.lua"
@@ -10,5 +12,6 @@ res = subprocess.call(["luac5.1", input_filename])
 
 with open("luac.out", "rb") as f:
 	source_file = LuaFile("luac.out", f.read())
+	if "--debug" in sys.argv:
+		source_file.env.tracer = ConsoleDebugger()
 	res = source_file.execute()
-
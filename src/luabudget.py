@@ -0,0 +1,79 @@
+from luatypes import LuaError
+
+import os
+import resource
+import time
+
+
+class LuaBudgetExceeded(LuaError):
+	def __init__(self, msg: str, kind: str):
+		super().__init__(msg)
+		self.kind = kind
+
+	def __reduce__(self):
+		return (type(self), (self.msg, self.kind))
+
+
+def memory_usage() -> int:
+	"""Resident memory of this process in bytes."""
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except OSError:
+		# only the peak is available here
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LuaBudget:
+	"""
+	Limits on how much work a script may do before it is stopped.
+
+	The VM charges the budget at back edges (with the length of the loop body)
+	and at function entry (with the length of the function), so the
+	instruction count is an estimate. The limits themselves are only checked
+	every `check_interval` charges, which keeps the cost in the hot loop down
+	to a counter update.
+
+	The memory limit is on the resident memory of the whole process (or
+	its peak, where the current value isn't available), not on what the
+	script allocated. It only means something when one script runs per
+	process, like with LuaExecutor's workers; LuaThreadExecutor rejects it,
+	since one job's memory would be charged to every other job.
+	"""
+
+	def __init__(
+		self,
+		max_instructions: int | None = None,
+		max_time: float | None = None,
+		max_memory: int | None = None,
+		check_interval: int = 1000,
+	):
+		self.max_instructions = max_instructions
+		self.max_time = max_time
+		self.max_memory = max_memory
+		self.check_interval = check_interval
+		self.start()
+
+	def start(self):
+		self.instructions = 0
+		self.countdown = self.check_interval
+		self.deadline = None
+		if self.max_time is not None:
+			self.deadline = time.monotonic() + self.max_time
+		return self
+
+	def charge(self, num_instructs: int):
+		self.instructions += num_instructs
+		self.countdown -= 1
+		if self.countdown <= 0:
+			self.check()
+
+	def check(self):
+		self.countdown = self.check_interval
+
+		if self.max_instructions is not None and self.instructions > self.max_instructions:
+			raise LuaBudgetExceeded(f"instruction budget exceeded ({self.max_instructions} instructions)", "instructions")
+		if self.deadline is not None and time.monotonic() > self.deadline:
+			raise LuaBudgetExceeded(f"time budget exceeded ({self.max_time}s)", "time")
+		if self.max_memory is not None and memory_usage() > self.max_memory:
+			raise LuaBudgetExceeded(f"memory budget exceeded ({self.max_memory} bytes)", "memory")
@@ -0,0 +1,102 @@
+from luatypes import *
+from lvm import LuaFrame
+
+
+class LuaTracer:
+	"""
+	Receives VM events while installed as `env.tracer`.
+
+	Only functions called while a tracer is installed are traced, everything
+	else runs the plain interpreter loop.
+	"""
+
+	def on_call(self, frame: LuaFrame):
+		pass
+
+	def on_instruction(self, frame: LuaFrame):
+		pass
+
+
+class LuaDebugger(LuaTracer):
+	"""
+	Stops at breakpoints or after every instruction while stepping.
+
+	Subclasses decide what happens when execution stops by overriding
+	`on_stop`, which runs before the instruction at `frame.pc`.
+	"""
+
+	def __init__(self, stepping: bool = False):
+		self.stepping = stepping
+		# (proto_num, pc) pairs and source lines
+		self.pc_breakpoints = set()
+		self.line_breakpoints = set()
+
+	def break_at_pc(self, proto_num: int, pc: int):
+		self.pc_breakpoints.add((proto_num, pc))
+
+	def break_at_line(self, line: int):
+		self.line_breakpoints.add(line)
+
+	def clear_breakpoints(self):
+		self.pc_breakpoints.clear()
+		self.line_breakpoints.clear()
+
+	def step(self):
+		self.stepping = True
+
+	def resume(self):
+		self.stepping = False
+
+	def on_instruction(self, frame: LuaFrame):
+		if (
+			self.stepping
+			or (frame.func.proto_num, frame.pc) in self.pc_breakpoints
+			or frame.line in self.line_breakpoints
+		):
+			self.on_stop(frame)
+
+	def on_stop(self, frame: LuaFrame):
+		pass
+
+
+class ConsoleDebugger(LuaDebugger):
+	"""
+	Interactive debugger for the terminal.
+
+	Shows the listing and registers of the current function and reads a
+	command: empty or `s` steps, `c` continues to the next breakpoint,
+	`b LINE` and `bp PC` set breakpoints, `p NAME` prints a local.
+	"""
+
+	def __init__(self, stepping: bool = True):
+		super().__init__(stepping)
+
+	def on_stop(self, frame: LuaFrame):
+		func = frame.func
+		print("\x1b[3J\x1b[H", end="")
+		print(func.get_debug_str())
+
+		local_vars = frame.locals()
+		for name, val in local_vars.items():
+			print(f"-> {name} = {repr(val)}")
+		extra_stack = [v or LuaNil() for v in frame.stack.registers[len(local_vars):]]
+		print(f"-> [{', '.join(repr(v) for v in extra_stack)}]")
+
+		inst = func.instructs[frame.pc]
+		while True:
+			cmd = input(f"{func.proto_num}:[{frame.pc + 1}] line {frame.line} {inst.name} ").split()
+			match cmd:
+				case [] | ["s"]:
+					self.step()
+					return
+				case ["c"]:
+					self.resume()
+					return
+				case ["b", line]:
+					self.break_at_line(int(line))
+				case ["bp", pc]:
+					self.break_at_pc(func.proto_num, int(pc) - 1)
+				case ["p", name]:
+					print(repr(local_vars.get(name, LuaNil())))
+				case _:
+					print("commands: s, c, b LINE, bp PC, p NAME")
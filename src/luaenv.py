@@ -1,35 +1,112 @@
 from lib.globals import lua_globals
+from lib.io import lua_iolib
+from lib.json import lua_jsonlib
 from lib.math import lua_mathlib
 from lib.string import lua_strlib
 from lib.table import lua_tablib
 
+from luamemory import LuaMemory
+from luaoutput import LuaOutput
 from luatypes import *
 
+from random import Random
+import threading
 
-def lua_io_read(what: str | None = None) -> str:
-	res = input()
-	if what and what.startswith("*n"):
-		res = float(res)
-	return res
+
+def deep_copy(t: LuaTable, copies: dict) -> LuaTable:
+	"""A copy of t and of the tables in it, sharing only frozen tables with the original."""
+	copy = copies.get(id(t))
+	if copy is not None:
+		return copy
+	copy = copies[id(t)] = t.copy()
+	if copy is t:
+		return t
+	for key, val in copy.items():
+		if isinstance(val, LuaTable):
+			copy.rawset(key, deep_copy(val, copies))
+	if copy.metatable is not None:
+		copy.metatable = deep_copy(copy.metatable, copies)
+	return copy
 
 
 class LuaEnv:
-	def __init__(self):
+	"""
+	Global variables of a running script.
+
+	An env can inherit from a parent env. Lookups that miss fall through to
+	the parent, while assignments always stay in the child. When the parent is
+	frozen the inherited values are cached in the child on first use, and
+	tables are copied at that point (along with the tables in them), so a
+	script changing e.g. `string` only changes its own copy.
+
+	Everything a script changes while it runs lives in its env (globals,
+	random generator, output buffer, budget), so scripts in separate envs
+	can run on separate threads at the same time. The base env is frozen
+	and only ever read, which lets all threads share it.
+	"""
+
+	_base = None
+	_base_lock = threading.Lock()
+
+	def __init__(self, parent: "LuaEnv" = None, seed: int = 0, output: LuaOutput | None = None):
 		self.globals = {}
+		self.parent = parent
+		self.frozen = False
+		# generator of math.random, seeded the same way every time unless the
+		# script calls math.randomseed, like in Lua
+		self.random = Random(seed)
+		# buffered stdout of print and io.write, see LuaOutput
+		self.output = output if output is not None else LuaOutput()
+		# accounting and collection behind collectgarbage
+		self.memory = LuaMemory(self)
+		# LuaBudget charged by the VM while this env runs, if any
+		self.budget = None
+		# LuaTracer notified of every instruction, only set when debugging
+		self.tracer = None
 
 	def get(self, name):
-		return self.globals.get(name.value, LuaNil())
+		val = self.globals.get(name.value)
+		if val is None:
+			return self.inherit(name.value)
+		return val
 
 	def set(self, name, val):
+		if self.frozen:
+			raise LuaError("attempt to modify a frozen environment")
 		self.globals[name.value] = val
 
+	def inherit(self, key: str):
+		if self.parent is None:
+			return LuaNil()
+
+		val = self.parent.get(LuaString(key))
+		if not self.parent.frozen or isinstance(val, LuaNil):
+			return val
+
+		if isinstance(val, LuaTable):
+			val = deep_copy(val, {})
+		self.globals[key] = val
+		return val
+
+	def freeze(self):
+		self.frozen = True
+		return self
+
+	def get_base():
+		# the standard library is only built once, every default env inherits it
+		if LuaEnv._base is None:
+			with LuaEnv._base_lock:
+				# another thread may have built it while this one waited
+				if LuaEnv._base is None:
+					env = LuaEnv()
+					env.globals.update({k: make_lua_type(v) for k, v in lua_globals.items()})
+					env.globals.update({ "io": make_lua_type(lua_iolib, copy=True) })
+					env.globals.update({ "json": make_lua_type(lua_jsonlib, copy=True) })
+					env.globals.update({ "math": make_lua_type(lua_mathlib, copy=True) })
+					env.globals.update({ "string": make_lua_type(lua_strlib, copy=True) })
+					env.globals.update({ "table": make_lua_type(lua_tablib, copy=True) })
+					LuaEnv._base = env.freeze()
+		return LuaEnv._base
+
 	def get_default():
-		# avoid circular import
-
-		env = LuaEnv()
-		env.globals = {}
-		env.globals.update({k: make_lua_type(v) for k, v in lua_globals.items()})
-		env.globals.update({ "math": make_lua_type(lua_mathlib) })
-		env.globals.update({ "string": make_lua_type(lua_strlib) })
-		env.globals.update({ "table": make_lua_type(lua_tablib) })
-		return env
+		return LuaEnv(LuaEnv.get_base())
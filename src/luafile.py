@@ -1,25 +1,59 @@
 from luatypes import *
 from luaenv import LuaEnv
+from luabudget import LuaBudget, LuaBudgetExceeded
+
+import luaopt
 
 import struct
 
 
 class LuaFile:
-	def __init__(self, filename: str, contents: str, env: LuaEnv = LuaEnv.get_default()):
+	def __init__(self, filename: str, contents: str, env: LuaEnv | None = None, optimize: bool = True):
 		self.filename = filename
 		self.contents = contents
 		self.func_proto_num = 0
 		self.position = 0
-		self.env = env
+		self.env = env if env is not None else LuaEnv.get_default()
 		self.read_header()
 		self.main_func = self.get_func()
+		self.set_source_names(self.main_func, filename)
+		if optimize:
+			luaopt.optimize(self.main_func)
 
-	def execute(self, args: list[LuaObject] = []):
+	def execute(self, args: list[LuaObject] = [], budget: LuaBudget | None = None):
 		from lvm import call_lua_function
+		# the budget only applies to this run
+		prev_budget = self.env.budget
+		if budget is not None:
+			self.env.budget = budget.start()
 		try:
 			return call_lua_function(self.main_func, self.env, args)
+		except LuaBudgetExceeded:
+			# the host has to know the script was stopped
+			raise
+		except LuaError as err:
+			# in order with the script's own output, and to the same sink
+			self.env.output.write(f"LuaError: {err}\n")
+		finally:
+			self.env.budget = prev_budget
+			self.env.output.flush()
+
+	async def execute_async(self, args: list[LuaObject] = [], budget: LuaBudget | None = None):
+		from lvm import call_lua_function_async
+		# the budget only applies to this run
+		prev_budget = self.env.budget
+		if budget is not None:
+			self.env.budget = budget.start()
+		try:
+			return await call_lua_function_async(self.main_func, self.env, args)
+		except LuaBudgetExceeded:
+			raise
 		except LuaError as err:
-			print("LuaError:", err)
+			# in order with the script's own output, and to the same sink
+			self.env.output.write(f"LuaError: {err}\n")
+		finally:
+			self.env.budget = prev_budget
+			self.env.output.flush()
 
 	def read(self, num_bytes: int = 1) -> bytes:
 		start = self.position
@@ -90,6 +124,12 @@ class LuaFile:
 		)
 		return func
 
+	def set_source_names(self, func: LuaFunction, source_name: str):
+		# luac only stores the source name once, in the main function
+		func.source_name = func.source_name or source_name
+		for proto in func.func_protos:
+			self.set_source_names(proto, func.source_name)
+
 	def read_header(self) -> None:
 		magic_bytes = self.get_bytes(4)
 		self.lua_version = self.get_byte()
@@ -53,6 +53,18 @@ INSTRUCT_DESCRIPTIONS = {
 }
 
 
+# superinstructions created by luaopt, outside of the 6 bit range of real opcodes
+SUPER_INSTRUCT_DESCRIPTIONS = {
+	0x40: ('getglobal+gettable', InstructKind.iABx),
+	0x41: ('loadk+arith',        InstructKind.iABx),
+	0x42: ('eq+jmp',             InstructKind.iABC),
+	0x43: ('lt+jmp',             InstructKind.iABC),
+	0x44: ('le+jmp',             InstructKind.iABC),
+	0x45: ('self+call',          InstructKind.iABC),
+	0x46: ('test+jmp',           InstructKind.iAC),
+}
+
+
 # BBBBBBBB BCCCCCCC CCAAAAAA AAOOOOOO
 OPCODE_OFFSET = 0
 OPCODE_SIZE = 6
@@ -71,6 +83,9 @@ C_MASK = ((1 << C_SIZE) - 1) << C_OFFSET
 
 
 class LuaInstruct:
+	# cleared by luaopt on forloop instructions whose loop variable is never read
+	loop_var_live = True
+
 	def __init__(self, raw: bytes):
 		self.raw_int = int.from_bytes(raw, "little")
 		self.raw = list(reversed(raw)) # little endian
@@ -126,3 +141,23 @@ class LuaInstruct:
 				res += "A, B, C"
 		res += ")"
 		return res
+
+
+class LuaSuperInstruct(LuaInstruct):
+	"""
+	Two consecutive instructions executed with a single dispatch.
+
+	Takes the place of the first instruction, keeping its operands, while the
+	second one stays where it was. The VM skips over it after running the
+	superinstruction, but jumps landing on it still find the original.
+	"""
+
+	def __init__(self, opcode: int, first: LuaInstruct, second: LuaInstruct):
+		self.raw_int = first.raw_int
+		self.raw = first.raw
+		self.opcode = opcode
+		self.A, self.B, self.C = first.A, first.B, first.C
+		self.Bx, self.sBx = first.Bx, first.sBx
+		self.first = first
+		self.second = second
+		self.name, self.kind = SUPER_INSTRUCT_DESCRIPTIONS[opcode]
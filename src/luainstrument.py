@@ -0,0 +1,207 @@
+from luatypes import *
+from luadebug import LuaTracer
+
+from collections import Counter
+import json
+import threading
+import time
+
+
+OPCODE_CLASSES = {
+	"move": "load", "loadk": "load", "loadbool": "load", "loadnil": "load",
+	"getupval": "upvalue", "setupval": "upvalue", "close": "upvalue", "closure": "upvalue",
+	"getglobal": "global", "setglobal": "global",
+	"gettable": "table", "settable": "table", "newtable": "table", "self": "table",
+	"setlist": "table", "len": "table",
+	"add": "arith", "sub": "arith", "mul": "arith", "div": "arith",
+	"mod": "arith", "pow": "arith", "unm": "arith",
+	"concat": "string",
+	"not": "branch", "jmp": "branch", "eq": "branch", "lt": "branch",
+	"le": "branch", "test": "branch", "testset": "branch",
+	"call": "call", "tailcall": "call", "return": "call", "vararg": "call",
+	"forloop": "loop", "forprep": "loop", "tforloop": "loop",
+	"getglobal+gettable": "table", "loadk+arith": "arith", "self+call": "call",
+	"eq+jmp": "branch", "lt+jmp": "branch", "le+jmp": "branch", "test+jmp": "branch",
+}
+
+# the counters are patched into the lua types, which is process-wide, so
+# the patches are installed once for all active instrumentations (which may
+# be on different threads) and count into each of them
+patch_lock = threading.Lock()
+active: tuple["LuaInstrumentation", ...] = ()
+originals = []
+
+
+def patch(cls, name: str, replacement):
+	originals.append((cls, name, cls.__dict__[name]))
+	setattr(cls, name, replacement)
+
+def patch_allocs(cls):
+	init = cls.__init__
+
+	def counted_init(obj, *args):
+		# by the class made, subclasses may share the init
+		for stats in active:
+			stats.allocs[type(obj).__name__] += 1
+		init(obj, *args)
+
+	patch(cls, "__init__", counted_init)
+
+def table_part(t, key) -> str:
+	if key in t.hash:
+		return "hash"
+	if isinstance(key, LuaNumber) and 1 <= key.value <= len(t.arr):
+		return "array"
+	return "miss"
+
+def table_set_part(t, key) -> str:
+	if isinstance(key, LuaNumber) and key.value.is_integer() and 1 <= key.value <= len(t.arr) + 1:
+		return "array"
+	return "hash"
+
+def weak_table_part(t, key) -> str:
+	# weak tables keep everything in the hash part
+	return "hash" if t.lookup_key(key) in t.hash else "miss"
+
+def proxy_table_part(t, key) -> str:
+	# looks at the host's object, the parts of a proxy would turn it into a table
+	return "miss" if t.lookup(key)[1] is None else "proxy"
+
+def patch_get_from(cls, part):
+	get_from = cls.__dict__["get_from"]
+
+	def counted_get_from(t, key):
+		name = part(t, key)
+		for stats in active:
+			stats.table_gets[name] += 1
+		return get_from(t, key)
+
+	patch(cls, "get_from", counted_get_from)
+
+def patch_set(cls, part):
+	set = cls.__dict__["set"]
+
+	def counted_set(t, key, val):
+		name = part(t, key)
+		for stats in active:
+			stats.table_sets[name] += 1
+		return set(t, key, val)
+
+	patch(cls, "set", counted_set)
+
+def patch_table_access():
+	# every class overriding get_from or set, since the overrides don't go through LuaTable's
+	patch_get_from(LuaTable, table_part)
+	patch_get_from(LuaNumberArray, table_part)
+	patch_get_from(LuaWeakTable, weak_table_part)
+	patch_get_from(LuaProxyTable, proxy_table_part)
+	# a proxy turns into a plain table on set, and sets through LuaTable's
+	patch_set(LuaTable, table_set_part)
+	patch_set(LuaWeakTable, lambda t, key: "hash")
+
+def install_patches():
+	patch_allocs(LuaNumber)
+	patch_allocs(LuaString)
+	patch_allocs(LuaRope)
+	patch_allocs(LuaTable)
+	patch_allocs(LuaProxyTable)
+	patch_table_access()
+
+def uninstall_patches():
+	for cls, name, original in reversed(originals):
+		setattr(cls, name, original)
+	originals.clear()
+
+
+class LuaInstrumentation(LuaTracer):
+	"""
+	Collects execution statistics for the scripts running in an env.
+
+	While active it counts executed opcodes and opcode pairs, the time spent
+	per opcode class, which part of a table served each get/set and how many
+	numbers, strings and tables were created. Opcodes are seen through the
+	tracer interface, the table and allocation counters are patched into the
+	lua types for as long as the instrumentation is active (which affects all
+	envs), so use it as a context manager:
+
+		with LuaInstrumentation(env) as stats:
+			call_lua_function(func, env, args)
+		print(stats.to_json())
+
+	Times include the overhead of tracing, so only compare them to each other.
+	"""
+
+	def __init__(self, env):
+		self.env = env
+		self.calls = 0
+		self.opcodes = Counter()
+		self.opcode_pairs = Counter()
+		self.class_time = Counter()
+		self.table_gets = Counter()
+		self.table_sets = Counter()
+		self.allocs = Counter()
+		self.prev_opcode = None
+		self.prev_time = None
+
+	def __enter__(self):
+		self.install()
+		return self
+
+	def __exit__(self, *exc):
+		self.uninstall()
+
+	def install(self):
+		global active
+		self.env.tracer = self
+		with patch_lock:
+			if not active:
+				install_patches()
+			active = active + (self,)
+
+	def uninstall(self):
+		global active
+		self.env.tracer = None
+		self.prev_opcode = None
+		with patch_lock:
+			if self not in active:
+				return
+			active = tuple(stats for stats in active if stats is not self)
+			if not active:
+				uninstall_patches()
+
+	def on_call(self, frame):
+		self.calls += 1
+
+	def on_instruction(self, frame):
+		now = time.perf_counter()
+		opcode = frame.func.instructs[frame.pc].name
+		if self.prev_opcode is not None:
+			self.opcode_pairs[(self.prev_opcode, opcode)] += 1
+			self.class_time[OPCODE_CLASSES.get(self.prev_opcode, "other")] += now - self.prev_time
+		self.opcodes[opcode] += 1
+		self.prev_opcode = opcode
+		# leave our own bookkeeping out of the next instruction's time
+		self.prev_time = time.perf_counter()
+
+	def to_dict(self) -> dict:
+		def hit_rates(counts: Counter) -> dict:
+			total = sum(counts.values())
+			return {part: {"count": n, "rate": n / total} for part, n in counts.items()}
+
+		return {
+			"calls": self.calls,
+			"instructions": sum(self.opcodes.values()),
+			"opcodes": dict(self.opcodes.most_common()),
+			"opcode_pairs": {f"{a} {b}": n for (a, b), n in self.opcode_pairs.most_common()},
+			"class_time": dict(self.class_time.most_common()),
+			"table_gets": hit_rates(self.table_gets),
+			"table_sets": hit_rates(self.table_sets),
+			"allocs": dict(self.allocs),
+		}
+
+	def to_json(self, **kwargs) -> str:
+		return json.dumps(self.to_dict(), **kwargs)
+
+	def write_json(self, filename: str):
+		with open(filename, "w") as f:
+			json.dump(self.to_dict(), f, indent="\t")
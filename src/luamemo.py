@@ -0,0 +1,97 @@
+from luatypes import *
+
+from collections import OrderedDict
+import threading
+
+
+DEFAULT_MAXSIZE = 128
+
+
+def memo_key(args: list[LuaObject]) -> tuple:
+	"""
+	A hashable key for a list of arguments. Strings and numbers are keyed by
+	value (the python types keep them apart, and booleans are tagged so true
+	isn't 1), anything else by identity. The objects themselves are part of
+	the key so their ids can't be reused while they're cached.
+	"""
+	key = []
+	for arg in args:
+		match arg:
+			case LuaNumber() | LuaString():
+				key.append(arg.value)
+			case LuaBoolean():
+				key.append((bool, arg.value))
+			case LuaNil():
+				key.append(None)
+			case _:
+				key.append((id(arg), arg))
+	return tuple(key)
+
+
+class LuaMemoCache:
+	"""
+	Least recently used cache of the results of a pure lua function.
+
+	The VM consults it before running a function that has one (`memo`), so
+	memoizing is transparent to the callers. Results are stored as they are:
+	a function returning a new table returns the same table on every hit.
+
+	A cache belongs to a function prototype, which scripts running on other
+	threads share, so it is guarded by a lock.
+	"""
+
+	def __init__(self, maxsize: int | None = DEFAULT_MAXSIZE):
+		self.maxsize = maxsize
+		self.results = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def get(self, key: tuple) -> tuple | None:
+		with self.lock:
+			res = self.results.get(key)
+			if res is None:
+				self.misses += 1
+				return None
+			self.results.move_to_end(key)
+			self.hits += 1
+			return res
+
+	def put(self, key: tuple, res: tuple):
+		with self.lock:
+			self.results[key] = res
+			if self.maxsize is not None and len(self.results) > self.maxsize:
+				self.results.popitem(last=False)
+
+	def clear(self):
+		with self.lock:
+			self.results.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {"hits": self.hits, "misses": self.misses, "size": len(self.results), "maxsize": self.maxsize}
+
+	def __repr__(self):
+		return f"LuaMemoCache({self.hits} hits, {self.misses} misses, {len(self.results)}/{self.maxsize})"
+
+
+def memoize(func: LuaFunction, maxsize: int | None = DEFAULT_MAXSIZE) -> LuaFunction:
+	"""A copy of func sharing its upvalues, whose results are cached."""
+	memoized = func.closure(func.upvals)
+	memoized.memo = LuaMemoCache(maxsize)
+	return memoized
+
+
+def mark_pure(proto: LuaFunction, maxsize: int | None = DEFAULT_MAXSIZE, recursive: bool = False):
+	"""
+	Declares that a function's results only depend on its arguments, so the
+	VM caches them. Closures made from the prototype later share the cache,
+	so their upvalues must not matter either. With recursive, the nested
+	prototypes are marked as well.
+	"""
+	proto.memo = LuaMemoCache(maxsize)
+	if recursive:
+		for nested in proto.func_protos:
+			mark_pure(nested, maxsize, recursive)
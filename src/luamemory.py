@@ -0,0 +1,86 @@
+from luatypes import *
+
+import gc
+import sys
+
+
+# python's collector has three generations, step runs one at a time
+GENERATIONS = 3
+
+
+def string_size(s: LuaString) -> int:
+	# don't join a rope just to measure it
+	if type(s) is LuaRope and s.flat is None:
+		return sys.getsizeof(s) + sys.getsizeof("") + s.size
+	return sys.getsizeof(s) + sys.getsizeof(s.value)
+
+def table_size(t: LuaTable) -> int:
+	return sys.getsizeof(t) + sys.getsizeof(t.__dict__) + sys.getsizeof(t.arr) + sys.getsizeof(t.hash)
+
+
+class LuaMemory:
+	"""
+	Memory accounting and collection for an env, behind `collectgarbage`.
+
+	Values are freed by python, mostly by reference counting as soon as the
+	last reference goes away (closed upvalues don't keep frames alive, and
+	weak tables let go of their entries). What's left are cycles between
+	tables and closures, which python's generational collector finds. `step`
+	runs it one generation at a time, so a script can spread the work over
+	its main loop instead of pausing for a full collection.
+
+	`usage` measures the tables and strings reachable from the globals of
+	the env, which takes time proportional to their number.
+	"""
+
+	def __init__(self, env):
+		self.env = env
+		self.generation = 0
+		self.stopped = False
+		# only stored, python's collector has its own thresholds
+		self.pause = 200
+		self.stepmul = 200
+
+	def usage(self) -> dict[str, int]:
+		"""Bytes in the tables and strings reachable from the env's globals."""
+		tables, strings = 0, 0
+		seen = set()
+		todo = list(self.env.globals.values())
+		while todo:
+			val = todo.pop()
+			if id(val) in seen:
+				continue
+			seen.add(id(val))
+			match val:
+				case LuaString():
+					strings += string_size(val)
+				case LuaProxyTable():
+					# the host's object, which the env doesn't own
+					tables += sys.getsizeof(val)
+				case LuaTable():
+					tables += table_size(val)
+					for key, item in val.items():
+						todo.append(key)
+						todo.append(item)
+					if val.metatable is not None:
+						todo.append(val.metatable)
+				case LuaFunction():
+					todo.extend(upval.get() for upval in val.upvals if upval is not None)
+		return {"tables": tables, "strings": strings}
+
+	def count(self) -> float:
+		"""Kilobytes in use, like collectgarbage("count")."""
+		return sum(self.usage().values()) / 1024
+
+	def collect(self):
+		gc.collect()
+		self.generation = 0
+
+	def step(self) -> bool:
+		"""Collects the next generation, True when that finished a full cycle."""
+		if self.stopped:
+			return False
+		gc.collect(self.generation)
+		finished = self.generation == GENERATIONS - 1
+		self.generation = (self.generation + 1) % GENERATIONS
+		return finished
@@ -0,0 +1,122 @@
+from luatypes import LuaFunction
+from luainst import LuaSuperInstruct
+
+
+ARITH_METHODS = {
+	0x0C: "op_add",
+	0x0D: "op_sub",
+	0x0E: "op_mul",
+	0x0F: "op_div",
+	0x10: "op_mod",
+	0x11: "op_pow",
+}
+
+# eq, lt, le and test followed by the jmp they guard
+BRANCHES = {
+	0x17: 0x42,
+	0x18: 0x43,
+	0x19: 0x44,
+	0x1A: 0x46,
+}
+
+
+# register number standing for "this register and all above it"
+OPEN_RANGE = 1 << 16
+
+
+def rk(val: int) -> list[int]:
+	return [] if val & 256 else [val]
+
+
+def registers_read(inst) -> list[int]:
+	"""Registers an instruction may read, OPEN_RANGE + n for open ranges starting at n."""
+	A, B, C = inst.A, inst.B, inst.C
+	match inst.opcode:
+		case 0x00 | 0x12 | 0x13 | 0x14 | 0x1B: # move, unm, not, len, testset
+			return [B]
+		case 0x06 | 0x0B: # gettable, self
+			return [B] + rk(C)
+		case 0x07 | 0x08 | 0x1A: # setglobal, setupval, test
+			return [A]
+		case 0x09: # settable
+			return [A] + rk(B) + rk(C)
+		case 0x0C | 0x0D | 0x0E | 0x0F | 0x10 | 0x11 | 0x17 | 0x18 | 0x19: # arith, compare
+			return rk(B) + rk(C)
+		case 0x15: # concat
+			return list(range(B, C + 1))
+		case 0x1C | 0x1D: # call, tailcall
+			return list(range(A, A + B)) if B > 0 else [OPEN_RANGE + A]
+		case 0x1E: # return
+			return list(range(A, A + B - 1)) if B > 0 else [OPEN_RANGE + A]
+		case 0x1F | 0x20 | 0x21: # forloop, forprep, tforloop
+			return [A, A + 1, A + 2]
+		case 0x22: # setlist
+			return list(range(A, A + B + 1)) if B > 0 else [OPEN_RANGE + A]
+	return []
+
+
+def mark_dead_loop_vars(func: LuaFunction):
+	"""Lets forloop skip writing the loop variable when the body never reads it."""
+	instructs = func.instructs
+	for pc, inst in enumerate(instructs):
+		if inst.opcode != 0x1F:
+			continue
+
+		var = inst.A + 3
+		body = instructs[pc + 1 + inst.sBx:pc]
+		if not any(
+			reg == var or (reg >= OPEN_RANGE and reg - OPEN_RANGE <= var)
+			for body_inst in body
+			for reg in registers_read(body_inst)
+		):
+			inst.loop_var_live = False
+
+
+def fused_opcode(first, second) -> int | None:
+	match first.opcode, second.opcode:
+		case 0x05, 0x06: # getglobal + gettable, as in `math.floor`
+			return 0x40
+		case 0x01, op if op in ARITH_METHODS: # loadk + arith
+			return 0x41
+		case op, 0x16 if op in BRANCHES: # compare + jmp
+			return BRANCHES[op]
+		case 0x0B, 0x1C: # self + call, as in `obj:method()`
+			return 0x45
+	return None
+
+
+def optimize(func: LuaFunction) -> LuaFunction:
+	"""
+	Peephole pass fusing common instruction pairs into superinstructions,
+	which also marks numeric for loops that don't read their loop variable.
+
+	A superinstruction replaces only the first instruction of its pair and
+	the second one is left in place, so the number of instructions, every
+	jump offset and `line_positions` stay valid. Works in place on the
+	function and all of its prototypes.
+	"""
+	# needs to see the plain instructions, so it runs before fusing
+	mark_dead_loop_vars(func)
+
+	instructs = func.instructs
+	pc = 0
+	while pc < len(instructs) - 1:
+		inst = instructs[pc]
+
+		# the word after a setlist with C = 0 is its block number, not an instruction
+		if inst.opcode == 0x22 and inst.C == 0:
+			pc += 2
+			continue
+
+		opcode = fused_opcode(inst, instructs[pc + 1])
+		if opcode is not None:
+			fused = LuaSuperInstruct(opcode, inst, instructs[pc + 1])
+			if opcode == 0x41:
+				fused.arith_method = ARITH_METHODS[instructs[pc + 1].opcode]
+			instructs[pc] = fused
+			pc += 1
+		pc += 1
+
+	for proto in func.func_protos:
+		optimize(proto)
+	return func
@@ -0,0 +1,66 @@
+import io
+import sys
+
+
+DEFAULT_BUFFER_SIZE = 1 << 16
+
+
+class LuaOutput:
+	"""
+	Where `print` and `io.write` of an env end up.
+
+	Writes are collected in a buffer and handed to the sink in one piece once
+	`buffer_size` characters are pending, when the script flushes
+	(`io.flush`, `io.stdout:flush`), before it reads from stdin and when
+	`LuaFile.execute` returns. A buffer size of 0 writes through.
+
+	The sink can be a text stream, a binary stream, anything with `sendall`
+	like a socket, or None for whatever `sys.stdout` is at the time of the
+	flush. To capture the output of a script:
+
+		env = LuaEnv.get_default()
+		env.output = LuaOutput.capture()
+		luafile.execute()
+		text = env.output.getvalue()
+	"""
+
+	def __init__(self, sink=None, buffer_size: int = DEFAULT_BUFFER_SIZE, encoding: str = "utf-8"):
+		self.sink = sink
+		self.buffer_size = buffer_size
+		self.encoding = encoding
+		self.pending = []
+		self.pending_size = 0
+
+	def capture(buffer_size: int = DEFAULT_BUFFER_SIZE) -> "LuaOutput":
+		return LuaOutput(io.StringIO(), buffer_size)
+
+	def write(self, text: str):
+		self.pending.append(text)
+		self.pending_size += len(text)
+		if self.pending_size >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		if not self.pending:
+			return
+		text = "".join(self.pending)
+		self.pending.clear()
+		self.pending_size = 0
+
+		sink = self.sink if self.sink is not None else sys.stdout
+		if isinstance(sink, io.TextIOBase):
+			sink.write(text)
+		elif isinstance(sink, (io.BufferedIOBase, io.RawIOBase)):
+			sink.write(text.encode(self.encoding, "surrogateescape"))
+		elif hasattr(sink, "sendall"):
+			sink.sendall(text.encode(self.encoding, "surrogateescape"))
+		else:
+			sink.write(text)
+		if hasattr(sink, "flush"):
+			sink.flush()
+
+	def getvalue(self) -> str:
+		"""Everything written so far, for sinks that keep it like io.StringIO."""
+		self.flush()
+		value = self.sink.getvalue()
+		return value.decode(self.encoding, "surrogateescape") if isinstance(value, bytes) else value
@@ -0,0 +1,183 @@
+from luatypes import *
+from luaenv import LuaEnv
+from luafile import LuaFile
+from luabudget import LuaBudget
+
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import gc
+import multiprocessing
+import threading
+
+
+# set in each worker by _init_worker, inherited from the parent through fork
+_worker_files: dict[str, LuaFile] = {}
+_worker_env: LuaEnv = None
+
+
+# executors that need the collector frozen, which is process-wide state, so
+# it's only unfrozen once the last of them is closed
+_freeze_lock = threading.Lock()
+_freezes = 0
+
+
+def _freeze_gc():
+	global _freezes
+	with _freeze_lock:
+		# keep the collector from touching (and so copying) the preloaded objects,
+		# freezing again for the objects of every new executor
+		gc.collect()
+		gc.freeze()
+		_freezes += 1
+
+
+def _unfreeze_gc():
+	global _freezes
+	with _freeze_lock:
+		_freezes -= 1
+		if _freezes == 0:
+			gc.unfreeze()
+
+
+def _init_worker(files: dict[str, LuaFile], env: LuaEnv):
+	global _worker_files, _worker_env
+	_worker_files = files
+	_worker_env = env
+
+
+def run_script(files: dict[str, LuaFile], base: LuaEnv, script: str, args: tuple, budget: LuaBudget | None = None) -> list:
+	from lvm import call_lua_function
+	if script not in files:
+		raise LuaError(f"unknown script '{script}'")
+
+	# every job gets its own globals, so scripts can't see each other's state
+	env = LuaEnv(base)
+	if budget is not None:
+		# jobs running at the same time each count against their own copy
+		env.budget = copy.copy(budget).start()
+	lua_args = [make_lua_type(a) for a in args]
+	try:
+		res = call_lua_function(files[script].main_func, env, lua_args)
+	finally:
+		# what the script printed is lost with its env otherwise
+		env.output.flush()
+	return [make_py_type(r) for r in res or ()]
+
+
+def _run_job(script: str, args: tuple, budget: LuaBudget | None = None) -> list:
+	return run_script(_worker_files, _worker_env, script, args, budget)
+
+
+class LuaExecutor:
+	"""
+	Runs lua scripts on a pool of forked worker processes.
+
+	The scripts are parsed and the default environment is built once in the
+	parent before forking, so the workers share them copy-on-write instead of
+	re-reading the bytecode for every job. Arguments and results are converted
+	from and to plain python values.
+	"""
+
+	def __init__(
+		self,
+		scripts: dict[str, str | bytes | LuaFile],
+		processes: int | None = None,
+		max_jobs_per_worker: int | None = None,
+	):
+		self.files = {}
+		for name, script in scripts.items():
+			self.files[name] = self.load(name, script)
+		self.env = LuaEnv.get_base()
+
+		_freeze_gc()
+		self.frozen = True
+
+		# with fork the initargs are inherited by the workers, not pickled
+		ctx = multiprocessing.get_context("fork")
+		self.pool = ctx.Pool(
+			processes,
+			initializer=_init_worker,
+			initargs=(self.files, self.env),
+			maxtasksperchild=max_jobs_per_worker,
+		)
+
+	def load(self, name: str, script: str | bytes | LuaFile) -> LuaFile:
+		if isinstance(script, LuaFile):
+			return script
+		if isinstance(script, str):
+			with open(script, "rb") as f:
+				script = f.read()
+		return LuaFile(name, script)
+
+	def submit(self, script: str, args: tuple = (), budget: LuaBudget | None = None):
+		return self.pool.apply_async(_run_job, (script, tuple(args), budget))
+
+	def execute(self, script: str, args: tuple = (), budget: LuaBudget | None = None) -> list:
+		return self.submit(script, args, budget).get()
+
+	def map(self, script: str, args_list: list[tuple], budget: LuaBudget | None = None) -> list[list]:
+		return self.pool.starmap(_run_job, [(script, tuple(args), budget) for args in args_list])
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+		self.unfreeze()
+
+	def terminate(self):
+		self.pool.terminate()
+		self.pool.join()
+		self.unfreeze()
+
+	def unfreeze(self):
+		if self.frozen:
+			self.frozen = False
+			_unfreeze_gc()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class LuaThreadExecutor(LuaExecutor):
+	"""
+	Runs lua scripts on a pool of threads in this process, for embedding in
+	threaded servers.
+
+	The parsed scripts and the frozen base environment are shared by all
+	threads, since running a script never changes them: each job gets its
+	own env, and with it its own globals, random generator, output buffer
+	and budget. With the GIL only one thread runs lua code at a time, so
+	this pays off on free-threaded builds of python or when scripts wait on
+	host functions.
+
+	Results are converted to python values like LuaExecutor's, but they
+	aren't pickled, so proxies of host data come back as the objects
+	themselves.
+	"""
+
+	def __init__(self, scripts: dict[str, str | bytes | LuaFile], threads: int | None = None):
+		self.files = {}
+		for name, script in scripts.items():
+			self.files[name] = self.load(name, script)
+		self.env = LuaEnv.get_base()
+		self.pool = ThreadPoolExecutor(threads, thread_name_prefix="lua")
+
+	def submit(self, script: str, args: tuple = (), budget: LuaBudget | None = None):
+		if budget is not None and budget.max_memory is not None:
+			raise ValueError("memory budgets apply to the whole process, they can't limit jobs running on threads")
+		return self.pool.submit(run_script, self.files, self.env, script, tuple(args), budget)
+
+	def execute(self, script: str, args: tuple = (), budget: LuaBudget | None = None) -> list:
+		return self.submit(script, args, budget).result()
+
+	def map(self, script: str, args_list: list[tuple], budget: LuaBudget | None = None) -> list[list]:
+		futures = [self.submit(script, args, budget) for args in args_list]
+		return [future.result() for future in futures]
+
+	def close(self):
+		self.pool.shutdown(wait=True)
+
+	def terminate(self):
+		self.pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,127 @@
+from lvm import execute_lua_function
+
+from collections import Counter
+import sys
+import threading
+import time
+
+
+def function_label(lua_func) -> str:
+	source = lua_func.source_name.lstrip("@=") or "?"
+	if lua_func.first_line_num == 0:
+		return f"{source}:main"
+	return f"{source}:{lua_func.first_line_num}"
+
+
+class LuaProfiler:
+	"""
+	Sampling profiler for lua code.
+
+	A background thread periodically looks at the python stack of the thread
+	running the VM and picks out the frames of `execute_lua_function`, whose
+	`lua_func` and `pc` locals give the lua call stack and the current line.
+	The VM itself isn't slowed down by this. Samples can't be taken more often
+	than the interpreter switches threads (see `sys.setswitchinterval`), so
+	each sample is weighted with the time that actually passed since the
+	previous one.
+	"""
+
+	def __init__(self, interval: float = 0.005):
+		self.interval = interval
+		# lua stacks from the outermost call inwards, each entry is (function label, line)
+		self.samples = Counter()
+		self.seconds = Counter()
+		self.thread_id = None
+		self.running = False
+		self.sampler = None
+
+	def start(self, thread_id: int | None = None):
+		self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+		self.running = True
+		self.sampler = threading.Thread(target=self.run, daemon=True)
+		self.sampler.start()
+		return self
+
+	def stop(self):
+		self.running = False
+		if self.sampler is not None:
+			self.sampler.join()
+			self.sampler = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	def run(self):
+		last = time.perf_counter()
+		while self.running:
+			time.sleep(self.interval)
+			stack = self.sample()
+			now = time.perf_counter()
+			if stack:
+				self.samples[stack] += 1
+				self.seconds[stack] += now - last
+			last = now
+
+	def sample(self) -> tuple:
+		frame = sys._current_frames().get(self.thread_id)
+		stack = []
+		while frame is not None:
+			if frame.f_code is execute_lua_function.__code__:
+				f_locals = frame.f_locals
+				lua_func, pc = f_locals.get("lua_func"), f_locals.get("pc", 0)
+				if lua_func is not None:
+					lines = lua_func.line_positions
+					line = lines[pc] if pc < len(lines) else None
+					stack.append((function_label(lua_func), line))
+			frame = frame.f_back
+		return tuple(reversed(stack))
+
+	def collapsed(self, lines: bool = False) -> str:
+		"""Stacks in the collapsed format read by flamegraph.pl and speedscope."""
+		folded = Counter()
+		for stack, count in self.samples.items():
+			if lines:
+				names = [f"{label} line {line}" for label, line in stack]
+			else:
+				names = [label for label, _ in stack]
+			folded[";".join(names)] += count
+		return "\n".join(f"{names} {count}" for names, count in folded.most_common())
+
+	def write_collapsed(self, filename: str, lines: bool = False):
+		with open(filename, "w") as f:
+			f.write(self.collapsed(lines) + "\n")
+
+	def function_stats(self) -> list[dict]:
+		"""Self and total time spent in every function, by self time."""
+		own = Counter()
+		total = Counter()
+		for stack, seconds in self.seconds.items():
+			own[stack[-1][0]] += seconds
+			# recursive calls only count once per sample
+			for label in {label for label, _ in stack}:
+				total[label] += seconds
+
+		stats = [
+			{"function": label, "self": own[label], "total": seconds}
+			for label, seconds in total.items()
+		]
+		return sorted(stats, key=lambda s: (s["self"], s["total"]), reverse=True)
+
+	def line_stats(self) -> list[dict]:
+		"""Time spent on every line of lua code, excluding the functions it calls."""
+		own = Counter()
+		for stack, seconds in self.seconds.items():
+			own[stack[-1]] += seconds
+		return [
+			{"function": label, "line": line, "self": seconds}
+			for (label, line), seconds in own.most_common()
+		]
+
+	def report(self) -> str:
+		res = f"{'self':>9} {'total':>9}  function\n"
+		for stat in self.function_stats():
+			res += f"{stat['self']:8.3f}s {stat['total']:8.3f}s  {stat['function']}\n"
+		return res
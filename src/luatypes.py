@@ -1,4 +1,9 @@
-from functools import reduce
+from array import array
+from collections.abc import Mapping
+from contextvars import ContextVar
+from functools import partial, reduce
+from inspect import iscoroutinefunction
+import weakref
 
 from fbyte import decode_fbyte
 from luainst import InstructKind, LuaInstruct
@@ -6,24 +11,61 @@ from luainst import InstructKind, LuaInstruct
 
 class LuaError(Exception):
 	def __init__(self, msg: str):
+		super().__init__(msg)
 		self.msg = msg
 
 
-def maybe_attempt_op(op_name: str, left, right):
+def maybe_attempt_op(op_name: str, left, right) -> bool:
+	"""Raises if the operands can't do op_name, returns True if a metamethod has to do it."""
 	left_type = type(left)
 	right_type = type(right)
 
+	if left_type is LuaNumber and right_type is LuaNumber:
+		return False
+	if (left.metatable is not None or right.metatable is not None) and find_metamethod(left, right, "__" + op_name):
+		return True
 	if left_type in NO_ARITHMETIC:
 		raise LuaError(f"attempt to perform arithmetic on a {left_type.name} value")
 	if right_type in NO_ARITHMETIC:
 		raise LuaError(f"attempt to perform arithmetic on a {right_type.name} value")
 	if left_type in NO_MATHOPS or right_type in NO_MATHOPS or left_type != right_type:
 		raise LuaError(f"attempt to {op_name} a '{left_type.name}' with a '{right_type.name}'")
+	return False
+
+
+def find_metamethod(left, right, event: str):
+	"""The metamethod for event of the first operand that has one, like Lua's binary events."""
+	for operand in (left, right):
+		if operand.metatable is not None:
+			handler = operand.metatable.metamethod(event)
+			if handler is not None:
+				return operand.metatable, handler
+	return None
+
+# the env of the script running in this thread (or task), set by the VM's
+# drivers, which metamethods run in since operators aren't passed an env
+running_env = ContextVar("running_env", default=None)
+
+def call_metamethod(metatable, handler, args: list) -> "LuaObject":
+	"""Calls a metamethod with the running env, returning its first result."""
+	env = running_env.get()
+	if env is None:
+		# triggered by the host outside of any script
+		from luaenv import LuaEnv
+		env = LuaEnv.get_default()
+	res = handler.call(env, args)
+	return res[0] if res else LuaNil()
+
+def arith_metamethod(op_name: str, left, right) -> "LuaObject":
+	metatable, handler = find_metamethod(left, right, "__" + op_name)
+	return call_metamethod(metatable, handler, [left, right])
 
 
 class LuaObject:
 	name: str = "object"
 	value: any = None
+	# only tables have metatables, see LuaTable.set_metatable
+	metatable = None
 
 	def tostring(self): return LuaString(f"{self.name}: 0x{id(self):x}")
 	def tonumber(self): return LuaNil()
@@ -40,42 +82,45 @@ class LuaObject:
 		return LuaNil()
 
 	def op_add(self, other) -> any:
-		maybe_attempt_op("add", self, other)
+		if maybe_attempt_op("add", self, other):
+			return arith_metamethod("add", self, other)
 		return type(self)(self.value + other.value)
 
 	def op_sub(self, other) -> any:
-		maybe_attempt_op("sub", self, other)
+		if maybe_attempt_op("sub", self, other):
+			return arith_metamethod("sub", self, other)
 		return type(self)(self.value - other.value)
 
 	def op_mul(self, other) -> any:
-		maybe_attempt_op("mul", self, other)
+		if maybe_attempt_op("mul", self, other):
+			return arith_metamethod("mul", self, other)
 		return type(self)(self.value * other.value)
 
 	def op_div(self, other) -> any:
-		maybe_attempt_op("div", self, other)
+		if maybe_attempt_op("div", self, other):
+			return arith_metamethod("div", self, other)
 		return type(self)(self.value / other.value)
 
 	def op_mod(self, other) -> any:
-		maybe_attempt_op("mod", self, other)
+		if maybe_attempt_op("mod", self, other):
+			return arith_metamethod("mod", self, other)
 		return type(self)(self.value % other.value)
 
 	def op_pow(self, other) -> any:
-		maybe_attempt_op("pow", self, other)
+		if maybe_attempt_op("pow", self, other):
+			return arith_metamethod("pow", self, other)
 		return type(self)(self.value ** other.value)
 
 	def op_unm(self) -> any:
-		maybe_attempt_op("unm", self, self)
+		if maybe_attempt_op("unm", self, self):
+			return arith_metamethod("unm", self, self)
 		return type(self)(-self.value)
 
 	def op_not(self) -> any:
 		return LuaBoolean(False)
 
 	def op_concat(self, other) -> any:
-		left_type = type(self)
-		right_type = type(other)
-		if LuaString not in [left_type, right_type]:
-			raise LuaError(f"attempt to concat a '{left_type.name}' with a '{right_type.name}'")
-		return LuaString(self.tostring().value + other.tostring().value)
+		return lua_concat([self, other])
 	
 	def bool(self) -> bool:
 		return True
@@ -123,10 +168,7 @@ class LuaNumber(LuaObject):
 		self.value = float(value)
 
 	def tostring(self):
-		if self.value.is_integer():
-			return LuaString(str(int(self.value)))
-		else:
-			return LuaString(str(self.value))
+		return LuaString(f"{self.value:.14g}")
 
 	def tonumber(self):
 		return LuaNumber(self.value)
@@ -147,16 +189,78 @@ class LuaString(LuaObject):
 	def tonumber(self):
 		try:
 			return LuaNumber(float(self.value))
+		except ValueError:
+			pass
+		# like Lua's str2d, fall back to a hex integer
+		value = self.value.strip()
+		if value.lstrip("+-")[:2] not in ("0x", "0X"):
+			return LuaNil()
+		try:
+			return LuaNumber(int(value, 16))
 		except ValueError:
 			return LuaNil()
 	
 	def op_len(self):
 		return LuaNumber(len(self.value))
 
+	# ropes are strings too, so compare by isinstance rather than exact type
+	def __eq__(self, other):
+		return isinstance(other, LuaString) and self.value == other.value
+	def __ne__(self, other):
+		return isinstance(other, LuaString) and self.value != other.value
+	def __lt__(self, other):
+		return isinstance(other, LuaString) and self.value < other.value
+	def __le__(self, other):
+		return isinstance(other, LuaString) and self.value <= other.value
+	def __gt__(self, other):
+		return isinstance(other, LuaString) and self.value > other.value
+	def __ge__(self, other):
+		return isinstance(other, LuaString) and self.value >= other.value
+
+	def __hash__(self): return hash(self.value)
+
 	def __str__(self): return f'"{self.value}"'
 	def __repr__(self): return f'LuaString("{self.value}")'
 
 
+class LuaRope(LuaString):
+	"""
+	A string made by concatenation, only joined once its value is needed.
+
+	Ropes made by appending to each other share one list of parts, each rope
+	owning the first `length` of them. Appending to the rope that owns the
+	whole list extends it in place, so `s = s .. x` in a loop doesn't copy
+	the string built so far; appending to an older rope copies its parts.
+	"""
+
+	def __init__(self, parts: list[str], size: int):
+		self.parts = parts
+		self.length = len(parts)
+		self.size = size
+		self.flat = None
+
+	@property
+	def value(self) -> str:
+		if self.flat is None:
+			self.flat = "".join(self.parts[:self.length])
+			# let go of the shared list, later appends start from the flat string
+			self.parts = [self.flat]
+			self.length = 1
+		return self.flat
+
+	def append(self, more: list[str], size: int):
+		parts = self.parts
+		if self.length != len(parts):
+			parts = parts[:self.length]
+		parts.extend(more)
+		return LuaRope(parts, self.size + size)
+
+	def op_len(self):
+		return LuaNumber(self.size)
+
+	def __repr__(self): return f'LuaRope("{self.value}")'
+
+
 class LuaBoolean(LuaObject):
 	name = "boolean"
 
@@ -175,75 +279,770 @@ class LuaBoolean(LuaObject):
 
 
 class LuaTable(LuaObject):
+	"""
+	A table, split into an array part for the keys 1..n and a hash part.
+
+	The array part never ends in nil and the key n + 1 is never in the hash
+	part, so n is always a border and `#t` is just the length of `arr`. It can
+	have holes (LuaNil) in the middle, which is fine since any border is a
+	valid length in Lua.
+
+	A table with a metatable only looks at it when a get misses or a set
+	would add a new key (and for operators plain tables don't support), so
+	tables without one don't pay for metatables.
+	"""
+
 	name = "table"
+	# snapshot of the hash keys for a traversal with next, see traversal
+	order = None
 
 	def __init__(self, arr_size: int, hash_size: int):
+		# the sizes are only hints from the compiler, python lists and dicts grow on their own
 		self.arr_size = arr_size
 		self.hash_size = hash_size
 
-		self.arr = [LuaNil()] * arr_size
+		self.arr = []
 		self.hash = {}
 
 	def get_from(self, key: LuaString | LuaNumber):
-		if key in self.hash.keys():
-			return self.hash[key]
-		elif isinstance(key, LuaNumber) and 0 <= key.value < len(self.arr):
-			return self.arr[int(key.value)]
-		else:
+		if type(key) is LuaNumber:
+			idx = key.value
+			if 1 <= idx <= len(self.arr) and idx.is_integer():
+				return self.arr[int(idx) - 1]
+		val = self.hash.get(key)
+		if val is None:
+			return LuaNil() if self.metatable is None else self.index_meta(key)
+		return val
+
+	def rawget(self, key: LuaObject) -> LuaObject:
+		if type(key) is LuaNumber:
+			idx = key.value
+			if 1 <= idx <= len(self.arr) and idx.is_integer():
+				return self.arr[int(idx) - 1]
+		val = self.hash.get(key)
+		return LuaNil() if val is None else val
+
+	def index_meta(self, key: LuaObject) -> LuaObject:
+		handler = self.metatable.metamethod("__index")
+		if handler is None:
 			return LuaNil()
+		# a table as __index is indexed in turn, which is how class hierarchies chain
+		if isinstance(handler, LuaTable):
+			return handler.get_from(key)
+		return call_metamethod(self.metatable, handler, [self, key])
+
+	def newindex_meta(self, key: LuaObject, val: LuaObject) -> bool:
+		"""Runs __newindex for a key the table doesn't have, True if it did."""
+		handler = self.metatable.metamethod("__newindex")
+		if handler is None or type(self.rawget(key)) is not LuaNil:
+			return False
+		if isinstance(handler, LuaTable):
+			handler.set(key, val)
+		else:
+			call_metamethod(self.metatable, handler, [self, key, val])
+		return True
+
+	def set_metatable(self, metatable: "LuaTable | None"):
+		"""
+		Sets the metatable. Plain tables used as metatables become a
+		LuaMetatable, which caches the metamethods.
+		"""
+		# a table with a metatable is never packed, the packed one ignores it
+		if type(self) is LuaNumberArray and metatable is not None:
+			self.unpack_numbers()
+		if type(metatable) is LuaNumberArray:
+			metatable.unpack_numbers()
+		if type(metatable) is LuaTable:
+			metatable.__class__ = LuaMetatable
+			metatable.cache = {}
+		self.metatable = metatable
+
+	def metamethod(self, event: str) -> LuaObject | None:
+		"""The metamethod for event if this table is used as a metatable."""
+		return self.hash.get(LuaString(event))
+
+	def copy(self):
+		t = LuaTable(0, 0)
+		t.arr = list(self.arr)
+		t.hash = dict(self.hash)
+		t.metatable = self.metatable
+		return t
 
 	def items(self):
-		items = [(LuaNumber(i + 1), v) for i, v in enumerate(self.arr)]
+		items = [(LuaNumber(i + 1), v) for i, v in enumerate(self.arr) if type(v) is not LuaNil]
 		items.extend(self.hash.items())
 		return items
 
 	def keys(self):
-		keys = [LuaNumber(i + 1) for i, _ in enumerate(self.arr)]
+		keys = [LuaNumber(i + 1) for i, v in enumerate(self.arr) if type(v) is not LuaNil]
 		keys.extend(self.hash.keys())
 		return keys
 
 	def values(self):
-		values = self.arr
+		values = [v for v in self.arr if type(v) is not LuaNil]
 		values.extend(self.hash.values())
 		return values
 
-	def set_hash(self, key: LuaString, val: any):
-		self.hash.update({key: val})
-	
-	def set_arr(self, idx: LuaNumber, val: any):
-		if idx.value - 1 == len(self.arr):
-			self.arr.append(val)
+	def next(self, key: LuaObject) -> tuple[LuaObject, LuaObject] | None:
+		"""The key and value after key (the first ones for nil), None after the last."""
+		i = self.array_position(key)
+		if i is None:
+			return self.next_in_hash(key)
+		arr = self.arr
+		while i < len(arr):
+			val = arr[i]
+			if type(val) is not LuaNil:
+				return LuaNumber(i + 1), val
+			i += 1
+		return self.next_in_hash(None)
+
+	def array_position(self, key: LuaObject) -> int | None:
+		"""Where a traversal continues in the array part after key, None if key is in the hash part."""
+		if type(key) is LuaNil:
+			return 0
+		if type(key) is not LuaNumber or not key.value.is_integer() or key.value < 1:
+			return None
+		if key.value <= len(self.arr):
+			return int(key.value)
+		# the array part may have shrunk since key was returned
+		if key not in self.hash and (self.order is None or key not in self.order[1]):
+			return int(key.value)
+		return None
+
+	def next_in_hash(self, key: LuaObject | None) -> tuple[LuaObject, LuaObject] | None:
+		keys, i = self.traversal(key)
+		hash = self.hash
+		while i < len(keys):
+			val = hash.get(keys[i])
+			if val is not None:
+				return keys[i], val
+			i += 1
+		self.order = None
+		return None
+
+	def traversal(self, key) -> tuple[list, int]:
+		"""
+		The hash keys a traversal goes through and the position after key.
+		They are snapshotted when a traversal starts (or key isn't in the
+		snapshot), so each step is a dict lookup instead of a search. Keys
+		removed since are skipped by the callers.
+		"""
+		order = self.order
+		if key is None or order is None or key not in order[1]:
+			keys = self.hash_keys()
+			order = self.order = (keys, {k: i for i, k in enumerate(keys)})
+			if key is None:
+				return keys, 0
+			if key not in order[1]:
+				raise LuaError("invalid key to 'next'")
+		return order[0], order[1][key] + 1
+
+	def hash_keys(self) -> list:
+		return list(self.hash)
+
+	def set_hash(self, key: LuaObject, val: LuaObject):
+		if val is None or type(val) is LuaNil:
+			self.hash.pop(key, None)
+			return
+		if type(key) is LuaNil:
+			raise LuaError("table index is nil")
+		self.hash[key] = val
+
+	def set_arr(self, idx: int, val: LuaObject):
+		"""Sets t[idx] for 1 <= idx <= #t + 1."""
+		arr = self.arr
+		if val is None or type(val) is LuaNil:
+			if idx <= len(arr):
+				arr[idx - 1] = LuaNil()
+				self.trim()
+		elif idx > len(arr):
+			arr.append(val)
+			self.take_from_hash()
 		else:
-			self.arr[int(idx.value - 1)] = val
-	
-	def set(self, key: LuaString | LuaNumber, val: any):
-		if isinstance(key, LuaString) or not key.value.is_integer():
-			self.set_hash(key, val)
+			arr[idx - 1] = val
+
+	def insert(self, idx: int, val: LuaObject):
+		"""Inserts at 1 <= idx <= #t + 1, moving the elements after it up."""
+		if idx > len(self.arr):
+			self.set_arr(idx, val)
 		else:
-			if key.value <= self.op_len().value + 1:
-				self.set_arr(key, val)
-			else:
-				self.set_hash(key, val)
+			self.arr.insert(idx - 1, LuaNil() if val is None else val)
+			self.take_from_hash()
+
+	def remove(self, idx: int) -> LuaObject:
+		"""Removes and returns t[idx] for 1 <= idx <= #t, moving the elements after it down."""
+		val = self.arr.pop(idx - 1)
+		self.trim()
+		return val
+
+	def trim(self):
+		# the array part must not end in nil
+		arr = self.arr
+		while arr and type(arr[-1]) is LuaNil:
+			arr.pop()
+
+	def take_from_hash(self):
+		# after the array part grew, the keys following it may be waiting in the hash part
+		arr, hash = self.arr, self.hash
+		while hash:
+			val = hash.pop(LuaNumber(len(arr) + 1), None)
+			if val is None:
+				break
+			arr.append(val)
+
+	def set(self, key: LuaString | LuaNumber, val: LuaObject):
+		if self.metatable is not None and self.newindex_meta(key, val):
+			return
+		if type(key) is LuaNumber:
+			idx = key.value
+			if 1 <= idx <= len(self.arr) + 1 and idx.is_integer():
+				self.set_arr(int(idx), val)
+				return
+		self.set_hash(key, val)
+
+	def rawset(self, key: LuaObject, val: LuaObject):
+		if type(key) is LuaNumber:
+			idx = key.value
+			if 1 <= idx <= len(self.arr) + 1 and idx.is_integer():
+				self.set_arr(int(idx), val)
+				return
+		self.set_hash(key, val)
 
 	def op_len(self):
-		keys = self.keys()
-		arr_keys = list(sorted(k for k in keys if isinstance(k, LuaNumber)))
-		i = 0
-		for k in arr_keys:
-			if k.value < i: continue
+		return LuaNumber(len(self.arr))
+
+	def call(self, env, args):
+		handler = self.metatable.metamethod("__call") if self.metatable is not None else None
+		if handler is None:
+			raise LuaError("attempt to call a table value")
+		return handler.call(env, [self, *args])
+
+	def tostring(self):
+		if self.metatable is not None:
+			handler = self.metatable.metamethod("__tostring")
+			if handler is not None:
+				return call_metamethod(self.metatable, handler, [self])
+		return LuaString(f"table: 0x{id(self):x}")
+
+	def compare_meta(self, other, event: str) -> bool:
+		# like Lua 5.1, both operands need the same metamethod
+		mine = self.metatable.metamethod(event) if self.metatable is not None else None
+		theirs = other.metatable.metamethod(event) if other.metatable is not None else None
+		if mine is None or mine is not theirs:
+			return None
+		return call_metamethod(self.metatable, mine, [self, other]).bool()
+
+	def set_mode(self, weak_keys: bool, weak_values: bool):
+		"""Makes the table weak (see LuaWeakTable) or strong again, for `__mode`."""
+		items = self.items()
+		self.arr = []
+		self.hash = {}
+		self.order = None
+		if weak_keys or weak_values:
+			self.__class__ = LuaWeakTable
+			self.weak_keys = weak_keys
+			self.weak_values = weak_values
+			self.selfref = weakref.ref(self)
+		else:
+			self.__class__ = LuaTable
+		for key, val in items:
+			self.rawset(key, val)
+
+	def freeze(self) -> "LuaFrozenTable":
+		"""Makes the table read-only, see LuaFrozenTable."""
+		if type(self) is LuaNumberArray:
+			self.unpack_numbers()
+		self.__class__ = LuaFrozenTable
+		self.cache = {}
+		return self
+
+	def pack_numbers(self) -> bool:
+		"""Switches to a LuaNumberArray if the array part only holds numbers."""
+		if self.metatable is not None or not all(type(v) is LuaNumber for v in self.arr):
+			return False
+		self.arr = array("d", [v.value for v in self.arr])
+		self.__class__ = LuaNumberArray
+		return True
+
+	# tables are only equal to themselves, unless __eq says otherwise
+	def __eq__(self, other):
+		if self is other:
+			return True
+		if self.metatable is None or not isinstance(other, LuaTable):
+			return False
+		return self.compare_meta(other, "__eq") or False
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __lt__(self, other):
+		res = self.compare_meta(other, "__lt") if isinstance(other, LuaTable) else None
+		if res is None:
+			raise LuaError("attempt to compare two table values")
+		return res
+	def __le__(self, other):
+		res = self.compare_meta(other, "__le") if isinstance(other, LuaTable) else None
+		if res is None:
+			# Lua 5.1 falls back to not (b < a)
+			res = other.compare_meta(self, "__lt") if isinstance(other, LuaTable) else None
+			if res is None:
+				raise LuaError("attempt to compare two table values")
+			return not res
+		return res
+	def __gt__(self, other):
+		if not isinstance(other, LuaTable):
+			raise LuaError("attempt to compare two table values")
+		return other.__lt__(self)
+	def __ge__(self, other):
+		if not isinstance(other, LuaTable):
+			raise LuaError("attempt to compare two table values")
+		return other.__le__(self)
+
+	def __hash__(self): return id(self)
 
-			if k.value == i + 1:
-				i += 1
-			else:
-				break
-		return LuaNumber(i)
-	
 	def __repr__(self):
 		return f"LuaTable({len(self.keys())})"
 
 
+class LuaNumberArray(LuaTable):
+	"""
+	A table whose array part only holds numbers, stored unboxed in an array('d').
+
+	Tables become one through `pack_numbers` (which the bulk math functions
+	call) and go back to a plain LuaTable as soon as anything but a number
+	is stored in the array part, so to lua code they are just tables.
+	"""
+
+	def get_from(self, key: LuaString | LuaNumber):
+		if type(key) is LuaNumber:
+			idx = key.value
+			if 1 <= idx <= len(self.arr) and idx.is_integer():
+				return LuaNumber(self.arr[int(idx) - 1])
+		val = self.hash.get(key)
+		return LuaNil() if val is None else val
+
+	def rawget(self, key: LuaObject) -> LuaObject:
+		return self.get_from(key)
+
+	def next(self, key: LuaObject) -> tuple[LuaObject, LuaObject] | None:
+		i = self.array_position(key)
+		if i is None:
+			return self.next_in_hash(key)
+		if i < len(self.arr):
+			return LuaNumber(i + 1), LuaNumber(self.arr[i])
+		return self.next_in_hash(None)
+
+	def copy(self):
+		t = LuaNumberArray(0, 0)
+		t.arr = array("d", self.arr)
+		t.hash = dict(self.hash)
+		return t
+
+	def items(self):
+		items = [(LuaNumber(i + 1), LuaNumber(v)) for i, v in enumerate(self.arr)]
+		items.extend(self.hash.items())
+		return items
+
+	def keys(self):
+		keys = [LuaNumber(i + 1) for i in range(len(self.arr))]
+		keys.extend(self.hash.keys())
+		return keys
+
+	def values(self):
+		values = [LuaNumber(v) for v in self.arr]
+		values.extend(self.hash.values())
+		return values
+
+	def set_arr(self, idx: int, val: LuaObject):
+		if type(val) is not LuaNumber:
+			self.unpack_numbers()
+			return self.set_arr(idx, val)
+		if idx > len(self.arr):
+			self.arr.append(val.value)
+			self.take_from_hash()
+		else:
+			self.arr[idx - 1] = val.value
+
+	def insert(self, idx: int, val: LuaObject):
+		if type(val) is not LuaNumber:
+			self.unpack_numbers()
+			return self.insert(idx, val)
+		self.arr.insert(idx - 1, val.value)
+		self.take_from_hash()
+
+	def remove(self, idx: int) -> LuaObject:
+		return LuaNumber(self.arr.pop(idx - 1))
+
+	def trim(self):
+		pass
+
+	def take_from_hash(self):
+		arr, hash = self.arr, self.hash
+		while hash:
+			val = hash.pop(LuaNumber(len(arr) + 1), None)
+			if val is None:
+				break
+			if type(val) is not LuaNumber:
+				self.unpack_numbers()
+				self.arr.append(val)
+				return self.take_from_hash()
+			arr.append(val.value)
+
+	def pack_numbers(self) -> bool:
+		return True
+
+	def unpack_numbers(self):
+		self.arr = [LuaNumber(v) for v in self.arr]
+		self.__class__ = LuaTable
+
+	def __repr__(self):
+		return f"LuaNumberArray({len(self.arr)})"
+
+
+class LuaMetatable(LuaTable):
+	"""
+	A table in use as a metatable.
+
+	Looking up a metamethod goes through a per-metatable cache, which also
+	remembers the ones that are missing, so for most events it's a single
+	dict lookup. The cache is dropped whenever a key is added to or removed
+	from the hash part, where every metamethod is kept.
+	"""
+
+	def metamethod(self, event: str) -> LuaObject | None:
+		try:
+			return self.cache[event]
+		except KeyError:
+			handler = self.cache[event] = self.hash.get(LuaString(event))
+			return handler
+
+	def set_hash(self, key: LuaObject, val: LuaObject):
+		self.cache.clear()
+		LuaTable.set_hash(self, key, val)
+
+	def pack_numbers(self) -> bool:
+		return False
+
+	def __repr__(self):
+		return f"LuaMetatable({len(self.keys())})"
+
+
+class LuaFrozenTable(LuaMetatable):
+	"""
+	A table that can't be changed, made by `freeze`. Tables of the standard
+	library that every env shares as they are (like json.array_mt, which
+	json recognizes by identity) are frozen, so no script can change them
+	for the others. It can still be used as a metatable.
+	"""
+
+	def read_only(self, *args):
+		raise LuaError("attempt to modify a read-only table")
+
+	set = rawset = set_hash = set_arr = insert = remove = set_metatable = set_mode = read_only
+
+	def copy(self):
+		return self
+
+	def __repr__(self):
+		return f"LuaFrozenTable({len(self.keys())})"
+
+
+def collectable(val: LuaObject) -> bool:
+	"""Whether a value is an object that can be collected, rather than a plain value like a string."""
+	return not isinstance(val, (LuaNil, LuaBoolean, LuaNumber, LuaString))
+
+def forget_key(selfref, ref):
+	t = selfref()
+	if t is not None:
+		t.hash.pop(ref, None)
+
+def forget_value(selfref, key, ref):
+	t = selfref()
+	# the entry may have been overwritten since
+	if t is not None and t.hash.get(key) is ref:
+		del t.hash[key]
+
+
+class LuaWeakTable(LuaTable):
+	"""
+	A table with weak keys, weak values or both, made by a metatable with `__mode`.
+
+	Keys and values that can be collected (tables, functions, userdata) are
+	held through weakrefs, and their entry disappears as soon as python frees
+	them. Strings, numbers and booleans are values rather than objects, so
+	like in Lua they are never removed. Everything is kept in the hash part,
+	so `#t` searches for a border, and the table library (which works on
+	the array part) sees a weak table as having no array.
+	"""
+
+	def lookup_key(self, key: LuaObject):
+		if self.weak_keys and collectable(key):
+			return weakref.ref(key)
+		return key
+
+	def get_from(self, key: LuaString | LuaNumber):
+		val = self.hash.get(self.lookup_key(key))
+		if type(val) is weakref.ref:
+			val = val()
+		if val is None:
+			return LuaNil() if self.metatable is None else self.index_meta(key)
+		return val
+
+	def rawget(self, key: LuaObject) -> LuaObject:
+		val = self.hash.get(self.lookup_key(key))
+		if type(val) is weakref.ref:
+			val = val()
+		return LuaNil() if val is None else val
+
+	def metamethod(self, event: str) -> LuaObject | None:
+		val = self.rawget(LuaString(event))
+		return None if type(val) is LuaNil else val
+
+	def set(self, key: LuaString | LuaNumber, val: LuaObject):
+		if self.metatable is not None and self.newindex_meta(key, val):
+			return
+		self.rawset(key, val)
+
+	def rawset(self, key: LuaObject, val: LuaObject):
+		if val is None or type(val) is LuaNil:
+			self.hash.pop(self.lookup_key(key), None)
+			return
+		if type(key) is LuaNil:
+			raise LuaError("table index is nil")
+		if self.weak_keys and collectable(key):
+			key = weakref.ref(key, partial(forget_key, self.selfref))
+		if self.weak_values and collectable(val):
+			val = weakref.ref(val, partial(forget_value, self.selfref, key))
+		self.hash[key] = val
+
+	def set_arr(self, idx: int, val: LuaObject):
+		self.rawset(LuaNumber(idx), val)
+
+	def next(self, key: LuaObject) -> tuple[LuaObject, LuaObject] | None:
+		# the snapshot holds the weakrefs themselves, so it doesn't keep keys alive
+		keys, i = self.traversal(None if type(key) is LuaNil else self.lookup_key(key))
+		hash = self.hash
+		while i < len(keys):
+			k, val = keys[i], hash.get(keys[i])
+			if type(k) is weakref.ref:
+				k = k()
+			if type(val) is weakref.ref:
+				val = val()
+			if k is not None and val is not None:
+				return k, val
+			i += 1
+		self.order = None
+		return None
+
+	def items(self):
+		items = []
+		for key, val in list(self.hash.items()):
+			if type(key) is weakref.ref:
+				key = key()
+			if type(val) is weakref.ref:
+				val = val()
+			if key is not None and val is not None:
+				items.append((key, val))
+		return items
+
+	def keys(self):
+		return [key for key, _ in self.items()]
+
+	def values(self):
+		return [val for _, val in self.items()]
+
+	def copy(self):
+		t = LuaTable(0, 0)
+		t.set_mode(self.weak_keys, self.weak_values)
+		for key, val in self.items():
+			t.rawset(key, val)
+		t.metatable = self.metatable
+		return t
+
+	def op_len(self):
+		n = 0
+		while type(self.rawget(LuaNumber(n + 1))) is not LuaNil:
+			n += 1
+		return LuaNumber(n)
+
+	def pack_numbers(self) -> bool:
+		return False
+
+	def __repr__(self):
+		mode = ("k" if self.weak_keys else "") + ("v" if self.weak_values else "")
+		return f"LuaWeakTable({mode}, {len(self.hash)})"
+
+
+def py_key(key: LuaObject):
+	"""The python key a lua key stands for in a dict passed in by the host."""
+	match key:
+		case LuaNumber():
+			return int(key.value) if key.value.is_integer() else key.value
+		case LuaString() | LuaBoolean():
+			return key.value
+	return key
+
+
+class LuaProxyTable(LuaTable):
+	"""
+	A table reading through to a python dict or list passed in by the host.
+
+	Nothing is converted up front: values become lua values when a script
+	reads them, and nested dicts and lists become proxies in turn, which are
+	kept so that reading the same key twice gives the same table. The first
+	write, or anything that needs the array and hash parts (like the table
+	library), turns the proxy into a plain LuaTable holding a copy, so the
+	host's object is never modified. Until then `make_py_type` hands back
+	the original object.
+	"""
+
+	def __init__(self, source: Mapping | list | tuple):
+		self.source = source
+		self.is_mapping = isinstance(source, Mapping)
+		# python key: (python value, the lua value made from it) for containers and functions
+		self.converted = {}
+
+	def lookup(self, key: LuaObject):
+		"""The python key and value for a lua key, None for the value if it's missing."""
+		source = self.source
+		if self.is_mapping:
+			k = py_key(key)
+			try:
+				return k, source.get(k)
+			except TypeError:
+				# unhashable, so it can't be there
+				return k, None
+		if type(key) is LuaNumber:
+			idx = key.value
+			if 1 <= idx <= len(source) and idx.is_integer():
+				return int(idx) - 1, source[int(idx) - 1]
+		return None, None
+
+	def wrap(self, k, val) -> LuaObject:
+		wrap = LUA_WRAPPERS.get(type(val))
+		if wrap is not None:
+			return wrap(val)
+		cached = self.converted.get(k)
+		if cached is None or cached[0] is not val:
+			cached = self.converted[k] = (val, make_lua_type(val))
+		return cached[1]
+
+	def get_from(self, key: LuaString | LuaNumber):
+		k, val = self.lookup(key)
+		if val is None:
+			return LuaNil() if self.metatable is None else self.index_meta(key)
+		return self.wrap(k, val)
+
+	def rawget(self, key: LuaObject) -> LuaObject:
+		k, val = self.lookup(key)
+		return LuaNil() if val is None else self.wrap(k, val)
+
+	def items(self):
+		if self.is_mapping:
+			return [(make_lua_type(k), self.wrap(k, v)) for k, v in self.source.items() if v is not None]
+		return [(LuaNumber(i + 1), self.wrap(i, v)) for i, v in enumerate(self.source) if v is not None]
+
+	def keys(self):
+		return [key for key, _ in self.items()]
+
+	def values(self):
+		return [val for _, val in self.items()]
+
+	def next(self, key: LuaObject) -> tuple[LuaObject, LuaObject] | None:
+		# goes through the host's object, which pairs shouldn't copy
+		source = self.source
+		if not self.is_mapping:
+			i = self.array_position(key)
+			if i is None:
+				raise LuaError("invalid key to 'next'")
+			while i < len(source):
+				if source[i] is not None:
+					return LuaNumber(i + 1), self.wrap(i, source[i])
+				i += 1
+			return None
+
+		keys, i = self.traversal(None if type(key) is LuaNil else py_key(key))
+		while i < len(keys):
+			val = source.get(keys[i])
+			if val is not None:
+				return make_lua_type(keys[i]), self.wrap(keys[i], val)
+			i += 1
+		self.order = None
+		return None
+
+	def array_position(self, key: LuaObject) -> int | None:
+		if type(key) is LuaNil:
+			return 0
+		if type(key) is LuaNumber and key.value.is_integer() and key.value >= 1:
+			return int(key.value)
+		return None
+
+	def hash_keys(self) -> list:
+		return list(self.source)
+
+	def op_len(self):
+		source = self.source
+		if self.is_mapping:
+			n = 0
+			while source.get(n + 1) is not None:
+				n += 1
+			return LuaNumber(n)
+		n = len(source)
+		while n and source[n - 1] is None:
+			n -= 1
+		return LuaNumber(n)
+
+	def materialize(self):
+		"""Turns the proxy into a plain LuaTable with the same contents."""
+		items = self.items()
+		self.__class__ = LuaTable
+		self.arr_size, self.hash_size = 0, 0
+		self.arr = []
+		self.hash = {}
+		self.order = None
+		del self.source, self.is_mapping, self.converted
+		for key, val in items:
+			self.rawset(key, val)
+
+	# reading the parts of a plain table means the proxy has to become one
+	@property
+	def arr(self):
+		self.materialize()
+		return self.arr
+
+	@property
+	def hash(self):
+		self.materialize()
+		return self.hash
+
+	def set(self, key: LuaString | LuaNumber, val: LuaObject):
+		self.materialize()
+		self.set(key, val)
+
+	def rawset(self, key: LuaObject, val: LuaObject):
+		self.materialize()
+		self.rawset(key, val)
+
+	def set_mode(self, weak_keys: bool, weak_values: bool):
+		self.materialize()
+		self.set_mode(weak_keys, weak_values)
+
+	def copy(self):
+		t = LuaProxyTable(self.source)
+		t.metatable = self.metatable
+		return t
+
+	def pack_numbers(self) -> bool:
+		self.materialize()
+		return self.pack_numbers()
+
+	def __repr__(self):
+		return f"LuaProxyTable({type(self.source).__name__}, {len(self.source)})"
+
+
 class LuaFunction(LuaObject):
 	name = "function"
+	# LuaMemoCache of a function whose results are cached, see luamemo
+	memo = None
 
 	def __init__(
 		self,
@@ -297,8 +1096,14 @@ class LuaFunction(LuaObject):
 			self.upval_names,
 			upvals
 		)
+		if self.memo is not None:
+			new_closure.memo = self.memo
 		return new_closure
 
+	def call(self, env, args):
+		from lvm import call_lua_function
+		return call_lua_function(self, env, args)
+
 	def set_upval(self, idx: int, val: LuaObject) -> None:
 		self.upvals[idx] = val
 
@@ -341,15 +1146,38 @@ class LuaFunction(LuaObject):
 	def __repr__(self):
 		return f"LuaFunction([{self.proto_num}], lines {self.first_line_num}:{self.last_line_num})"
 
+	# functions are only equal to themselves
+	def __eq__(self, other): return self is other
+	def __ne__(self, other): return self is not other
+	def __hash__(self): return id(self)
+
 
 class LuaPyFunction(LuaObject):
 	name = "function"
 
 	def __init__(self, func: callable):
 		self.func = func
+		# async host functions can only be awaited by call_lua_function_async
+		self.is_async = iscoroutinefunction(func)
+		# library functions that call back into lua get the env first, see lib.common.pass_env
+		self.pass_env = getattr(func, "lua_pass_env", False)
+		# library functions with a declared signature, see lib.common.signature
+		signature = getattr(func, "lua_signature", None)
+		if signature is None:
+			self.call_args, self.call_into = None, None
+		else:
+			self.call_args, self.call_into = signature.bind(func)
 
 	def call(self, env, args):
-		res = self.func(*args)
+		if self.is_async:
+			raise LuaError("attempt to call an async function outside of async mode")
+		if self.call_args is not None:
+			return self.call_args(env, args)
+		if self.pass_env:
+			return self.wrap_results(self.func(env, *args))
+		return self.wrap_results(self.func(*args))
+
+	def wrap_results(self, res):
 		if isinstance(res, tuple):
 			return tuple(make_lua_type(r) for r in res)
 		return (make_lua_type(res),)
@@ -357,31 +1185,106 @@ class LuaPyFunction(LuaObject):
 	def __repr__(self):
 		return f"LuaPyFunction({self.func.__name__})"
 
+	def __eq__(self, other): return self is other
+	def __ne__(self, other): return self is not other
+	def __hash__(self): return id(self)
+
 
 NO_LENGTH = [LuaObject, LuaNil, LuaBoolean, LuaNumber, LuaFunction, LuaPyFunction]
 NO_ARITHMETIC = [LuaObject, LuaNil, LuaTable, LuaFunction, LuaPyFunction]
-NO_MATHOPS = [LuaBoolean, LuaString]
-
-
-def make_lua_type(val: any) -> tuple[LuaObject]:
+NO_MATHOPS = [LuaBoolean, LuaString, LuaRope]
+
+
+def lua_concat(values: list[LuaObject]) -> LuaRope:
+	"""Concatenates strings and numbers, appending to the first value if it is an unjoined rope."""
+	first = values[0]
+	extend = type(first) is LuaRope and first.flat is None
+
+	parts = []
+	for val in values[1:] if extend else values:
+		match val:
+			case LuaString():
+				parts.append(val.value)
+			case LuaNumber():
+				parts.append(f"{val.value:.14g}")
+			case _:
+				return concat_metamethod(values)
+
+	if extend:
+		return first.append(parts, sum(map(len, parts)))
+	return LuaRope(parts, sum(map(len, parts)))
+
+
+def concat_metamethod(values: list[LuaObject]) -> LuaObject:
+	"""Concatenation involving other values than strings and numbers, which goes right to left like in Lua."""
+	values = [LuaNil() if val is None else val for val in values]
+	res = values[-1]
+	for val in reversed(values[:-1]):
+		if isinstance(val, (LuaString, LuaNumber)) and isinstance(res, (LuaString, LuaNumber)):
+			res = lua_concat([val, res])
+			continue
+		found = find_metamethod(val, res, "__concat")
+		if found is None:
+			bad = res if isinstance(val, (LuaString, LuaNumber)) else val
+			raise LuaError(f"attempt to concatenate a {bad.name} value")
+		res = call_metamethod(*found, [val, res])
+	return res
+
+
+# python types returned by host functions that can skip make_lua_type
+LUA_WRAPPERS = {float: LuaNumber, int: LuaNumber, str: LuaString, bool: LuaBoolean}
+
+
+def wrap_result(val: any) -> LuaObject:
+	wrap = LUA_WRAPPERS.get(type(val))
+	if wrap is not None:
+		return wrap(val)
+	return make_lua_type(val)
+
+
+def make_lua_type(val: any, copy: bool = False) -> tuple[LuaObject]:
+	"""
+	The lua value for a python one. Dicts and lists are wrapped in a
+	LuaProxyTable, or with copy converted into a LuaTable right away (which
+	is what the standard library tables do, since they are read constantly).
+	"""
 	match val:
 		case LuaObject(): return val
 		case None: return LuaNil()
+		case bool(): return LuaBoolean(val)
 		case int(): return LuaNumber(val)
 		case float(): return LuaNumber(val)
 		case str(): return LuaString(val)
-		case dict():
+		case Mapping() if copy:
 			t = LuaTable(0, len(val))
 			for k, v in val.items():
-				t.set(make_lua_type(k), make_lua_type(v))
+				t.set(make_lua_type(k, copy), make_lua_type(v, copy))
 			return t
-		case list():
+		case list() | tuple() if copy:
 			t = LuaTable(len(val), 0)
 			for i, v in enumerate(val):
-				t.set(LuaNumber(i + 1), make_lua_type(v))
+				t.set(LuaNumber(i + 1), make_lua_type(v, copy))
 			return t
+		case Mapping() | list() | tuple():
+			return LuaProxyTable(val)
 		case f if callable(f):
 			return LuaPyFunction(f)
 		case _:
 			raise Exception("unrecognised type: " + str(type(val)))
 
+
+def make_py_type(val: LuaObject) -> any:
+	match val:
+		case LuaNil(): return None
+		case LuaBoolean(): return val.value
+		case LuaNumber(): return int(val.value) if val.value.is_integer() else val.value
+		case LuaString(): return val.value
+		case LuaProxyTable(): return val.source
+		case LuaNumberArray() if not val.hash:
+			return [int(v) if v.is_integer() else v for v in val.arr]
+		case LuaTable():
+			if not val.hash:
+				return [make_py_type(v) for v in val.arr]
+			return {make_py_type(k): make_py_type(v) for k, v in val.items()}
+		case _:
+			raise Exception("unconvertible type: " + val.name)
@@ -0,0 +1,76 @@
+from luatypes import *
+
+from collections.abc import Mapping, Sequence
+
+
+def to_python(val: LuaObject) -> any:
+	"""
+	The python value for a lua value without copying tables: scalars are
+	unwrapped, tables become views (or the host's own object again for
+	proxies that were never written to) and functions stay as they are.
+	"""
+	match val:
+		case LuaNil(): return None
+		case LuaBoolean() | LuaString(): return val.value
+		case LuaNumber(): return int(val.value) if val.value.is_integer() else val.value
+		case LuaProxyTable(): return val.source
+		case LuaTable(): return view(val)
+	return val
+
+
+def view(t: LuaTable) -> "LuaMappingView | LuaSequenceView":
+	"""A sequence view for tables with only an array part, a mapping view for the others."""
+	if type(t) in (LuaTable, LuaNumberArray) and not t.hash:
+		return LuaSequenceView(t)
+	return LuaMappingView(t)
+
+
+class LuaMappingView(Mapping):
+	"""
+	A read-only `Mapping` over a lua table, converting keys and values as
+	they are read. Changes the script makes to the table show through.
+	"""
+
+	def __init__(self, table: LuaTable):
+		self.table = table
+
+	def __getitem__(self, key):
+		val = self.table.rawget(make_lua_type(key))
+		if type(val) is LuaNil:
+			raise KeyError(key)
+		return to_python(val)
+
+	def __iter__(self):
+		return (to_python(key) for key in self.table.keys())
+
+	def __len__(self):
+		return len(self.table.keys())
+
+	def __repr__(self):
+		return f"LuaMappingView({dict(self)!r})"
+
+
+class LuaSequenceView(Sequence):
+	"""
+	A read-only `Sequence` over the array part of a lua table (its items
+	1 to #t), converting values as they are read.
+	"""
+
+	def __init__(self, table: LuaTable):
+		self.table = table
+
+	def __getitem__(self, idx: int | slice):
+		if isinstance(idx, slice):
+			return [self[i] for i in range(*idx.indices(len(self)))]
+		n = len(self)
+		if idx < 0:
+			idx += n
+		if not 0 <= idx < n:
+			raise IndexError("lua table index out of range")
+		return to_python(self.table.rawget(LuaNumber(idx + 1)))
+
+	def __len__(self):
+		return int(self.table.op_len().value)
+
+	def __repr__(self):
+		return f"LuaSequenceView({list(self)!r})"
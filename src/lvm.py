@@ -1,15 +1,14 @@
 from luatypes import *
 from luaenv import LuaEnv
-
-
-debug = True
+from luamemo import memo_key
 
 
 class LuaStack:
 	def __init__(self, max_stack_size: int):
 		self.max_stack_size = max_stack_size
 		self.registers = [None] * max_stack_size
-		self.pool = {}
+		# upvalues still reading their register, by register index
+		self.open_upvals = {}
 
 	def __getitem__(self, idx: int | slice):
 		return self.registers[idx]
@@ -22,34 +21,126 @@ class LuaStack:
 		return len(self.registers)
 
 	def open_upval(self, idx: int):
-		self.pool.update({idx: self[idx]})
-		return LuaUpvalue(self, idx)
+		# closures capturing the same local share its upvalue
+		upval = self.open_upvals.get(idx)
+		if upval is None:
+			upval = self.open_upvals[idx] = LuaUpvalue(self.registers, idx)
+		return upval
+
+	def close_upvals(self, level: int):
+		"""Closes the upvalues of the registers from level on, when their locals go out of scope."""
+		for idx in [i for i in self.open_upvals if i >= level]:
+			self.open_upvals.pop(idx).close()
+
+	def grow(self, size: int):
+		"""Makes room for size registers, for variable results that go past max_stack_size."""
+		registers = self.registers
+		if size > len(registers):
+			# in place, open upvalues read through this list
+			registers.extend([None] * (size - len(registers)))
+
+	def clear(self, idx: int):
+		# registers past a call's results read as unset, see not_none
+		registers = self.registers
+		registers[idx:] = [None] * (len(registers) - idx)
+
+
+class LuaUpvalue(LuaObject):
+	"""
+	A local variable captured by a closure.
+
+	While the function declaring the local runs, the upvalue is open and goes
+	through its register, so that function and all closures share the
+	variable. Once the local goes out of scope the upvalue is closed: it
+	keeps the value itself and lets go of the registers, so a closure doesn't
+	keep the frame it was made in alive.
+	"""
+
+	def __init__(self, registers: list, idx: int):
+		self.registers = registers
+		self.idx = idx
+		self.value = None
 
-	def get_upval(self, idx: int) -> LuaObject:
-		return self.pool[idx]
+	def get(self) -> LuaObject:
+		if self.registers is None:
+			return self.value
+		val = self.registers[self.idx]
+		return LuaNil() if val is None else val
 
-	def set_upval(self, idx: int, val: LuaObject):
+	def set(self, val: LuaObject):
 		assert isinstance(val, LuaObject), "tried to set a non-lua value to an upvalue"
-		self.pool[idx] = val
+		if self.registers is None:
+			self.value = val
+		else:
+			self.registers[self.idx] = val
 
-	def pop(self, idx: int):
-		self.registers.pop(idx)
-		self.registers.append(None)
+	def close(self):
+		self.value = self.get()
+		self.registers = None
 
+	def __repr__(self):
+		state = "closed" if self.registers is None else f"open, register {self.idx}"
+		return f"LuaUpvalue({state})"
 
-class LuaUpvalue(LuaObject):
-	def __init__(self, parent: LuaStack, idx: int):
-		self.parent = parent
-		self.idx = idx
 
-	def set(self, val: LuaObject):
-		self.parent.set_upval(self.idx, val)
+def for_number(val: LuaObject | None, what: str) -> int | float:
+	num = val.tonumber() if val is not None else LuaNil()
+	if not isinstance(num, LuaNumber):
+		raise LuaError(f"'for' {what} must be a number")
+	return int(num.value) if num.value.is_integer() else num.value
 
-	def get(self):
-		return self.parent.get_upval(self.idx)
 
-	def close(self):
-		self.parent.pop(self.idx)
+class LuaForLoop(LuaObject):
+	"""
+	State of a numeric for loop, kept in the loop's internal index register.
+
+	The index, limit and step are plain python numbers (ints when they are
+	all integral), so iterating doesn't allocate or compare lua numbers.
+	"""
+
+	name = "for state"
+
+	def __init__(self, init: LuaObject, limit: LuaObject, step: LuaObject):
+		self.limit = for_number(limit, "limit")
+		self.step = for_number(step, "step")
+		self.i = for_number(init, "initial value") - self.step
+		self.ascending = self.step > 0
+
+	def __repr__(self):
+		return f"LuaForLoop({self.i}, {self.limit}, {self.step})"
+
+
+class LuaFrame:
+	"""
+	A function activation as seen by a tracer.
+
+	Stands in for the instruction list of a traced function, so that every
+	instruction fetch reports to the tracer first. Untraced functions read
+	their instructions directly and pay nothing for this.
+	"""
+
+	def __init__(self, tracer, lua_func, stack: LuaStack):
+		self.tracer = tracer
+		self.func = lua_func
+		self.stack = stack
+		self.pc = 0
+		tracer.on_call(self)
+
+	def __getitem__(self, pc: int):
+		self.pc = pc
+		self.tracer.on_instruction(self)
+		return self.func.instructs[pc]
+
+	@property
+	def line(self) -> int | None:
+		if self.pc < len(self.func.line_positions):
+			return self.func.line_positions[self.pc]
+		return None
+
+	def locals(self) -> dict[str, LuaObject]:
+		# locals are numbered in order of the ones active at the current pc
+		active = [name for name, start_pc, end_pc in self.func.local_vars if start_pc <= self.pc < end_pc]
+		return {name: self.stack[i] or LuaNil() for i, name in enumerate(active)}
 
 
 def not_none(l: list) -> list:
@@ -57,6 +148,79 @@ def not_none(l: list) -> list:
 
 
 def call_lua_function(lua_func, env: LuaEnv, args: list[LuaObject]):
+	# metamethods run in the env of the script running them, see call_metamethod
+	token = running_env.set(env) if running_env.get() is not env else None
+	try:
+		frame = execute_lua_function(lua_func, env, args)
+		try:
+			awaitable = frame.send(None)
+		except StopIteration as stop:
+			return stop.value
+
+		# the function tried to await an async host function, which needs the
+		# event loop of call_lua_function_async to drive it
+		frame.close()
+		awaitable.close()
+		raise LuaError("attempt to call an async function outside of async mode")
+	finally:
+		if token is not None:
+			running_env.reset(token)
+
+
+async def call_lua_function_async(lua_func, env: LuaEnv, args: list[LuaObject]):
+	# every asyncio task has its own context, so concurrent scripts don't mix up their envs
+	token = running_env.set(env)
+	try:
+		frame = execute_lua_function(lua_func, env, args)
+		value, error = None, None
+		while True:
+			try:
+				if error is None:
+					awaitable = frame.send(value)
+				else:
+					awaitable = frame.throw(error)
+			except StopIteration as stop:
+				return stop.value
+
+			# suspend the whole lua call stack until the host coroutine completes
+			try:
+				value, error = await awaitable, None
+			except Exception as err:
+				value, error = None, err
+	finally:
+		running_env.reset(token)
+
+
+def call_value(func: LuaObject, env: LuaEnv, args: list[LuaObject]):
+	"""
+	Calls any value from within the VM, as a generator to `yield from`: lua
+	functions run on the same driver, async host functions have their
+	awaitable yielded up to it, anything else is called directly.
+	"""
+	if type(func) is LuaFunction:
+		return (yield from execute_lua_function(func, env, args))
+	if type(func) is LuaPyFunction and func.is_async:
+		return func.wrap_results((yield func.func(*args)))
+	return func.call(env, args)
+
+
+def execute_lua_function(lua_func, env: LuaEnv, args: list[LuaObject]):
+	"""
+	Runs a lua function as a generator.
+
+	Calls to lua functions are delegated with `yield from`, so the python
+	generators make up the lua call stack. When an async host function is
+	called its awaitable is yielded up to the driver (`call_lua_function` or
+	`call_lua_function_async`), which sends the result back in.
+	"""
+	# functions marked pure answer from their cache, see luamemo
+	memo = lua_func.memo
+	if memo is not None:
+		key = memo_key(args)
+		res = memo.get(key)
+		if res is not None:
+			return res
+
 	pc = 0
 	stack = LuaStack(lua_func.max_stack_size)
 	for i in range(len(args)):
@@ -64,59 +228,115 @@ def call_lua_function(lua_func, env: LuaEnv, args: list[LuaObject]):
 	const = lua_func.consts
 	upval = lua_func.upvals
 
-	if debug:
-		upval_names = lua_func.upval_names
-		local_names = lua_func.local_vars
+	budget = env.budget
+	if budget is not None:
+		budget.charge(len(lua_func.instructs))
+
+	# a tracer sees every instruction fetch through a LuaFrame, without one
+	# the instructions are read straight from the function
+	tracer = env.tracer
+	if tracer is None:
+		code = lua_func.instructs
+	else:
+		code = LuaFrame(tracer, lua_func, stack)
 
 	def stack_or_const(val: int):
 		return const[val ^ 256] if val & 256 else stack[val]
 
-	if debug:
-		print(lua_func.get_debug_str())
-
 	while pc < len(lua_func.instructs):
-		inst = lua_func.instructs[pc]
+		inst = code[pc]
 		A, B, C, Bx, sBx = inst.A, inst.B, inst.C, inst.Bx, inst.sBx
 
-		if debug:
-			print("\x1b[3J\x1b[H", end="")
-			print(lua_func.get_debug_str())
-			registers = [v or LuaNil() for v in stack.registers]
-			for [name, _, _], val in zip(local_names, registers):
-				print(f"-> {name} = {repr(val)}")
-			extra_stack = registers[len(local_names):]
-			print(f"-> [{', '.join(repr(v) for v in extra_stack)}]")
-			input(f"{lua_func.proto_num}:[{pc + 1}] {inst.name}")
-
+		# python tests the cases one after the other, so the most frequently
+		# executed instructions come first
 		match inst.opcode:
 			case 0x00: # move
 				stack[A] = stack[B]
 			case 0x01: # loadk
 				stack[A] = const[Bx]
-			case 0x02: # loadbool
-				stack[A] = LuaBoolean(B)
-				if bool(C):
-					pc += 1
-			case 0x03: # loadnil
-				for i in range(A, B + 1):
-					stack[i] = LuaNil()
-			case 0x04: # getupval
-				stack[A] = upval[B].get()
-			case 0x05: # getglobal
-				stack[A] = env.get(const[Bx])
 			case 0x06: # gettable
 				stack[A] = stack[B].get_from(stack_or_const(C))
-			case 0x07: # setglobal
-				env.set(const[Bx], stack[A])
-			case 0x08: # setupval
-				upval[B].set(stack[A])
-			case 0x09: # settable
-				stack[A].set(stack_or_const(B), stack_or_const(C))
-			case 0x0A: # newtable
-				stack[A] = LuaTable(decode_fbyte(B), decode_fbyte(C))
+			case 0x40: # getglobal + gettable
+				stack[A] = env.get(const[Bx])
+				inst = inst.second
+				stack[inst.A] = stack[inst.B].get_from(stack_or_const(inst.C))
+				pc += 1
+			case 0x05: # getglobal
+				stack[A] = env.get(const[Bx])
+			case 0x04: # getupval
+				stack[A] = upval[B].get()
+			case 0x1C | 0x45: # call, self + call
+				if inst.opcode == 0x45:
+					stack[A + 1] = stack[B]
+					stack[A] = stack[B].get_from(stack_or_const(C))
+					pc += 1
+					A, B, C = inst.second.A, inst.second.B, inst.second.C
+
+				func = stack[A]
+				if B != 0 and C != 0 and type(func) is LuaPyFunction and func.call_into is not None:
+					# a library function with a signature reads its arguments from
+					# the registers and stores its results back into them
+					func.call_into(env, stack.registers, A, B - 1, C - 1)
+					pc += 1
+					continue
+
+				if B == 1:
+					args = []
+				elif B == 0:
+					args = stack[A + 1:]
+				else:
+					args = stack[A + 1:A + B]
+
+				args = not_none(args)
+
+				res = yield from call_value(func, env, args)
+
+				stack.clear(A)
+
+				num_res = (C - 1) if C >= 1 else len(res)
+				stack.grow(A + num_res)
+
+				for i in range(num_res):
+					stack[A + i] = res[i] if i < len(res) else LuaNil()
 			case 0x0B: # self
 				stack[A + 1] = stack[B]
 				stack[A] = stack[B].get_from(stack_or_const(C))
+			case 0x43: # lt + jmp
+				if (stack_or_const(B) < stack_or_const(C)) != bool(A):
+					pc += 1
+				else:
+					sBx = inst.second.sBx
+					pc += sBx + 1
+					if sBx < 0 and budget is not None:
+						budget.charge(-sBx)
+			case 0x44: # le + jmp
+				if (stack_or_const(B) <= stack_or_const(C)) != bool(A):
+					pc += 1
+				else:
+					sBx = inst.second.sBx
+					pc += sBx + 1
+					if sBx < 0 and budget is not None:
+						budget.charge(-sBx)
+			case 0x42: # eq + jmp
+				if (stack_or_const(B) == stack_or_const(C)) != bool(A):
+					pc += 1
+				else:
+					sBx = inst.second.sBx
+					pc += sBx + 1
+					if sBx < 0 and budget is not None:
+						budget.charge(-sBx)
+			case 0x46: # test + jmp
+				if (stack[A] is not None and stack[A].bool()) != bool(C):
+					pc += 1
+				else:
+					sBx = inst.second.sBx
+					pc += sBx + 1
+					if sBx < 0 and budget is not None:
+						budget.charge(-sBx)
+			case 0x16: # jmp
+				pc += sBx
+				if sBx < 0 and budget is not None:
+					budget.charge(-sBx)
 			case 0x0C: # add
 				stack[A] = stack_or_const(B).op_add(stack_or_const(C))
 			case 0x0D: # sub
@@ -125,59 +345,78 @@ def call_lua_function(lua_func, env: LuaEnv, args: list[LuaObject]):
 				stack[A] = stack_or_const(B).op_mul(stack_or_const(C))
 			case 0x0F: # div
 				stack[A] = stack_or_const(B).op_div(stack_or_const(C))
-			case 0x10: # mod
-				stack[A] = stack_or_const(B).op_mod(stack_or_const(C))
-			case 0x11: # pow
-				stack[A] = stack_or_const(B).op_pow(stack_or_const(C))
-			case 0x12: # unm
-				stack[A] = stack[B].op_unm()
-			case 0x13: # not
-				stack[A] = stack[B].op_not()
-			case 0x14: # len
-				stack[A] = stack[B].op_len()
-			case 0x15: # concat
-				stack[A] = reduce(lambda l, r: l.op_concat(r), stack[B:C + 1])
-				# stack[A] = LuaString("".join(map(lambda s: s.tostring(), stack[B:C + 1])))
-			case 0x16: # jmp
-				pc += sBx
-			case 0x17: # eq
-				if (stack_or_const(B) == stack_or_const(C)) != bool(A):
-					pc += 1
+			case 0x1F: # forloop
+				loop = stack[A]
+				i = loop.i + loop.step
+				if i <= loop.limit if loop.ascending else i >= loop.limit:
+					loop.i = i
+					if inst.loop_var_live:
+						stack[A + 3] = LuaNumber(i)
+					pc += sBx
+					if budget is not None:
+						budget.charge(-sBx)
+			case 0x09: # settable
+				stack[A].set(stack_or_const(B), stack_or_const(C))
+			case 0x1E: # return
+				if B == 1:
+					res = (LuaNil(),)
+				elif B == 0:
+					res = tuple(not_none(stack[A:]))
+				else:
+					res = tuple(stack[A:A + B - 1])
+				if stack.open_upvals:
+					stack.close_upvals(0)
+				if memo is not None:
+					memo.put(key, res)
+				return res
 			case 0x18: # lt
 				if (stack_or_const(B) < stack_or_const(C)) != bool(A):
 					pc += 1
 			case 0x19: # le
 				if (stack_or_const(B) <= stack_or_const(C)) != bool(A):
 					pc += 1
+			case 0x17: # eq
+				if (stack_or_const(B) == stack_or_const(C)) != bool(A):
+					pc += 1
 			case 0x1A: # test
-				if (stack[B] is not None and stack[B].bool()) != bool(C):
+				if (stack[A] is not None and stack[A].bool()) != bool(C):
 					pc += 1
 			case 0x1B: # testset
 				if (stack[B] is not None and stack[B].bool()) != bool(C):
 					pc += 1
 				else:
 					stack[A] = stack[B] or LuaNil()
-			case 0x1C: # call
-				if B == 1:
-					args = []
-				elif B == 0:
-					args = stack[A + 1:]
-				else:
-					args = stack[A + 1:A + B]
-
-				args = not_none(args)
-
-				if debug: print(f"call: args {args}")
-				res = stack[A].call(env, args)
-
-				for i in range(A, len(stack)):
-					stack.pop(A)
-
-				num_res = (C - 1) if C >= 1 else len(res)
-				if debug: print(f"call: returned with {num_res} results {res}")
-
-				for i in range(num_res):
-					stack[A + i] = res[i] if i < len(res) else LuaNil()
+			case 0x07: # setglobal
+				env.set(const[Bx], stack[A])
+			case 0x08: # setupval
+				upval[B].set(stack[A])
+			case 0x0A: # newtable
+				stack[A] = LuaTable(decode_fbyte(B), decode_fbyte(C))
+			case 0x02: # loadbool
+				stack[A] = LuaBoolean(B)
+				if bool(C):
+					pc += 1
+			case 0x03: # loadnil
+				for i in range(A, B + 1):
+					stack[i] = LuaNil()
+			case 0x10: # mod
+				stack[A] = stack_or_const(B).op_mod(stack_or_const(C))
+			case 0x11: # pow
+				stack[A] = stack_or_const(B).op_pow(stack_or_const(C))
+			case 0x41: # loadk + arith
+				stack[A] = const[Bx]
+				method, inst = inst.arith_method, inst.second
+				lhs, rhs = stack_or_const(inst.B), stack_or_const(inst.C)
+				stack[inst.A] = getattr(lhs, method)(rhs)
+				pc += 1
+			case 0x12: # unm
+				stack[A] = stack[B].op_unm()
+			case 0x13: # not
+				stack[A] = stack[B].op_not()
+			case 0x14: # len
+				stack[A] = stack[B].op_len()
+			case 0x15: # concat
+				stack[A] = lua_concat(stack[B:C + 1])
 			case 0x1D: # tail_call
 				if B == 1:
 					args = []
@@ -187,41 +426,25 @@ def call_lua_function(lua_func, env: LuaEnv, args: list[LuaObject]):
 					args = stack[A + 1:A + B]
 
 				args = not_none(args)
+				if stack.open_upvals:
+					stack.close_upvals(0)
 
-				if debug: print(f"tailcall: args {args}")
-				res = stack[A].call(env, args)
-
-				for i in range(A, len(stack)):
-					stack.pop(A)
-
-				if debug: print(f"tailcall: returning with {len(res)} results {res}")
+				func = stack[A]
+				res = yield from call_value(func, env, args)
+				if memo is not None:
+					memo.put(key, res)
 				return res
-			case 0x1E: # return
-				if B == 1:
-					res = (LuaNil(),)
-				elif B == 0:
-					res = tuple(stack[A:])
-				else:
-					res = tuple(stack[A:A + B - 1])
-
-				for i in range(A, len(stack)):
-					stack.pop(A)
-
-				if debug: print(f"return: returning with {len(res)} results {res}")
-				return res
-			case 0x1F: # forloop
-				stack[A] = stack[A].op_add(stack[A + 2])
-				if stack[A] <= stack[A + 1]:
-					pc += sBx
-					stack[A + 3] = stack[A]
 			case 0x20: # forprep
-				stack[A] = stack[A].op_sub(stack[A + 2])
+				stack[A] = LuaForLoop(stack[A], stack[A + 1], stack[A + 2])
 				pc += sBx
 			case 0x21: # tforloop
-				res = stack[A].call(env, [stack[A + 1], stack[A + 2]])
+				func = stack[A]
+				args = [stack[A + 1], stack[A + 2]]
+				res = yield from call_value(func, env, args)
 				
+				# iterators may return fewer values than there are loop variables
 				for i in range(0, C):
-					stack[A + 3 + i] = res[i]
+					stack[A + 3 + i] = res[i] if i < len(res) else LuaNil()
 
 				if not isinstance(stack[A + 3], LuaNil):
 					stack[A + 2] = stack[A + 3]
@@ -239,32 +462,29 @@ def call_lua_function(lua_func, env: LuaEnv, args: list[LuaObject]):
 
 				for i in range(1, B + 1):
 					stack[A].set(
-						((C - 1) * LFIELDS_PER_FLUSH + i),
+						LuaNumber((C - 1) * LFIELDS_PER_FLUSH + i),
 						stack[A + i]
 					)
 			case 0x23: # close
-				for i in range(A, len(stack)):
-					stack.pop(i)
+				if stack.open_upvals:
+					stack.close_upvals(A)
 			case 0x24: # closure
 				func = lua_func.func_protos[Bx]
 				new_upvals = []
-				while lua_func.instructs[pc + 1].opcode in {0x00, 0x04}:
+				# each upvalue is described by a move (a local of this function)
+				# or a getupval (an upvalue of this function) following the closure
+				for _ in range(func.num_upvals):
 					pc += 1
 					inst = lua_func.instructs[pc]
-
-					# input(f" -> {inst.name}")
-
 					match inst.opcode:
 						case 0x00: # move
 							new_upvals.append(stack.open_upval(inst.B))
 						case 0x04: # getupval
 							new_upvals.append(upval[inst.B])
-
-				if len(new_upvals) != func.num_upvals:
-					raise Exception("Internal VM error")
+						case _:
+							raise Exception("Internal VM error")
 
 				stack[A] = func.closure(new_upvals)
 			case 0x25: # vararg
 				raise LuaError("Not implemented: vararg") # TODO
-
 		pc += 1
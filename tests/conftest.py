@@ -0,0 +1,35 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from luaenv import LuaEnv
+from luafile import LuaFile
+from luaoutput import LuaOutput
+from luatypes import make_py_type
+from lvm import call_lua_function
+
+
+# the VM runs luac5.1 bytecode, tests written in lua need the compiler
+needs_luac = pytest.mark.skipif(shutil.which("luac5.1") is None, reason="luac5.1 not found")
+
+
+def compile_lua(source: str) -> bytes:
+	proc = subprocess.run(["luac5.1", "-o", "/dev/stdout", "-"], input=source.encode(), capture_output=True, check=True)
+	return proc.stdout
+
+
+@pytest.fixture
+def run_lua():
+	"""Runs a chunk in a fresh env, returning its results as python values and what it printed."""
+	def run(source: str, env: LuaEnv | None = None) -> tuple[list, str]:
+		env = env if env is not None else LuaEnv.get_default()
+		env.output = LuaOutput.capture()
+		luafile = LuaFile("test", compile_lua(source), env)
+		res = call_lua_function(luafile.main_func, env, [])
+		return [make_py_type(r) for r in res], env.output.getvalue()
+	return run
@@ -0,0 +1,40 @@
+import pytest
+from conftest import needs_luac
+
+from luaenv import LuaEnv
+from luatypes import *
+
+
+def call_global(name: str, *args) -> list:
+	env = LuaEnv.get_default()
+	return [make_py_type(r) for r in env.get(LuaString(name)).call(env, [make_lua_type(a) for a in args])]
+
+
+def test_tonumber_hex_strings():
+	assert call_global("tonumber", "0x10") == [16]
+	assert call_global("tonumber", " 0XfF ") == [255]
+	assert call_global("tonumber", "-0x10") == [-16]
+	assert call_global("tonumber", "0x") == [None]
+	assert call_global("tonumber", "10", 16) == [16]
+	assert call_global("tonumber", "1e2") == [100]
+
+
+@needs_luac
+def test_dostring_runs_in_the_callers_env(run_lua):
+	res, out = run_lua("""
+		x = 1
+		local a, b = dostring("x = x + 1; print(x); return x, 'done'")
+		return x, a, b
+	""")
+	assert res == [2, 2, "done"]
+	assert out == "2\n"
+
+
+@needs_luac
+def test_dofile_errors_reach_the_caller(run_lua, tmp_path):
+	path = tmp_path / "chunk.lua"
+	path.write_text("count = (count or 0) + 1\nerror('from the chunk')\n")
+	env = LuaEnv.get_default()
+	with pytest.raises(LuaError, match="from the chunk"):
+		run_lua(f'dofile("{path}")', env)
+	assert env.get(LuaString("count")) == LuaNumber(1)
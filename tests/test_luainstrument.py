@@ -0,0 +1,37 @@
+from luaenv import LuaEnv
+from luainstrument import LuaInstrumentation
+from luatypes import *
+
+
+def test_table_subclasses_are_counted():
+	numbers = make_lua_type([1.0, 2.0, 3.0], copy=True)
+	assert numbers.pack_numbers()
+	weak = LuaTable(0, 0)
+	weak.set_mode(True, False)
+	proxy = LuaProxyTable({"a": 1})
+
+	with LuaInstrumentation(LuaEnv.get_default()) as stats:
+		numbers.get_from(LuaNumber(2))
+		numbers.get_from(LuaString("x"))
+		weak.set(LuaString("k"), LuaNumber(1))
+		weak.get_from(LuaString("k"))
+		proxy.get_from(LuaString("a"))
+		proxy.get_from(LuaString("b"))
+
+	assert stats.table_gets == {"array": 1, "hash": 1, "proxy": 1, "miss": 2}
+	assert stats.table_sets == {"hash": 1}
+	# the proxy wasn't turned into a table by counting
+	assert type(proxy) is LuaProxyTable
+
+
+def test_allocations_are_counted_by_class():
+	with LuaInstrumentation(LuaEnv.get_default()) as stats:
+		LuaRope(["a", "b"], 2)
+		LuaNumberArray(0, 0)
+		LuaProxyTable([])
+		LuaTable(0, 0)
+
+	assert stats.allocs["LuaRope"] == 1
+	assert stats.allocs["LuaNumberArray"] == 1
+	assert stats.allocs["LuaProxyTable"] == 1
+	assert stats.allocs["LuaTable"] == 1
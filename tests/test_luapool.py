@@ -0,0 +1,26 @@
+from conftest import compile_lua, needs_luac
+
+from luapool import LuaExecutor, LuaThreadExecutor
+
+
+SCRIPT = """
+	local name = ...
+	io.write("hello ")
+	print(name)
+	return #name
+"""
+
+
+@needs_luac
+def test_thread_executor_job_output(capsys):
+	with LuaThreadExecutor({"hello": compile_lua(SCRIPT)}, threads=2) as executor:
+		assert executor.execute("hello", ("world",)) == [5]
+	assert capsys.readouterr().out == "hello world\n"
+
+
+@needs_luac
+def test_executor_job_output(capfd):
+	# the workers are forked, so their output only shows up on the file descriptor
+	with LuaExecutor({"hello": compile_lua(SCRIPT)}, processes=1) as executor:
+		assert executor.execute("hello", ("world",)) == [5]
+	assert capfd.readouterr().out == "hello world\n"
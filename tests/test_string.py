@@ -0,0 +1,55 @@
+from conftest import needs_luac
+
+from luaenv import LuaEnv
+from luatypes import *
+
+
+def call_string(name: str, *args) -> list:
+	env = LuaEnv.get_default()
+	func = env.get(LuaString("string")).get_from(LuaString(name))
+	return [make_py_type(r) for r in func.call(env, [make_lua_type(a) for a in args])]
+
+
+def test_gsub_nil_replacement_keeps_the_match():
+	assert call_string("gsub", "abc", "%w", lambda c: None) == ["abc", 3]
+	assert call_string("gsub", "abc", "%w", lambda c: c.value == "b" and "X") == ["aXc", 3]
+
+
+def test_gsub_missing_table_key_keeps_the_match():
+	repl = LuaTable(0, 1)
+	repl.set(LuaString("b"), LuaString("X"))
+	assert call_string("gsub", "abc", "%w", repl) == ["aXc", 3]
+
+
+@needs_luac
+def test_gsub_lua_function_returning_nil(run_lua):
+	res, _ = run_lua("""
+		return (string.gsub("hello world", "%w+", function(w)
+			local r
+			if w == "world" then r = "lua" end
+			return r
+		end))
+	""")
+	assert res == ["hello lua"]
+
+
+@needs_luac
+def test_gmatch_loop_with_multiple_captures(run_lua):
+	res, _ = run_lua("""
+		local keys, sum = {}, 0
+		for k, v in string.gmatch("a=1, b=2, c=3", "(%w+)=(%w+)") do
+			keys[#keys + 1] = k
+			sum = sum + tonumber(v)
+		end
+		return table.concat(keys), sum
+	""")
+	assert res == ["abc", 6]
+
+
+@needs_luac
+def test_find_and_byte_print_every_result(run_lua):
+	_, out = run_lua("""
+		print(string.find("hello", "(l)(l)"))
+		print(string.byte("hello", 1, -1))
+	""")
+	assert out == "3\t4\tl\tl\n104\t101\t108\t108\t111\n"
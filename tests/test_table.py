@@ -0,0 +1,45 @@
+import pytest
+from conftest import needs_luac
+
+from luaenv import LuaEnv
+from luatypes import *
+
+
+def call_table(name: str, *args) -> tuple:
+	env = LuaEnv.get_default()
+	func = env.get(LuaString("table")).get_from(LuaString(name))
+	return func.call(env, list(args))
+
+
+def test_sort_tables_with_lt():
+	meta = LuaTable(0, 1)
+	meta.set(LuaString("__lt"), make_lua_type(lambda a, b: a.get_from(LuaString("n")) < b.get_from(LuaString("n"))))
+	t = LuaTable(3, 0)
+	for i, n in enumerate([3, 1, 2]):
+		item = LuaTable(0, 1)
+		item.set(LuaString("n"), LuaNumber(n))
+		item.set_metatable(meta)
+		t.set(LuaNumber(i + 1), item)
+
+	call_table("sort", t)
+	assert [make_py_type(v.get_from(LuaString("n"))) for v in t.arr] == [1, 2, 3]
+
+
+def test_sort_tables_without_lt():
+	t = make_lua_type([{"n": 1}, {"n": 2}], copy=True)
+	with pytest.raises(LuaError, match="attempt to compare two table values"):
+		call_table("sort", t)
+
+
+@needs_luac
+def test_sort_tables_with_lt_in_lua(run_lua):
+	res, _ = run_lua("""
+		local meta = {__lt = function(a, b) return a.n < b.n end}
+		local t = {}
+		for _, n in ipairs({5, 3, 4, 1, 2}) do t[#t + 1] = setmetatable({n = n}, meta) end
+		table.sort(t)
+		local ns = {}
+		for i, v in ipairs(t) do ns[i] = v.n end
+		return table.concat(ns, " ")
+	""")
+	assert res == ["1 2 3 4 5"]
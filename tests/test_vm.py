@@ -0,0 +1,36 @@
+from conftest import needs_luac
+
+
+@needs_luac
+def test_ipairs_loop_runs_to_completion(run_lua):
+	res, _ = run_lua("""
+		local sum, count = 0, 0
+		for i, v in ipairs({10, 20, 30}) do
+			sum = sum + i * v
+			count = count + 1
+		end
+		return sum, count
+	""")
+	assert res == [140, 3]
+
+
+@needs_luac
+def test_pairs_loop_runs_to_completion(run_lua):
+	res, _ = run_lua("""
+		local n = 0
+		for k, v in pairs({1, 2, x = 3}) do n = n + v end
+		return n
+	""")
+	assert res == [6]
+
+
+@needs_luac
+def test_multiple_results_past_the_stack_size(run_lua):
+	res, out = run_lua("""
+		local t = {}
+		for i = 1, 300 do t[i] = i end
+		print(unpack(t, 1, 5))
+		return unpack(t)
+	""")
+	assert res == list(range(1, 301))
+	assert out == "1\t2\t3\t4\t5\n"